@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author:  Hua Liang [ Stupid ET ]
+# email:   et@everet.org
+# website: http://EverET.org
+#
+# 字符图集
+#
+# Tools/GeneratorCharacters.py 切出来的每个字符原本是一张单独的PNG，
+# 生成验证码时要逐个打开，每次粘贴还要重新计算一遍遮罩。
+# 这里把所有字符打包到一张RGBA图集中，alpha通道直接存放预先算好的遮罩，
+# 再用一个JSON清单记录每个字符的位置。图集只在第一次使用时载入，
+# 原始格式（raw）的图集可以直接mmap，不需要解码。
+#
+#   atlas = GlyphAtlas.from_directory('Images')
+#   atlas.save('Images/atlas')                # atlas.json + atlas.png
+#   atlas = GlyphAtlas.open('Images/atlas.json')
+#   img = atlas.canvas((100, 40))
+#   atlas.compose('EfLb', img, (15, 0))
+
+import os, json, mmap
+import Image, ImageChops
+
+
+class Glyph(object):
+    '''图集中的一个字符，image的alpha通道就是粘贴时使用的遮罩'''
+    __slots__ = ('char', 'box', 'image', 'width', 'height')
+
+    def __init__(self, char, box, image):
+        self.char = char
+        self.box = box
+        self.image = image
+        self.width = box[2] - box[0]
+        self.height = box[3] - box[1]
+
+
+def glyph_mask(img):
+    '''GeneratorCharacters生成的字符是白底黑字，遮罩是反转后的绿色通道'''
+    return ImageChops.invert(img.convert('RGBA').split()[1])
+
+
+class GlyphAtlas(object):
+    '''字符图集
+    @param image RGBA图集，或者返回图集的函数（用于延迟载入）
+    @param boxes {字符: (left, top, right, bottom)}
+    @param metrics {字符: {度量名: 值}}，随清单一起保存，图集本身不使用
+    一张图集可以放多套字体，这时字符的名字是 "字体/字符"，用face(字体)取出其中一套。
+    '''
+    def __init__(self, image, boxes, metrics=None):
+        self._image = image
+        self.boxes = boxes
+        self.metrics = metrics or {}
+        self._glyphs = None
+        self._blanks = {}
+
+    @property
+    def image(self):
+        if callable(self._image):
+            self._image = self._image()
+        return self._image
+
+    @property
+    def glyphs(self):
+        '''{字符: Glyph}，第一次访问时才载入图集并切出每个字符'''
+        if self._glyphs is None:
+            image = self.image
+            self._glyphs = dict((ch, Glyph(ch, box, image.crop(box)))
+                                for ch, box in self.boxes.iteritems())
+            for glyph in self._glyphs.itervalues():
+                glyph.image.load()
+        return self._glyphs
+
+    @property
+    def characters(self):
+        return ''.join(sorted(self.boxes))
+
+    @property
+    def faces(self):
+        '''图集中所有字体的名字'''
+        return sorted(set(name.rsplit('/', 1)[0] for name in self.boxes if '/' in name))
+
+    def face(self, name):
+        '''图集中的一套字体，与原图集共用同一张图片'''
+        prefix = name + '/'
+        boxes = dict((key[len(prefix):], box) for key, box in self.boxes.iteritems()
+                     if key.startswith(prefix))
+        if not boxes:
+            raise KeyError(name)
+        metrics = dict((key[len(prefix):], value) for key, value in self.metrics.iteritems()
+                       if key.startswith(prefix))
+        return GlyphAtlas(lambda: self.image, boxes, metrics)
+
+    @classmethod
+    def from_glyphs(cls, glyphs, max_width=1024, padding=1, metrics=None):
+        '''把若干字符图片打包成图集
+        @param glyphs [(字符, 白底黑字的图片)]
+        '''
+        glyphs = [(ch, img.convert('RGBA')) for ch, img in glyphs]
+
+        # 按高度从高到低排成若干行（shelf packing）
+        order = sorted(glyphs, key=lambda item: -item[1].size[1])
+        boxes, x, y, row_height = {}, 0, 0, 0
+        for ch, img in order:
+            width, height = img.size
+            if x + width > max_width and x > 0:
+                x, y, row_height = 0, y + row_height + padding, 0
+            boxes[ch] = (x, y, x + width, y + height)
+            x += width + padding
+            row_height = max(row_height, height)
+
+        atlas_width = max([box[2] for box in boxes.itervalues()] or [1])
+        atlas_height = max([box[3] for box in boxes.itervalues()] or [1])
+        atlas = Image.new('RGBA', (atlas_width, atlas_height), (255, 255, 255, 0))
+        for ch, img in glyphs:
+            img = img.copy()
+            img.putalpha(glyph_mask(img))
+            atlas.paste(img, boxes[ch][:2])
+        return cls(atlas, boxes, metrics)
+
+    @classmethod
+    def from_directory(cls, directory, characters=None):
+        '''由GeneratorCharacters生成的 <字符>.png 构造图集'''
+        if characters is None:
+            characters = [name[:-4] for name in os.listdir(directory)
+                          if name.endswith('.png') and len(name) == 5]
+        return cls.from_glyphs((ch, Image.open(os.path.join(directory, '%s.png' % ch)))
+                               for ch in characters)
+
+    def save(self, path, format='png'):
+        '''保存为 path.json 清单以及 path.png（或者 path.raw）图集
+        raw格式不压缩，可以用open(..., use_mmap=True)直接映射到内存。
+        '''
+        image_file = '%s.%s' % (path, format)
+        if format == 'raw':
+            with open(image_file, 'wb') as f:
+                f.write(self.image.tostring())
+        else:
+            self.image.save(image_file)
+        manifest = dict(image=os.path.basename(image_file), format=format,
+                        mode=self.image.mode, size=self.image.size,
+                        glyphs=self.boxes, metrics=self.metrics)
+        with open(path + '.json', 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+
+    @classmethod
+    def open(cls, manifest_path, use_mmap=False):
+        '''读取save保存的图集，图片在第一次使用时才载入'''
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        image_file = os.path.join(os.path.dirname(manifest_path), manifest['image'])
+        mode, size = str(manifest['mode']), tuple(manifest['size'])
+
+        def load():
+            if manifest['format'] != 'raw':
+                img = Image.open(image_file)
+                img.load()
+                return img
+            with open(image_file, 'rb') as f:
+                if use_mmap:
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                else:
+                    data = f.read()
+            return Image.frombuffer(mode, size, data, 'raw', mode, 0, 1)
+
+        boxes = dict((ch, tuple(box)) for ch, box in manifest['glyphs'].iteritems())
+        return cls(load, boxes, manifest.get('metrics'))
+
+    def text_width(self, text, overlap=1):
+        glyphs = self.glyphs
+        return sum(glyphs[ch].width for ch in text) - overlap * max(0, len(text) - 1)
+
+    def compose(self, text, img, origin=(0, 0), overlap=1):
+        '''把text画到img上，相邻的字符重叠overlap个像素
+        @return 画完之后的横坐标
+        '''
+        glyphs = self.glyphs
+        x, y = origin
+        if img.mode != 'RGBA':
+            for ch in text:
+                glyph = glyphs[ch]
+                img.paste(glyph.image, (x, y), glyph.image)
+                x += glyph.width - overlap
+            return x + overlap
+
+        # 模式相同时直接调用PIL的C接口，省掉Image.paste中的检查和转换，速度快一倍
+        img.load()
+        if img.readonly:
+            img._copy()
+        paste = img.im.paste
+        for ch in text:
+            glyph = glyphs[ch]
+            core = glyph.image.im
+            paste(core, (x, y, x + glyph.width, y + glyph.height), core)
+            x += glyph.width - overlap
+        return x + overlap
+
+    def canvas(self, size, background=(255, 255, 255, 255)):
+        '''一张新的空白RGBA图片。空白图会被缓存，复制比Image.new快一倍'''
+        blank = self._blanks.get((size, background))
+        if blank is None:
+            blank = self._blanks[(size, background)] = Image.new('RGBA', size, background)
+        return blank.copy()
+
+    def render(self, text, background=(255, 255, 255, 255), padding=(0, 0), overlap=1):
+        '''生成一张刚好放下text的新图片'''
+        height = max(self.glyphs[ch].height for ch in text)
+        width = self.text_width(text, overlap)
+        img = self.canvas((width + 2 * padding[0], height + 2 * padding[1]), background)
+        self.compose(text, img, padding, overlap)
+        return img
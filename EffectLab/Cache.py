@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author:  Hua Liang [ Stupid ET ]
+# email:   et@everet.org
+# website: http://EverET.org
+#
+# 特效结果的缓存
+#
+# 以 (输入图片的摘要, 特效的fingerprint) 为key保存输出的图片，同样的图片经过
+# 同样参数的特效时直接返回保存的结果。可以放在内存中，也可以放在磁盘上，
+# 都按占用的字节数做LRU淘汰。
+#
+#   glue.cache = MemoryCache(512 * 1024 * 1024)
+#   glue(img)       # 计算并缓存
+#   glue(img)       # 直接取出
+#
+# 缓存设置在EffectGlue上时，整条流水线的结果作为一项缓存；也可以设置在单个特效上。
+# GlobalWaveEffect需要指定seed，否则每个实例的参数都不同，很难命中。
+
+import os, zlib, hashlib, threading, tempfile, collections
+import Image
+
+
+def image_digest(img):
+    '''图片内容的摘要'''
+    digest = hashlib.sha1('%s %d %d ' % ((img.mode, ) + img.size))
+    digest.update(img.tostring())
+    return digest.hexdigest()
+
+
+class ResultCache(object):
+    '''结果缓存的基类，负责key的计算和LRU淘汰
+    子类实现load(key)、save(key, img)（返回占用的字节数）和discard(key)。
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # key => 占用的字节数，按最近使用的顺序排列
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # 参数无法描述、不能缓存的调用次数
+        self.bypassed = 0
+
+    def key(self, effect, img):
+        '''缓存的key，特效不能缓存时为None'''
+        fingerprint = effect.fingerprint()
+        if fingerprint is None:
+            return None
+        return hashlib.sha1(fingerprint + image_digest(img)).hexdigest()
+
+    def call(self, effect, img):
+        '''effect(img)，有缓存的话直接返回缓存的结果'''
+        key = self.key(effect, img)
+        if key is None:
+            with self.lock:
+                self.bypassed += 1
+            return effect.invoke(img)
+
+        with self.lock:
+            known = key in self.entries
+            if known:
+                self.entries[key] = self.entries.pop(key)
+        out = self.load(key) if known else None
+        if out is not None:
+            with self.lock:
+                self.hits += 1
+            return out
+
+        out = effect.invoke(img)
+        size = self.save(key, out)
+        with self.lock:
+            self.misses += 1
+            self.nbytes += size - self.entries.pop(key, 0)
+            self.entries[key] = size
+            evicted = []
+            while self.nbytes > self.max_bytes and len(self.entries) > 1:
+                old, old_size = self.entries.popitem(last=False)
+                self.nbytes -= old_size
+                self.evictions += 1
+                evicted.append(old)
+        for old in evicted:
+            self.discard(old)
+        return out
+
+    def clear(self):
+        with self.lock:
+            keys = list(self.entries)
+            self.entries.clear()
+            self.nbytes = 0
+        for key in keys:
+            self.discard(key)
+
+    def info(self):
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                    bypassed=self.bypassed, size=len(self.entries),
+                    nbytes=self.nbytes, max_bytes=self.max_bytes)
+
+
+class MemoryCache(ResultCache):
+    '''放在内存中的结果缓存
+    有的特效会直接修改输入的图片，所以存入和取出的都是副本。
+    '''
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        super(MemoryCache, self).__init__(max_bytes)
+        self.images = {}
+
+    def load(self, key):
+        img = self.images.get(key)
+        return img.copy() if img is not None else None
+
+    def save(self, key, img):
+        self.images[key] = img.copy()
+        width, height = img.size
+        return width * height * Image.getmodebands(img.mode)
+
+    def discard(self, key):
+        self.images.pop(key, None)
+
+
+class DiskCache(ResultCache):
+    '''放在磁盘上的结果缓存，每个结果一个文件，可以在多次运行之间共用
+    文件的修改时间就是最近一次使用的时间，重新打开时按它恢复LRU的顺序。
+    '''
+    suffix = '.effect'
+
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024, compress=1):
+        '''
+        @param compress zlib的压缩级别，0表示不压缩
+        '''
+        super(DiskCache, self).__init__(max_bytes)
+        self.directory = directory
+        self.compress = compress
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        entries = []
+        for filename in os.listdir(directory):
+            if filename.endswith(self.suffix):
+                st = os.stat(os.path.join(directory, filename))
+                entries.append((st.st_mtime, filename[:-len(self.suffix)], st.st_size))
+        for mtime, key, size in sorted(entries):
+            self.entries[key] = size
+            self.nbytes += size
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def load(self, key):
+        try:
+            with open(self.path(key), 'rb') as f:
+                data = f.read()
+            os.utime(self.path(key), None)
+        except (IOError, OSError):
+            # 可能被其他进程删掉了
+            return None
+
+        header, data = data.split('\n', 1)
+        mode, width, height, compressed = header.split()
+        if int(compressed):
+            data = zlib.decompress(data)
+        return Image.fromstring(mode, (int(width), int(height)), data)
+
+    def save(self, key, img):
+        data = img.tostring()
+        if self.compress:
+            data = zlib.compress(data, self.compress)
+        header = '%s %d %d %d\n' % (img.mode, img.size[0], img.size[1], int(bool(self.compress)))
+
+        # 先写到临时文件再改名，其他进程不会读到写了一半的文件
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header)
+            f.write(data)
+        os.rename(tmp, self.path(key))
+        return len(header) + len(data)
+
+    def discard(self, key):
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
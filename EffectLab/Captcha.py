@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author:  Hua Liang [ Stupid ET ]
+# email:   et@everet.org
+# website: http://EverET.org
+#
+# 验证码生成服务
+#
+# 与TestEffectLab.main相同的流程：从图集中随机取字符拼到画布上，加上波浪特效，编码成JPEG。
+# 生成一张验证码要几毫秒到几十毫秒，请求到来时再生成太慢。
+# 这里预先生成一池 (文字, 图片数据)，请求直接从池中取走一张，不做任何计算。
+# 池中的数量低于水位线时，后台的进程池一批一批地补充，直到补满。
+#
+#   generator = CaptchaGenerator(GlyphAtlas.open('Images/atlas.json'))
+#   pool = CaptchaPool(generator, depth=512, workers=4)
+#   text, data = pool.get()
+#   print pool.stats()
+#   pool.close()
+#
+# 也可以直接运行，在本地起一个HTTP服务：
+#
+#   python -m EffectLab.Captcha --atlas Images/atlas.json --port 8000
+#   GET /captcha  图片，答案在 X-Captcha-Text 头中
+#   GET /stats    JSON格式的计数器
+
+import os, time, json, logging, random, string, threading, collections, multiprocessing, Queue
+import SocketServer, BaseHTTPServer
+
+from Effect import GlobalWaveEffect
+from Atlas import GlyphAtlas
+from Encoder import Encoder
+from Instrument import Histogram
+
+
+CONTENT_TYPES = {'JPEG': 'image/jpeg', 'PNG': 'image/png', 'WEBP': 'image/webp'}
+
+
+class CaptchaGenerator(object):
+    '''生成一张验证码
+    @param atlas GlyphAtlas
+    @param effects 依次应用的特效，默认与TestEffectLab相同，一个GlobalWaveEffect
+    @param randomize 为True时每张验证码的波浪都不一样：有filter_random的特效（GlobalWaveEffect）
+                     用它渲染，只用一次的mesh不进入缓存；其他特效在每张图之前调用randomize()
+    '''
+    def __init__(self, atlas, size=(100, 40), length=5, characters=None, origin=(15, 0),
+                 effects=None, randomize=True, format='JPEG', quality=90):
+        self.atlas = atlas
+        self.size = size
+        self.length = length
+        self.characters = characters or string.letters + string.digits
+        self.origin = origin
+        self.effects = effects if effects is not None else [GlobalWaveEffect(1, 0.5)]
+        self.randomize = randomize
+        self.encoder = Encoder(format, quality=quality)
+        # 答案不能被猜到，使用操作系统的随机数
+        self.rng = random.SystemRandom()
+
+    def text(self):
+        choice = self.rng.choice
+        return ''.join(choice(self.characters) for i in xrange(self.length))
+
+    def render(self, text):
+        img = self.atlas.canvas(self.size)
+        self.atlas.compose(text, img, self.origin)
+        for effect in self.effects:
+            if self.randomize and hasattr(effect, 'filter_random'):
+                img = next(effect.filter_random([img]))[0]
+            else:
+                if self.randomize and hasattr(effect, 'randomize'):
+                    effect.randomize()
+                img = effect(img)
+        return img
+
+    def __call__(self):
+        '''@return (文字, 编码后的图片数据)'''
+        text = self.text()
+        return text, self.encoder.encode(self.render(text))
+
+    @property
+    def content_type(self):
+        return CONTENT_TYPES.get(self.encoder.format, 'application/octet-stream')
+
+
+# 子进程中的生成器，由进程池的initializer设置。进程池是fork出来的，生成器直接继承。
+_worker = {}
+
+
+def _init_worker(generator):
+    # fork出来的进程继承了同一个随机数状态，不重新设置的话各个进程的波浪完全相同
+    random.seed()
+    _worker['generator'] = generator
+
+
+def render_batch(generator, count):
+    '''生成count张验证码
+    出错时只返回已经生成的部分，池根据请求的张数与实际的张数记录错误
+    @return ([(文字, 图片数据)], 耗时, count)
+    '''
+    start = time.time()
+    items = []
+    try:
+        for i in xrange(count):
+            items.append(generator())
+    except Exception:
+        logging.getLogger('EffectLab.Captcha').exception('captcha generation failed')
+    return items, time.time() - start, count
+
+
+def _render_batch(count):
+    return render_batch(_worker['generator'], count)
+
+
+class CaptchaPool(object):
+    '''预先生成的验证码池
+
+    get()从池中取出一张，池中有存货时只是一次deque.popleft。
+    池中的数量（加上正在生成的）低于low_water时，补充线程向进程池提交若干批任务，直到补满depth张。
+    '''
+    # 生成出错之后，等待这么多秒再补充，避免一直重试
+    error_delay = 1.0
+
+    def __init__(self, generator, depth=256, workers=None, low_water=0.5, batch=16):
+        '''
+        @param generator 返回 (文字, 图片数据) 的函数，通常是CaptchaGenerator
+        @param depth 池的容量
+        @param workers 生成验证码的进程数，默认为CPU核数；为0时在补充线程中生成
+        @param low_water 水位线，可以是张数，也可以是小于1的比例
+        @param batch 每个任务生成的张数，越大进程间通信越少，但补充得不那么及时
+        '''
+        if depth < 1:
+            raise ValueError('depth must be at least 1')
+        self.generator = generator
+        self.depth = depth
+        self.low_water = int(low_water * depth) if low_water < 1 else int(low_water)
+        self.batch = max(1, min(batch, depth))
+        self.workers = multiprocessing.cpu_count() if workers is None else workers
+
+        self.items = collections.deque()
+        self.pending = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        self.counters = collections.Counter()
+        self.latency = Histogram()
+        self.generate_time = 0.0
+        self.retry_at = 0
+        self.started = time.time()
+
+        self.pool = None
+        if self.workers:
+            self.pool = multiprocessing.Pool(self.workers, _init_worker, (generator,))
+        self.refiller = threading.Thread(target=self._refill)
+        self.refiller.daemon = True
+        self.refiller.start()
+
+    def _refill(self):
+        while True:
+            with self.cond:
+                while not self.closed:
+                    if len(self.items) + self.pending > self.low_water:
+                        self.cond.wait()
+                    elif time.time() < self.retry_at:
+                        self.cond.wait(self.retry_at - time.time())
+                    else:
+                        break
+                if self.closed:
+                    return
+                need = self.depth - len(self.items) - self.pending
+                batches = [min(self.batch, need - i) for i in xrange(0, need, self.batch)]
+                self.pending += need
+                self.counters['refills'] += 1
+
+            for count in batches:
+                if self.pool is not None:
+                    self.pool.apply_async(_render_batch, (count,), callback=self._add)
+                else:
+                    self._add(render_batch(self.generator, count))
+
+    def _add(self, result):
+        items, elapsed, requested = result
+        with self.cond:
+            self.pending -= requested
+            if len(items) < requested:
+                self.counters['errors'] += requested - len(items)
+                self.retry_at = time.time() + self.error_delay
+            if self.closed:
+                return
+            self.items.extend(items)
+            self.counters['generated'] += len(items)
+            self.generate_time += elapsed
+            self.cond.notify_all()
+
+    def get(self, timeout=None):
+        '''取出一张验证码，池空了就等待补充
+        @return (文字, 图片数据)
+        @raise Queue.Empty 等待超过timeout秒
+        '''
+        start = time.time()
+        with self.cond:
+            if not self.items:
+                self.counters['misses'] += 1
+                deadline = None if timeout is None else start + timeout
+                while not self.items and not self.closed:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        self.counters['timeouts'] += 1
+                        raise Queue.Empty
+                    self.cond.wait(remaining)
+                if not self.items:
+                    raise ValueError('pool is closed')
+            item = self.items.popleft()
+            self.counters['served'] += 1
+            if len(self.items) + self.pending <= self.low_water:
+                self.cond.notify_all()
+            self.latency.add(time.time() - start)
+        return item
+
+    def wait_full(self, timeout=None):
+        '''等待池第一次补满，启动服务之前调用可以避免开始的请求等待'''
+        deadline = None if timeout is None else time.time() + timeout
+        with self.cond:
+            while len(self.items) < self.depth and not self.closed:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    def stats(self):
+        '''计数器：取出、生成的张数，池空的次数，生成速度，以及取出时等待时间的直方图'''
+        with self.cond:
+            uptime = time.time() - self.started
+            generated = self.counters['generated']
+            return dict(self.counters,
+                        available=len(self.items), pending=self.pending,
+                        depth=self.depth, low_water=self.low_water, workers=self.workers,
+                        uptime=uptime,
+                        served_per_second=self.counters['served'] / uptime if uptime else 0,
+                        generated_per_second=generated / uptime if uptime else 0,
+                        ms_per_captcha=self.generate_time / generated * 1000 if generated else 0,
+                        latency_us=self.latency.items())
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.refiller.join()
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+
+
+class CaptchaHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if path == '/captcha':
+            try:
+                text, data = self.server.pool.get(self.server.timeout)
+            except Queue.Empty:
+                return self.send_error(503, 'captcha pool is empty')
+            self.reply(data, self.server.content_type, {'X-Captcha-Text': text})
+        elif path == '/stats':
+            self.reply(json.dumps(self.server.pool.stats(), sort_keys=True), 'application/json')
+        else:
+            self.send_error(404)
+
+    def reply(self, data, content_type, headers={}):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Cache-Control', 'no-store')
+        for name, value in headers.iteritems():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CaptchaServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''用CaptchaPool应答的HTTP服务，每个请求一个线程'''
+    daemon_threads = True
+
+    def __init__(self, pool, address=('127.0.0.1', 8000), timeout=1.0,
+                 content_type='image/jpeg'):
+        '''@param timeout 池空时请求最多等待的秒数，超时返回503'''
+        BaseHTTPServer.HTTPServer.__init__(self, address, CaptchaHandler)
+        self.pool = pool
+        self.timeout = timeout
+        self.content_type = content_type
+
+
+def main():
+    import optparse
+    parser = optparse.OptionParser()
+    parser.add_option('--atlas', default=os.path.join('Images', 'atlas.json'),
+                      help='manifest written by Tools/GeneratorCharacters.py')
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--port', type='int', default=8000)
+    parser.add_option('--depth', type='int', default=256)
+    parser.add_option('--workers', type='int', help='default one per CPU')
+    parser.add_option('--low-water', type='float', default=0.5,
+                      help='refill below this many captchas, or this fraction of depth')
+    parser.add_option('--batch', type='int', default=16)
+    parser.add_option('--format', default='JPEG')
+    options, args = parser.parse_args()
+
+    generator = CaptchaGenerator(GlyphAtlas.open(options.atlas), format=options.format)
+    pool = CaptchaPool(generator, options.depth, options.workers,
+                       options.low_water, options.batch)
+    pool.wait_full()
+    server = CaptchaServer(pool, (options.host, options.port),
+                           content_type=generator.content_type)
+    print 'serving on http://%s:%d/captcha' % server.server_address
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -11,16 +11,711 @@
 import random, string, time
 import Image, ImageDraw, ImageFont, ImageChops, ImageFilter
 import StringIO
-import math, operator
-from math import sqrt, sin, cos, atan2
+import math, logging, collections, copy, hashlib, types, threading, inspect
+from math import sqrt, atan2
+from Formula import Formula, as_formula, polar_coords, float32_list
 
 VERSION = "1.0.1"
 
-# 尝试加载C语言实现的部分
+logger = logging.getLogger(__name__)
+
+# 尝试加载C语言实现的部分，用 python setup.py build_ext --inplace 编译
 try:
     import EffectLabCore as core
-except:
-    pass
+except ImportError:
+    core = None
+
+# NumPy是可选的，有的话可以整张图一起算
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# WarpEffect的计算后端，按速度从快到慢排列
+#   core   C语言实现，计算时释放GIL（映射表由NumPy生成，所以也需要NumPy）
+#   numpy  NumPy实现
+#   python 纯Python实现，逐像素计算
+BACKENDS = ('core', 'numpy', 'python')
+
+# 全局默认后端，None表示自动选择可用的最快后端
+default_backend = None
+
+# WarpEffect的取样方式
+#   nearest  每个像素取antialias ** 2个子采样点，各取最近的像素求平均
+#   bilinear, bicubic, lanczos  每个像素只取一个采样点，按插值核对周围像素加权
+INTERPOLATIONS = ('nearest', 'bilinear', 'bicubic', 'lanczos')
+
+# 各插值核在每个方向上用到的像素个数
+KERNEL_TAPS = {'bilinear': 2, 'bicubic': 4, 'lanczos': 6}
+
+# 插值权重用定点数表示，1.0对应WEIGHT_ONE。两个方向的权重相乘后右移2 * WEIGHT_BITS位
+WEIGHT_BITS = 12
+WEIGHT_ONE = 1 << WEIGHT_BITS
+
+
+def available_backends():
+    '''当前环境中可以使用的后端'''
+    backends = []
+    if core is not None and numpy is not None:
+        backends.append('core')
+    if numpy is not None:
+        backends.append('numpy')
+    backends.append('python')
+    return backends
+
+
+def set_backend(name):
+    '''设置全局默认后端，None表示自动选择'''
+    global default_backend
+    if name is not None:
+        check_backend(name)
+    default_backend = name
+
+
+def check_backend(name):
+    if name not in BACKENDS:
+        raise ValueError('unknown backend %r, expected one of %s' % (name, BACKENDS))
+    if name not in available_backends():
+        raise ValueError('backend %r is not available' % name)
+    return name
+
+
+def image_to_array(img):
+    '''把Image转成 height x width x bands 的uint8数组'''
+    width, height = img.size
+    return numpy.asarray(img).reshape(height, width, -1)
+
+
+def array_to_image(arr, mode=None):
+    '''image_to_array的逆操作，mode默认按通道数推断'''
+    if mode is None:
+        mode = {1: 'L', 3: 'RGB', 4: 'RGBA'}[arr.shape[2]]
+    if arr.shape[2] == 1:
+        arr = arr[:, :, 0]
+    return Image.fromarray(numpy.ascontiguousarray(arr, numpy.uint8), mode)
+
+
+def output_target(img, out, inplace):
+    '''filter的out、inplace参数 => 结果要写入的Image，None表示返回一张新的Image'''
+    if inplace:
+        if out is not None and out is not img:
+            raise ValueError('pass either out or inplace=True, not both')
+        return img
+    return out
+
+
+def check_target(target, mode, size):
+    '''检查target能否放下模式为mode、尺寸为size的结果，并保证可以写入'''
+    if target.mode != mode or target.size != size:
+        raise ValueError('output is %s %r, the result is %s %r'
+                         % (target.mode, target.size, mode, size))
+    target.load()
+    if target.readonly:
+        target._copy()
+
+
+def deliver(result, target):
+    '''把result交给调用者：target为None时result就是结果，否则把result写进target'''
+    if target is None or result is target:
+        return result
+    check_target(target, result.mode, result.size)
+    target.paste(result, (0, 0) + result.size)
+    return target
+
+
+def deliver_array(arr, mode, target):
+    '''同deliver，result是image_to_array格式的数组，直接解码到target的内存中'''
+    if target is None:
+        return array_to_image(arr, mode)
+    height, width = arr.shape[:2]
+    check_target(target, mode, (width, height))
+    target.fromstring(numpy.ascontiguousarray(arr))
+    return target
+
+
+# 类 => 它的filter是否接受out、inplace参数
+_filter_takes_output = {}
+
+def filter_takes_output(effect):
+    '''effect的filter是否接受out、inplace参数，只实现了filter(img)的老式子类不接受'''
+    cls = effect.__class__
+    takes = _filter_takes_output.get(cls)
+    if takes is None:
+        try:
+            args, varargs, keywords, defaults = inspect.getargspec(cls.filter)
+            takes = varargs is not None or keywords is not None or (
+                'out' in args and 'inplace' in args)
+        except TypeError:
+            takes = False
+        _filter_takes_output[cls] = takes
+    return takes
+
+
+def copy_to(img, target):
+    '''把img拷到target中，target为None时拷贝一张新的，用于直接在图片上绘制的特效'''
+    if target is None:
+        return img.copy()
+    return deliver(img, target)
+
+
+def transform_mesh(img, mesh, resample, target=None):
+    '''同img.transform(img.size, Image.MESH, mesh, resample)，
+    target不为None时直接画到target上，不分配新的图片。target不能是img本身。
+    '''
+    if target is None:
+        return img.transform(img.size, Image.MESH, mesh, resample)
+    check_target(target, img.mode, img.size)
+    # Image.transform就是新建一张图片，再对每一格调用这个方法
+    transformer = getattr(target, '_Image__transformer', None)
+    if transformer is None:
+        return deliver(img.transform(img.size, Image.MESH, mesh, resample), target)
+    for box, quad in mesh:
+        transformer(box, img, Image.QUAD, quad, resample)
+    return target
+
+
+def fill_color(mode, color):
+    '''把empty_color裁剪成与mode的通道数一致'''
+    nband = Image.getmodebands(mode)
+    return tuple(color[:nband]) if nband > 1 else color[0]
+
+
+def check_interpolation(name):
+    if name not in INTERPOLATIONS:
+        raise ValueError('unknown interpolation %r, expected one of %s' % (name, INTERPOLATIONS))
+    return name
+
+
+def is_array(x):
+    return numpy is not None and isinstance(x, numpy.ndarray)
+
+
+def round_half_away(t):
+    '''与Python 2内建的round一致：0.5向远离0的方向舍入。
+    numpy.round是银行家舍入，会导致和标量版本的结果不一致。
+    '''
+    a = numpy.abs(t)
+    f = numpy.floor(a)
+    f += (a - f) >= 0.5
+    return numpy.copysign(f, t)
+
+
+def subsample_grid(box, antialias):
+    '''生成box内所有抗锯齿子采样点的像素坐标，形状均为 (antialias ** 2, height, width)
+    子采样点的顺序与标量版本的 ai, aj 循环一致。
+    '''
+    left, top, right, bottom = box
+    width, height = right - left, bottom - top
+    offsets = numpy.arange(antialias) / float(antialias)
+    xs = numpy.arange(left, right, dtype=float)[None, :] + offsets[:, None]
+    ys = numpy.arange(top, bottom, dtype=float)[None, :] + offsets[:, None]
+    shape = (antialias, antialias, height, width)
+    xs = numpy.broadcast_to(xs[:, None, None, :], shape)
+    ys = numpy.broadcast_to(ys[None, :, :, None], shape)
+    n = antialias * antialias
+    return xs.reshape(n, height, width), ys.reshape(n, height, width)
+
+
+def kernel_weight(kind, d):
+    '''插值核在距离d处的权重，d可以是标量，也可以是numpy数组'''
+    m = numpy if is_array(d) else math
+    where = numpy.where if m is numpy else lambda c, a, b: a if c else b
+    d = abs(d)
+    if kind == 'bilinear':
+        return where(d < 1, 1 - d, 0.0)
+    if kind == 'bicubic':
+        # Keys三次卷积核，a = -0.5
+        a = -0.5
+        near = ((a + 2) * d - (a + 3)) * d * d + 1
+        far = ((a * d - 5 * a) * d + 8 * a) * d - 4 * a
+        return where(d <= 1, near, where(d < 2, far, 0.0))
+    # lanczos3: sinc(d) * sinc(d / 3)
+    pd = where(d == 0, 1.0, math.pi * d)
+    w = 3 * m.sin(pd) * m.sin(pd / 3) / (pd * pd)
+    return where(d == 0, 1.0, where(d < 3, w, 0.0))
+
+
+def axis_taps(kind, u, size):
+    '''一个方向上的插值：坐标u处的值由哪些像素、以多大的权重组成
+    返回 ([下标], [权重])，越界的下标夹到边上的像素，权重是定点数（见WEIGHT_ONE）。
+    u可以是标量，也可以是numpy数组。
+    '''
+    taps = KERNEL_TAPS[kind]
+    if is_array(u):
+        base = numpy.floor(u) - (taps // 2 - 1)
+        ibase = base.astype(numpy.int32)
+        indices = [numpy.clip(ibase + k, 0, size - 1) for k in xrange(taps)]
+    else:
+        base = int(math.floor(u)) - (taps // 2 - 1)
+        indices = [min(max(base + k, 0), size - 1) for k in xrange(taps)]
+    if kind == 'bilinear':
+        # 两个采样点的距离都不超过1，不需要kernel_weight中的判断，结果相同
+        weights = [1 - abs(u - (base + k)) for k in xrange(taps)]
+    else:
+        weights = [kernel_weight(kind, u - (base + k)) for k in xrange(taps)]
+    if kind == 'lanczos':
+        # lanczos核的权重之和不为1，需要归一化
+        total = sum(weights)
+        weights = [w / total for w in weights]
+    if is_array(u):
+        weights = [numpy.floor(w * WEIGHT_ONE + 0.5).astype(numpy.int16) for w in weights]
+    else:
+        weights = [int(math.floor(w * WEIGHT_ONE + 0.5)) for w in weights]
+    return indices, weights
+
+
+def weighted_pixel(t):
+    '''把两次定点数加权的累加结果还原成0到255之间的像素值'''
+    t = t + (1 << (2 * WEIGHT_BITS - 1))
+    if is_array(t):
+        return numpy.clip(numpy.maximum(t, 0) >> (2 * WEIGHT_BITS), 0, 255)
+    return min(max(t, 0) >> (2 * WEIGHT_BITS), 255)
+
+
+def batches(images, batch_size):
+    '''把连续的、尺寸和模式都相同的图片分成一组，每组最多batch_size张'''
+    group = []
+    for img in images:
+        if group and (len(group) >= batch_size or
+                      (img.size, img.mode) != (group[0].size, group[0].mode)):
+            yield group
+            group = []
+        group.append(img)
+    if group:
+        yield group
+
+
+class PixelBuffer(object):
+    '''图片像素的可写缓冲区，纯Python后端用它代替getpixel/putpixel
+    像素按行连续存放在bytearray中，(x, y)的第b个通道是 data[(y * width + x) * nband + b]。
+    getpixel/putpixel每次都要经过一次带边界检查的Python到C的调用，
+    直接读写bytearray要快得多，而且L模式也不需要特殊处理。
+    '''
+    def __init__(self, mode, size, data):
+        self.mode = mode
+        self.size = size
+        self.nband = Image.getmodebands(mode)
+        self.data = data
+
+    @classmethod
+    def from_image(cls, img):
+        return cls(img.mode, img.size, bytearray(img.tostring()))
+
+    @classmethod
+    def blank(cls, mode, size, color):
+        '''填充为color的缓冲区'''
+        color = fill_color(mode, color)
+        pixel = bytearray(color if isinstance(color, tuple) else (color, ))
+        return cls(mode, size, pixel * (size[0] * size[1]))
+
+    def copy(self):
+        return PixelBuffer(self.mode, self.size, bytearray(self.data))
+
+    def image(self, target=None):
+        '''转换成Image，给出target时写入target'''
+        if target is None:
+            return Image.fromstring(self.mode, self.size, str(self.data))
+        check_target(target, self.mode, self.size)
+        target.fromstring(buffer(self.data))
+        return target
+
+    def rows(self, box):
+        '''box中每一行在data中的切片'''
+        left, top, right, bottom = box
+        stride = self.size[0] * self.nband
+        for y in xrange(top, bottom):
+            yield slice(y * stride + left * self.nband, y * stride + right * self.nband)
+
+    def crop(self, box):
+        size = (box[2] - box[0], box[3] - box[1])
+        return Image.fromstring(self.mode, size,
+                                ''.join(str(self.data[row]) for row in self.rows(box)))
+
+    def paste(self, other, box):
+        '''把同样尺寸的other中box内的像素拷贝过来'''
+        for row in self.rows(box):
+            self.data[row] = other.data[row]
+
+
+class RemapTable(object):
+    '''预先算好的坐标映射表
+    对于box中的每个像素，记录其所有子采样点在源图中的下标（-1表示落在图外），
+    以及有效采样点的个数。之后每次处理同样尺寸的图只需要取样求平均即可。
+    '''
+    def __init__(self, box, index, found):
+        self.box = box
+        self.index = index
+        self.found = found
+
+    @classmethod
+    def from_coords(cls, box, us, vs, width, height):
+        '''由源图坐标（浮点数，NaN表示无效）生成映射表'''
+        with numpy.errstate(invalid='ignore'):
+            us = round_half_away(us)
+            vs = round_half_away(vs)
+            valid = (us >= 0) & (us < width) & (vs >= 0) & (vs < height)
+            index = numpy.where(valid, vs * width + us, -1).astype(numpy.int32)
+        n = len(index)
+        found = valid.reshape(n, -1).sum(axis=0).astype(numpy.int32)
+        return cls(box, index.reshape(n, -1), found)
+
+    @property
+    def nbytes(self):
+        return self.index.nbytes + self.found.nbytes
+
+    def apply(self, src, out, rows=None):
+        '''从src中取样，把box内的结果写到out中
+        没有有效采样点的像素保持out中原来的值。
+        @param rows (top, bottom)，只处理这些行，None表示整个box
+        '''
+        height, width, nband = src.shape[-3:]
+        left, top, right, bottom = self.box
+        if rows is not None:
+            top, bottom = max(top, rows[0]), min(bottom, rows[1])
+            if top >= bottom:
+                return out
+        boxwidth = right - left
+        first = (top - self.box[1]) * boxwidth
+        last = (bottom - self.box[1]) * boxwidth
+
+        # src和out也可以是 n x height x width x bands 的一批图片
+        src = src.reshape(-1, height * width, nband)
+        n = len(src)
+
+        psum = numpy.zeros((n, last - first, nband), numpy.int32)
+        if (last - first) * 2 < height * width:
+            # 只处理一小块区域时不复制整张src：下标-1（落在图外）先当作第0个像素累加，
+            # 最后再减掉，这样开销只与区域大小有关
+            for sample_index in self.index[:, first:last]:
+                psum += src[:, numpy.maximum(sample_index, 0)]
+            missing = len(self.index) - self.found[first:last]
+            psum -= missing[None, :, None] * src[:, :1].astype(numpy.int32)
+        else:
+            # 在最后补一个0像素，下标-1正好取到它
+            flat = numpy.empty((n, height * width + 1, nband), numpy.uint8)
+            flat[:, :-1] = src
+            flat[:, -1] = 0
+            for sample_index in self.index[:, first:last]:
+                psum += flat[:, sample_index]
+
+        found = self.found[first:last]
+        hit = found > 0
+        region = out[..., top:bottom, left:right, :]
+        shape = region.shape
+        region = region.reshape(n, -1, nband)
+        region[:, hit] = psum[:, hit] // found[hit, None]
+        out[..., top:bottom, left:right, :] = region.reshape(shape)
+        return out
+
+
+class InterpolatedRemapTable(object):
+    '''按插值核加权取样的映射表
+    插值核是可分离的，所以只需分别记录两个方向上的像素下标和权重：
+    out = sum_j wy[j] * sum_i wx[i] * src[y[j], x[i]]
+    每个像素的各个采样点连续存放（npixels x taps），权重是int16的定点数，
+    所以三种后端可以用整数运算得到完全相同的结果。
+    found为1表示该像素有效，0表示采样点落在图外，保持out中原来的值。
+    '''
+    # apply每次处理的像素个数，让中间结果留在缓存里
+    chunk = 16384
+
+    def __init__(self, box, xindex, xweight, yoffset, yweight, found):
+        self.box = box
+        self.xindex = xindex
+        self.xweight = xweight
+        # y方向直接记录行首在源图中的下标，即 y * width
+        self.yoffset = yoffset
+        self.yweight = yweight
+        self.found = found
+
+    @classmethod
+    def from_coords(cls, kind, box, us, vs, width, height):
+        '''由源图坐标（每个像素一个，NaN表示无效）生成映射表'''
+        us, vs = us.ravel(), vs.ravel()
+        with numpy.errstate(invalid='ignore'):
+            # 与最近邻取样的有效范围一致
+            valid = (us > -0.5) & (us < width - 0.5) & (vs > -0.5) & (vs < height - 0.5)
+        us = numpy.where(valid, us, 0)
+        vs = numpy.where(valid, vs, 0)
+        xindex, xweight = axis_taps(kind, us, width)
+        yindex, yweight = axis_taps(kind, vs, height)
+        return cls(box,
+                   numpy.column_stack(xindex), numpy.column_stack(xweight),
+                   numpy.column_stack(yindex) * numpy.int32(width),
+                   numpy.column_stack(yweight), valid.astype(numpy.int32))
+
+    @property
+    def nbytes(self):
+        return (self.xindex.nbytes + self.xweight.nbytes + self.yoffset.nbytes +
+                self.yweight.nbytes + self.found.nbytes)
+
+    def apply(self, src, out, rows=None):
+        '''参数与RemapTable.apply相同'''
+        height, width, nband = src.shape[-3:]
+        left, top, right, bottom = self.box
+        if rows is not None:
+            top, bottom = max(top, rows[0]), min(bottom, rows[1])
+            if top >= bottom:
+                return out
+        boxwidth = right - left
+        first = (top - self.box[1]) * boxwidth
+        last = (bottom - self.box[1]) * boxwidth
+
+        src = src.reshape(-1, height * width, nband)
+        n = len(src)
+        region = out[..., top:bottom, left:right, :]
+        shape = region.shape
+        region = region.reshape(n, -1, nband)
+
+        for start in xrange(first, last, self.chunk):
+            stop = min(start + self.chunk, last)
+            xindex = self.xindex[start:stop]
+            xweight = self.xweight[start:stop].astype(numpy.int32)
+            yoffset = self.yoffset[start:stop]
+            yweight = self.yweight[start:stop].astype(numpy.int64)
+            psum = numpy.zeros((n, stop - start, nband), numpy.int64)
+            for j in xrange(yoffset.shape[1]):
+                rsum = numpy.zeros((n, stop - start, nband), numpy.int32)
+                for i in xrange(xindex.shape[1]):
+                    rsum += xweight[:, i, None] * src[:, yoffset[:, j] + xindex[:, i]]
+                psum += yweight[:, j, None] * rsum
+
+            hit = self.found[start:stop] > 0
+            region[:, start - first + hit.nonzero()[0]] = weighted_pixel(psum[:, hit])
+
+        out[..., top:bottom, left:right, :] = region.reshape(shape)
+        return out
+
+
+class RemapCache(object):
+    '''映射表的LRU缓存，按占用的字节数限制大小
+    可以在多个线程中同时使用（Pipeline的计算线程）。生成映射表时不持有锁，
+    两个线程同时生成同一项时，先放进缓存的那个会被后一个替换掉。
+    '''
+    def __init__(self, max_bytes=256 * 1024 * 1024, sizeof=lambda table: table.nbytes):
+        '''@param sizeof 估计缓存中一项所占的字节数'''
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.tables = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, build):
+        '''取出key对应的映射表，没有的话调用build()生成并缓存起来'''
+        with self.lock:
+            table = self.tables.pop(key, None)
+            if table is not None:
+                self.hits += 1
+                self.tables[key] = table
+                return table
+            self.misses += 1
+
+        table = build()
+        size = self.sizeof(table)
+        with self.lock:
+            old = self.tables.pop(key, None)
+            if old is not None:
+                self.nbytes -= self.sizeof(old)
+            self.tables[key] = table
+            self.nbytes += size
+            while self.nbytes > self.max_bytes and len(self.tables) > 1:
+                _, old = self.tables.popitem(last=False)
+                self.nbytes -= self.sizeof(old)
+                self.evictions += 1
+        return table
+
+    def clear(self):
+        with self.lock:
+            self.tables.clear()
+            self.nbytes = 0
+
+    def info(self):
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                        size=len(self.tables), nbytes=self.nbytes,
+                        max_bytes=self.max_bytes)
+
+
+# 所有WarpEffect共用的映射表缓存
+remap_cache = RemapCache()
+
+# 径向特效共用的极坐标网格，见polar_grid
+polar_cache = RemapCache(128 * 1024 * 1024, sizeof=lambda grid: grid[0].nbytes + grid[1].nbytes)
+
+# PerspectiveWarpEffect的单应矩阵
+homography_cache = RemapCache(1024 * 1024, sizeof=lambda matrix: 200)
+
+# GlobalWaveEffect的mesh缓存，每个网格大约占400字节
+mesh_cache = RemapCache(32 * 1024 * 1024, sizeof=lambda mesh: len(mesh) * 400)
+
+# EffectGlue按阶段统计性能时代表缓冲区中的一帧，这一帧没有分配新的图片
+Frame = collections.namedtuple('Frame', 'mode size')
+
+# Effect.progressive产生的一帧
+Preview = collections.namedtuple('Preview', 'image scale final')
+
+
+def render_bands(effect, img, cancelled, band_height=64):
+    '''与effect(img)的结果相同，但是按行分块计算，每一块之前检查cancelled()
+    @return 结果，被取消时返回None
+    '''
+    stages = effect.stages() if isinstance(effect, EffectGlue) else [effect]
+    for f in stages:
+        if cancelled():
+            return None
+        if numpy is None or not f.tileable:
+            img = f(img)
+            continue
+
+        width, height = img.size
+        src = image_to_array(img)
+        out = numpy.empty_like(src)
+        f.prepare(width, height)
+        f.init_output(src, out)
+        step = max(1, (band_height + f.tile_align - 1) // f.tile_align) * f.tile_align
+        for top in xrange(0, height, step):
+            if cancelled():
+                return None
+            f.render_rows(src, out, top, min(height, top + step))
+        img = array_to_image(out, img.mode)
+    return img
+
+
+def polar_grid(width, height, antialias):
+    '''整张图所有子采样点在规范化坐标（-1到1）下的极坐标 (r, phi)
+    只与尺寸和antialias有关，所有径向特效共用一份。用float32保存，比float64的网格省一半内存，
+    标量版本用polar_coords做同样的舍入，所以各个后端的结果仍然完全相同。
+    与原来float64的结果相比会有少量像素不同，r ** 2在400x300的图上大约每百万像素340个，见README。
+    '''
+    def build():
+        xs, ys = subsample_grid((0, 0, width, height), antialias)
+        x = 2 * xs / width - 1
+        y = 2 * ys / height - 1
+        return (numpy.sqrt(x ** 2 + y ** 2).astype(numpy.float32),
+                numpy.arctan2(y, x).astype(numpy.float32))
+    return polar_cache.get((width, height, antialias), build)
+
+
+def solve_linear(matrix, rhs):
+    '''高斯消元（列主元）解线性方程组，不需要NumPy'''
+    n = len(rhs)
+    rows = [list(row) + [value] for row, value in zip(matrix, rhs)]
+    for col in xrange(n):
+        pivot = max(xrange(col, n), key=lambda r: abs(rows[r][col]))
+        if abs(rows[pivot][col]) < 1e-12:
+            raise ValueError('singular matrix')
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        for r in xrange(col + 1, n):
+            factor = rows[r][col] / rows[col][col]
+            for k in xrange(col, n + 1):
+                rows[r][k] -= factor * rows[col][k]
+    solution = [0.0] * n
+    for r in reversed(xrange(n)):
+        solution[r] = (rows[r][n] - sum(rows[r][k] * solution[k]
+                                        for k in xrange(r + 1, n))) / rows[r][r]
+    return solution
+
+
+def perspective_matrix(width, height, offsets):
+    '''把输出图的四个角映射到源图中四个角加上offsets的单应矩阵
+    返回 (a, b, c, d, e, f, g, h)：u = (ax + by + c) / (gx + hy + 1)，v = (dx + ey + f) / (gx + hy + 1)
+    @param offsets 左上、右上、右下、左下四个角的偏移
+    '''
+    corners = [(0, 0), (width, 0), (width, height), (0, height)]
+    matrix, rhs = [], []
+    for (x, y), (dx, dy) in zip(corners, offsets):
+        u, v = x + dx, y + dy
+        matrix.append([x, y, 1, 0, 0, 0, -x * u, -y * u])
+        rhs.append(u)
+        matrix.append([0, 0, 0, x, y, 1, -x * v, -y * v])
+        rhs.append(v)
+    try:
+        return tuple(solve_linear([map(float, row) for row in matrix], map(float, rhs)))
+    except ValueError:
+        raise ValueError('degenerate perspective offsets %r' % (offsets, ))
+
+
+class Unfingerprintable(Exception):
+    '''参数中有无法稳定描述的对象'''
+
+
+def code_repr(code):
+    '''函数体的描述，不包括文件名和行号，所以移动代码的位置不影响结果'''
+    consts = ', '.join(code_repr(c) if isinstance(c, types.CodeType) else fingerprint_repr(c)
+                       for c in code.co_consts)
+    return 'code(%r, (%s), %r)' % (code.co_code, consts, code.co_names)
+
+
+def code_names(code):
+    '''函数体（包括其中嵌套的lambda）用到的所有名字'''
+    names = set(code.co_names)
+    for c in code.co_consts:
+        if isinstance(c, types.CodeType):
+            names |= code_names(c)
+    return names
+
+
+def function_repr(func, active):
+    '''函数的描述：代码、默认参数、闭包，以及用到的全局变量的当前值
+    全局变量中的函数递归描述，这样修改辅助函数或者全局常量之后fingerprint也会改变。
+    '''
+    if func in active:
+        # 递归调用自己的函数
+        return 'recursive(%s)' % func.__name__
+    active = active + (func, )
+    closure = [c.cell_contents for c in func.func_closure or ()]
+    # 不在func_globals中的名字是内建函数或者属性名
+    used = [(name, func.func_globals[name]) for name in sorted(code_names(func.func_code))
+            if name in func.func_globals]
+    return 'function(%s, %s, %s, {%s})' % (
+        code_repr(func.func_code),
+        fingerprint_repr(func.func_defaults, active),
+        fingerprint_repr(closure, active),
+        ', '.join('%s: %s' % (name, fingerprint_repr(value, active)) for name, value in used))
+
+
+def fingerprint_repr(value, active=()):
+    '''把特效的参数转成稳定的字符串，不同的进程、不同的运行中结果都相同
+    不认识的对象抛出Unfingerprintable。
+    @param active 正在描述的函数，用于处理递归
+    '''
+    if value is None or isinstance(value, (bool, int, long, float, str, unicode)):
+        return repr(value)
+    if isinstance(value, (tuple, list)):
+        return '%s(%s)' % (type(value).__name__,
+                           ', '.join(fingerprint_repr(v, active) for v in value))
+    if isinstance(value, dict):
+        return 'dict(%s)' % ', '.join('%s: %s' % (fingerprint_repr(k, active),
+                                                  fingerprint_repr(v, active))
+                                      for k, v in sorted(value.items()))
+    if isinstance(value, Effect):
+        ignore = value.fingerprint_ignore
+        return '%s.%s{%s}' % (value.__class__.__module__, value.__class__.__name__,
+                              ', '.join('%s: %s' % (k, fingerprint_repr(v, active))
+                                        for k, v in sorted(value.__dict__.items())
+                                        if k not in ignore))
+    if isinstance(value, types.FunctionType):
+        return function_repr(value, active)
+    if isinstance(value, types.MethodType):
+        return 'method(%s, %s)' % (fingerprint_repr(value.im_func, active),
+                                   fingerprint_repr(value.im_self, active))
+    if isinstance(value, types.BuiltinFunctionType):
+        return 'builtin(%s.%s)' % (getattr(value, '__module__', None), value.__name__)
+    if isinstance(value, (type, types.ClassType)):
+        return 'class(%s.%s)' % (value.__module__, value.__name__)
+    if isinstance(value, types.ModuleType):
+        # 函数里的math.sin之类，只记录模块名
+        return 'module(%s)' % value.__name__
+    if isinstance(value, Formula):
+        return repr(value)
+    if is_array(value):
+        return 'array(%s, %r, %s)' % (value.dtype.str, value.shape,
+                                      hashlib.sha1(numpy.ascontiguousarray(value)).hexdigest())
+    raise Unfingerprintable('cannot fingerprint %r' % (value, ))
+
 
 # Effect是特效处理流程中的过滤器，输入PIL中的Image，然后输出处理好的Image
 # 其中，（）是经过重载的，默认调用成员函数filter(img)。这样可以方便的与其他普通过滤器函数组合在一起。
@@ -31,115 +726,488 @@ class Effect(object):
     '''
     name = 'Base Effect'
     empty_color = (128, 128, 128, 255)
+    # 是否是纯粹的坐标映射（实现了source_coords），EffectGlue会把相邻的这类特效合并
+    coordinate_mapping = False
+    # 结果是否保留源图中的像素（在原图上绘制）。为False时整张图重画，不能在源图上原地执行
+    keep_source = True
+    # 是否可以分块渲染（实现了prepare和render_rows），以及每一块的高度需要对齐到多少行
+    tileable = False
+    tile_align = 1
+    # 性能统计的接收者，见Instrument模块。为None时不做任何统计
+    instrument = None
+    # 结果缓存，见Cache模块。为None时不缓存
+    cache = None
+    # 参数是否与图片尺寸无关（如规范化坐标下的方程），是的话缩小的预览可以直接使用这个特效
+    scale_invariant = False
+    # 不影响输出结果的属性，计算fingerprint时忽略
+    fingerprint_ignore = ('name', 'backend', 'vectorizable', 'cache', 'rng', 'prepared_mesh')
     def __init__(self):
         pass
 
-    def __call__(self, img):
-        '''重载（），模仿C++中的仿函数。
+    def __call__(self, img, out=None, inplace=False):
+        '''重载（），模仿C++中的仿函数。参数的含义见filter
         '''
-        return self.filter(img)
+        if self.cache is not None:
+            return deliver(self.cache.call(self, img), output_target(img, out, inplace))
+        return self.invoke(img, out, inplace)
 
-    def filter(self, img):
-        return img
+    def fingerprint(self):
+        '''由类和参数得到的稳定摘要，fingerprint相同的特效对同一张图的输出也相同。
+        参数中有无法描述的对象时返回None。
+        '''
+        try:
+            text = '%s %r %s' % (VERSION, Effect.empty_color, fingerprint_repr(self))
+        except Unfingerprintable:
+            return None
+        return hashlib.sha1(text).hexdigest()
+
+    def invoke(self, img, out=None, inplace=False):
+        '''调用filter，打开了性能统计时记录这次调用'''
+        target = output_target(img, out, inplace)
+        if target is None:
+            call = lambda: self.filter(img)
+        elif filter_takes_output(self):
+            call = lambda: self.filter(img, out, inplace)
+        else:
+            # 只实现了filter(img)的子类：照常调用，再把结果交到target中
+            call = lambda: deliver(self.filter(img), target)
+        if Effect.instrument is None:
+            return call()
+
+        wall, cpu = time.time(), time.clock()
+        result = call()
+        Effect.instrument.record(self, img, result, time.time() - wall, time.clock() - cpu,
+                                 target)
+        return result
+
+    def filter(self, img, out=None, inplace=False):
+        '''应用特效。所有的特效都遵守同样的所有权约定：
+        默认返回一张新的Image，img不会被修改；
+        给出out（与结果模式、尺寸相同的Image）时结果写入out并返回out，不再分配新的图片；
+        inplace为True时相当于out=img，结果覆盖img。
+        '''
+        return copy_to(img, output_target(img, out, inplace))
 
-class PerspectiveWarpEffect(Effect):
-    '''透视变换
+    def filter_batch(self, images, batch_size=16):
+        '''对一组图片应用特效，结果逐张惰性地返回
+        子类会把尺寸相同的连续batch_size张图片放在一起处理，分摊预处理的开销。
+        '''
+        for img in images:
+            yield self.filter(img)
+
+    def filter_tiled(self, img, workers=None, tile_height=64):
+        '''按行分块，用多个进程并行渲染，见Parallel.TiledRenderer'''
+        import Parallel
+        return Parallel.render_tiled(self, img, workers, tile_height)
+
+    def draft(self, scale=1):
+        '''用于预览的特效：作用在缩小到scale倍的图片上，质量可以低一些
+        参数与图片尺寸有关、又不知道如何缩放的特效，scale不为1时返回None。
+        '''
+        if scale == 1 or self.scale_invariant:
+            return self
+        return None
+
+    def progressive(self, img, scales=(0.25, ), cancel=None, band_height=64):
+        '''渐进式渲染，用于交互式地调整参数
+        先在缩小的图片上用最低的质量算出预览，再逐步提高到原图尺寸和完整的质量。
+        参数变了之后，设置cancel或者直接丢弃生成器，剩下的计算就不会再进行。
+        @param scales 预览的缩小比例，draft不支持缩放的特效会跳过这些预览
+        @param cancel 有is_set()方法的对象（如threading.Event），设置后在下一块开始之前停止
+        @return 生成器，依次产生越来越好的Preview(image, scale, final)，image都与img一样大
+        '''
+        cancelled = cancel.is_set if cancel is not None else lambda: False
+        width, height = img.size
+        for scale in sorted(s for s in scales if 0 < s < 1):
+            effect = self.draft(scale)
+            if effect is None:
+                continue
+            size = (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+            out = render_bands(effect, img.resize(size, Image.BILINEAR), cancelled, band_height)
+            if out is None:
+                return
+            yield Preview(out.resize(img.size, Image.BILINEAR), scale, False)
+
+        effect = self.draft(1)
+        if effect is not self:
+            out = render_bands(effect, img, cancelled, band_height)
+            if out is None:
+                return
+            yield Preview(out, 1, False)
+
+        out = render_bands(self, img, cancelled, band_height)
+        if out is not None:
+            yield Preview(out, 1, True)
+
+class WarpEffect(Effect):
+    '''基于坐标映射的特效的基类
+    子类实现source_coords，给出输出图中每个子采样点在源图中的坐标。
+    有NumPy时，映射关系会被编译成RemapTable缓存起来，
+    之后同样尺寸、同样参数的调用只需要取样求平均。
     '''
-    def __init__(self,
-                 lefttopoffset=(0, 0),
-                 righttopoffset=(0, 0),
-                 rightbottomoffset=(0, 0),
-                 leftbottomoffset=(0, 0),
-                 ):
-        # self.offsets = [lefttopoffset,
-        #                 righttopoffset,
-        #                 rightbottomoffset,
-        #                 leftbottomoffset,
-        #                 ]
-        self.lefttopoffset     = lefttopoffset
-        self.righttopoffset    = righttopoffset
-        self.rightbottomoffset = rightbottomoffset
-        self.leftbottomoffset  = leftbottomoffset
+    name = 'Warp Effect'
+    antialias = 2
+    coordinate_mapping = True
+    # 没有有效采样点的像素是否保留原图的像素，否则填充empty_color
+    keep_source = False
+    # source_coords是否能直接接受numpy数组，失败后置为False
+    vectorizable = True
+    # 指定这个特效使用的后端，None表示使用全局默认后端
+    backend = None
+    # 取样方式，见INTERPOLATIONS。插值方式下每个像素只取一个采样点，antialias不起作用
+    interpolation = 'nearest'
+
+    @property
+    def active_backend(self):
+        '''实际会使用的后端'''
+        name = self.backend or default_backend
+        if name is not None:
+            return check_backend(name)
+        return available_backends()[0]
+
+    def remap_params(self):
+        '''决定映射关系的参数，与图片尺寸、antialias一起作为映射表缓存的key'''
+        raise NotImplementedError
+
+    def region(self, width, height):
+        '''需要计算的像素范围 (left, top, right, bottom)'''
+        return (0, 0, width, height)
+
+    def source_coords(self, x, y, width, height):
+        '''输出图中的像素坐标 => 源图中的像素坐标，NaN表示该点无效
+        x和y可以是标量，也可以是numpy数组。
+        '''
+        raise NotImplementedError
+
+    def remap_table(self, width, height):
+        key = (self.__class__, self.remap_params(), width, height,
+               self.antialias, check_interpolation(self.interpolation))
+        return remap_cache.get(key, lambda: self.build_remap_table(width, height))
+
+    def build_remap_table(self, width, height, rows=None):
+        '''生成映射表，rows为 (top, bottom) 时只生成这些行，与region没有交集时返回None'''
+        box = self.region(width, height)
+        if rows is not None:
+            box = (box[0], max(box[1], rows[0]), box[2], min(box[3], rows[1]))
+            if box[0] >= box[2] or box[1] >= box[3]:
+                return None
+        interpolated = self.interpolation != 'nearest'
+        antialias = 1 if interpolated else self.antialias
+
+        if self.vectorizable:
+            try:
+                us, vs = self.grid_coords(box, antialias, width, height)
+                shape = (antialias * antialias, box[3] - box[1], box[2] - box[0])
+                us = numpy.broadcast_to(numpy.asarray(us, float), shape)
+                vs = numpy.broadcast_to(numpy.asarray(vs, float), shape)
+            except Exception, e:
+                logger.warning('%s: formula does not accept numpy arrays (%s), '
+                               'building the remap table point by point',
+                               self.name, e)
+                self.vectorizable = False
+
+        if not self.vectorizable:
+            xs, ys = subsample_grid(box, antialias)
+            coords = numpy.frompyfunc(
+                lambda x, y: self.source_coords(x, y, width, height), 2, 2)
+            us, vs = coords(xs, ys)
+            us, vs = us.astype(float), vs.astype(float)
+
+        if interpolated:
+            return InterpolatedRemapTable.from_coords(
+                self.interpolation, box, us, vs, width, height)
+        return RemapTable.from_coords(box, us, vs, width, height)
+
+    def grid_coords(self, box, antialias, width, height):
+        '''box内所有子采样点在源图中的坐标，形状为 (antialias ** 2, 高, 宽)'''
+        xs, ys = subsample_grid(box, antialias)
+        return self.source_coords(xs, ys, width, height)
+
+    def draft(self, scale=1):
+        '''预览时每个像素只取一个最近邻采样点'''
+        effect = Effect.draft(self, scale)
+        if effect is None or (self.antialias == 1 and self.interpolation == 'nearest'):
+            return effect
+        effect = copy.copy(effect)
+        effect.antialias = 1
+        effect.interpolation = 'nearest'
+        return effect
+
+    @property
+    def tileable(self):
+        return self.active_backend != 'python'
+
+    @property
+    def direct_core(self):
+        '''filter_core是否直接计算，不需要映射表'''
+        return False
+
+    def filter(self, img, out=None, inplace=False):
+        target = output_target(img, out, inplace)
+        if self.active_backend == 'python':
+            return self.filter_python(img, target)
 
-    def filter(self, im):
-        # import cv, numpy
-
-        # orig = [(0,0),(width - 1,0),(width - 1, height - 1),(0, height - 1)]
-        # pos = map(lambda lhs, rhs: (lhs[0] + rhs[0], lhs[1] + rhs[1]), orig, self.offsets)
-
-        # mat = cv.CreateMat(3, 3, cv.CV_32FC1)
-        # cv.GetPerspectiveTransform(pos, orig, mat) 
-        # a = numpy.asarray(mat) 
-        # matrix = a.flatten()
-
-        width, height = im.size
-        matrix = (0 + self.lefttopoffset[0], 0 + self.lefttopoffset[1],
-                  0 + self.leftbottomoffset[0], height + self.leftbottomoffset[1],
-                  width + self.rightbottomoffset[0], height + self.rightbottomoffset[1],
-                  width + self.righttopoffset[0], 0 + self.righttopoffset[1],)
-        # print matrix 
-
-        # fill empty color
-        data = im.transform(im.size, Image.QUAD, matrix,
-                          Image.BILINEAR)
-        mask = Image.new("L", im.size, 255)
-        mask = mask.transform(im.size, Image.QUAD, matrix,
-                          Image.BILINEAR)
-        imout = Image.new("RGB", im.size, self.empty_color)
-        imout.paste(data, mask)
-
-        im = imout
-        
-        return im
+        width, height = img.size
+        src = image_to_array(img)
+        buf = numpy.empty_like(src)
+        self.prepare(width, height)
+        self.init_output(src, buf)
+        self.render_rows(src, buf, 0, height)
+        return deliver_array(buf, img.mode, target)
+
+    def prepare(self, width, height):
+        '''预先生成只与尺寸有关的数据（映射表），之后可以分块调用render_rows'''
+        self.remap_table(width, height)
+
+    def init_output(self, src, out):
+        '''把out初始化为没有有效采样点时的颜色'''
+        if self.keep_source:
+            out[:] = src
+        else:
+            out[:] = Effect.empty_color[:src.shape[-1]]
+
+    def render_rows(self, src, out, top, bottom):
+        '''只计算输出图中[top, bottom)这些行，结果写入out
+        src和out也可以是 n x height x width x bands 的一批图片
+        '''
+        height, width, nband = src.shape[-3:]
+        if self.active_backend == 'core':
+            shape = (-1, height, width, nband)
+            for frame_src, frame_out in zip(src.reshape(shape), out.reshape(shape)):
+                self.filter_core(frame_src, frame_out, (top, bottom))
+        else:
+            self.remap_table(width, height).apply(src, out, (top, bottom))
+
+    def render_tile(self, src, out, top, bottom):
+        '''与render_rows相同，但映射表只为这些行生成，用完就丢弃，不进入映射表缓存
+        用于参数只用一次（filter_variants）或者图片大到整张映射表放不下（RawImage）的情况。
+        '''
+        height, width = src.shape[-3:-1]
+        if self.direct_core:
+            self.filter_core(src, out, (top, bottom))
+            return
+        if width * height >= 2 ** 31:
+            # 映射表中的下标是int32
+            raise ValueError('%s: %dx%d is too large for a remap table' % (self.name, width, height))
+        table = self.build_remap_table(width, height, (top, bottom))
+        if table is None:
+            return
+        if self.active_backend == 'core':
+            self.apply_core(table, src, out, (top, bottom))
+        else:
+            table.apply(src, out, (top, bottom))
+
+    def filter_mapped(self, src, out, tile_height=None):
+        '''src、out是RawImage.RawImage，逐块渲染，见RawImage.render_mapped'''
+        import RawImage
+        return RawImage.render_mapped(self, src, out, tile_height)
+
+    def filter_batch(self, images, batch_size=16):
+        if self.active_backend == 'python':
+            for img in images:
+                yield self.filter(img)
+            return
+
+        for group in batches(images, batch_size):
+            width, height = group[0].size
+            mode = group[0].mode
+            src = numpy.array([image_to_array(img) for img in group])
+            out = numpy.empty_like(src)
+            self.prepare(width, height)
+            self.init_output(src, out)
+            self.render_rows(src, out, 0, height)
+            for frame in out:
+                yield array_to_image(frame, mode)
+
+    def filter_core(self, src, out, rows):
+        '''用C语言核心按映射表取样，结果写入out'''
+        height, width = src.shape[:2]
+        self.apply_core(self.remap_table(width, height), src, out, rows)
+
+    def apply_core(self, table, src, out, rows):
+        '''用C语言核心执行映射表table，与table.apply(src, out, rows)的结果相同'''
+        height, width, nband = src.shape
+        if isinstance(table, InterpolatedRemapTable):
+            core.remap_weighted(src, width, height, nband,
+                                table.xindex, table.xweight, table.xindex.shape[1],
+                                table.yoffset, table.yweight, table.yoffset.shape[1],
+                                table.found, table.box, rows, out)
+        else:
+            core.remap(src, width, height, nband, table.index, table.found,
+                       len(table.index), table.box, rows, out)
+
+    def filter_python(self, img, target=None):
+        '''逐像素计算的版本，不需要NumPy'''
+        src = PixelBuffer.from_image(img)
+        if self.keep_source:
+            out = src.copy()
+        else:
+            out = PixelBuffer.blank(img.mode, img.size, Effect.empty_color)
+        self.render_pixels(src, out)
+        return out.image(target)
+
+    def render_pixels(self, src, out):
+        '''纯Python版本的render_rows：读取PixelBuffer src，结果写入out'''
+        if self.interpolation != 'nearest':
+            self.render_interpolated(src, out)
+        else:
+            self.render_nearest(src, out)
+
+    def render_nearest(self, src, out):
+        '''每个像素取antialias ** 2个最近邻采样点求平均
+        通用的版本逐点调用source_coords，子类可以换成更直接的计算。
+        '''
+        width, height = src.size
+        nband = src.nband
+        data, pixels = src.data, out.data
+        source_coords = self.source_coords
+        antialias = self.antialias
+        offsets = [ai / float(antialias) for ai in xrange(antialias)]
+        bands = range(nband)
+        psum = [0] * nband
+        left, top, right, bottom = self.region(width, height)
 
+        for y in xrange(top, bottom):
+            for x in xrange(left, right):
+                found = 0
+                for b in bands:
+                    psum[b] = 0
+
+                for ox in offsets:
+                    for oy in offsets:
+                        u, v = source_coords(x + ox, y + oy, width, height)
+                        # NaN表示无效
+                        if u != u or v != v:
+                            continue
+                        u = int(round(u))
+                        v = int(round(v))
+                        if not (0 <= u < width and 0 <= v < height):
+                            continue
+                        k = (v * width + u) * nband
+                        for b in bands:
+                            psum[b] += data[k + b]
+                        found += 1
 
-class RegionWarpEffect(Effect):
-    def __init__(self, formula, antialias=2, box=None):
-        self.formula = formula
+                if found > 0:
+                    k = (y * width + x) * nband
+                    for b in bands:
+                        pixels[k + b] = psum[b] / found
+
+    def render_interpolated(self, src, out):
+        '''插值取样的纯Python版本，与InterpolatedRemapTable的结果完全一致'''
+        width, height = src.size
+        nband = src.nband
+        data, pixels = src.data, out.data
+        kind = self.interpolation
+        left, top, right, bottom = self.region(width, height)
+        bands = range(nband)
+        psum = [0] * nband
+        rsum = [0] * nband
+
+        for y in xrange(top, bottom):
+            for x in xrange(left, right):
+                u, v = self.source_coords(float(x), float(y), width, height)
+                # NaN也会在这里被排除
+                if not (-0.5 < u < width - 0.5 and -0.5 < v < height - 0.5):
+                    continue
+
+                xindex, xweight = axis_taps(kind, u, width)
+                yindex, yweight = axis_taps(kind, v, height)
+                xtaps = [(i * nband, wx) for i, wx in zip(xindex, xweight)]
+                for b in bands:
+                    psum[b] = 0
+                for j, wy in zip(yindex, yweight):
+                    row = j * width * nband
+                    for b in bands:
+                        rsum[b] = 0
+                    for i, wx in xtaps:
+                        k = row + i
+                        for b in bands:
+                            rsum[b] += wx * data[k + b]
+                    for b in bands:
+                        psum[b] += wy * rsum[b]
+
+                k = (y * width + x) * nband
+                for b in bands:
+                    pixels[k + b] = weighted_pixel(psum[b])
+
+
+class RegionWarpEffect(WarpEffect):
+    '''只在box内做坐标变换，formula是 f(x, y) => (x', y')，也可以是字符串（见Formula）'''
+    def __init__(self, formula, antialias=2, box=None, interpolation='nearest'):
+        self.formula = as_formula(formula)
         self.antialias = antialias
         self.box = box
-
-    def filter(self, img):
-        width, height = img.size
-        new_img = Image.new(img.mode, img.size, Effect.empty_color)
-
-        nband = len(img.getpixel((0, 0)))
+        self.interpolation = check_interpolation(interpolation)
+
+    def remap_params(self):
+        # box可以是列表，作为缓存的key要转成tuple
+        return (self.formula, tuple(self.box) if self.box else None)
+
+    def region(self, width, height):
+        if not self.box:
+            return (0, 0, width, height)
+        left, top, right, bottom = self.box
+        return (max(0, left), max(0, top), min(width, right), min(height, bottom))
+
+    def source_coords(self, x, y, width, height):
+        u, v = self.formula(x, y)
+        if not self.box:
+            return u, v
+        # box之外的像素无效
+        left, top, right, bottom = self.box
+        if is_array(x):
+            inside = (x >= left) & (x < right) & (y >= top) & (y < bottom)
+            return numpy.where(inside, u, numpy.nan), numpy.where(inside, v, numpy.nan)
+        if left <= x < right and top <= y < bottom:
+            return u, v
+        return float('nan'), float('nan')
+
+    def render_nearest(self, src, out):
+        width, height = src.size
+        nband = src.nband
+        data, pixels = src.data, out.data
+        formula = self.formula
         antialias = self.antialias
-        left, top, right, bottom = self.box if self.box else (0, 0, width, height)
-            
-        for x in xrange(left, right):
-            for y in xrange(top, bottom): 
+        offsets = [ai / float(antialias) for ai in xrange(antialias)]
+        bands = range(nband)
+        psum = [0] * nband
+        left, top, right, bottom = self.region(width, height)
+
+        for y in xrange(top, bottom):
+            for x in xrange(left, right):
                 found = 0
-                psum = (0, ) * nband
+                for b in bands:
+                    psum[b] = 0
 
                 # anti-alias
-                for ai in xrange(antialias):
-                    _x = x + ai / float(antialias)
-                    for aj in xrange(antialias):
-                        _y = y + aj / float(antialias)
-
-                        u, v = self.formula(_x, _y)
+                for ox in offsets:
+                    _x = x + ox
+                    for oy in offsets:
+                        u, v = formula(_x, y + oy)
 
                         u = int(round(u))
                         v = int(round(v))
                         if not (0 <= u < width and 0 <= v < height):
                             continue
-                        pt = img.getpixel((u, v))
-                        psum = map(operator.add, psum, pt)
-                        found += 1 
+                        k = (v * width + u) * nband
+                        for b in bands:
+                            psum[b] += data[k + b]
+                        found += 1
 
                 if found > 0:
-                    psum = map(operator.div, psum, (found, ) * len(psum)) 
-                    new_img.putpixel((x, y), tuple(psum))
+                    k = (y * width + x) * nband
+                    for b in bands:
+                        pixels[k + b] = psum[b] / found
 
-        return new_img 
-        
-        
-class LocalWarpEffect(Effect):
+
+class LocalWarpEffect(WarpEffect):
     '''Interactive Image Warping Effect
     @note 参考文献: Interactive Image Warping by Andreas Gustafsson 
     '''
-    def __init__(self, center, mouse, radius, antialias=2):
+    keep_source = True
+
+    def __init__(self, center, mouse, radius, antialias=2, interpolation='nearest'):
         '''
         @param center 局部变形效果的圆心，可以认为是鼠标按下起点
         @param mouse 鼠标释放的位置
@@ -149,15 +1217,21 @@ class LocalWarpEffect(Effect):
         self.mouse = mouse
         self.radius = radius
         self.antialias = antialias
+        self.interpolation = check_interpolation(interpolation)
 
     def warp(self, x, y, r, center, mouse):
+        m = numpy if is_array(x) else math
         cx, cy = center
         mx, my = mouse
-        dis_x_c = sqrt((x - cx) ** 2 + (y - cy) ** 2) 
-        dis_m_c = sqrt((x - mx) ** 2 + (y - my) ** 2) 
-        div = float(r ** 2 - dis_x_c ** 2 + dis_m_c ** 2) 
-        if div == 0:
-            div = 0.0000000001
+        dis_x_c = m.sqrt((x - cx) ** 2 + (y - cy) ** 2)
+        dis_m_c = m.sqrt((x - mx) ** 2 + (y - my) ** 2)
+        div = r ** 2 - dis_x_c ** 2 + dis_m_c ** 2
+        if m is numpy:
+            div = numpy.where(div == 0, 0.0000000001, div)
+        else:
+            div = float(div)
+            if div == 0:
+                div = 0.0000000001
         factor = ((r ** 2 - dis_x_c ** 2) / div) ** 2
 
         u = x - factor * (mx - cx)
@@ -165,84 +1239,369 @@ class LocalWarpEffect(Effect):
 
         return u, v
 
-    def filter(self, img):
-        width, height = img.size
-        new_img = img.copy()
+    def remap_params(self):
+        return (tuple(self.center), tuple(self.mouse), self.radius)
+
+    def source_coords(self, x, y, width, height):
+        m = numpy if is_array(x) else math
+        cx, cy = self.center
+        # 只有像素本身（而不是子采样点）在圆内才变形
+        inside = m.sqrt((m.floor(x) - cx) ** 2 + (m.floor(y) - cy) ** 2) <= self.radius
+        u, v = self.warp(x, y, self.radius, self.center, self.mouse)
+        if m is numpy:
+            return numpy.where(inside, u, numpy.nan), numpy.where(inside, v, numpy.nan)
+        return (u, v) if inside else (float('nan'), float('nan'))
+
+    def region(self, width, height):
+        '''圆的外接矩形（裁剪到图片范围内），只有其中的像素会被改变'''
+        cx, cy = self.center
+        r = self.radius
+        left = max(0, int(math.ceil(cx - r)))
+        top = max(0, int(math.ceil(cy - r)))
+        right = max(left, min(width, int(math.floor(cx + r)) + 1))
+        bottom = max(top, min(height, int(math.floor(cy + r)) + 1))
+        return (left, top, right, bottom)
+
+    def empty(self, width, height):
+        '''圆是否完全在图片之外'''
+        left, top, right, bottom = self.region(width, height)
+        return left >= right or top >= bottom
+
+    def draft(self, scale=1):
+        effect = WarpEffect.draft(self, 1)
+        if scale == 1:
+            return effect
+        if effect is self:
+            effect = copy.copy(self)
+        effect.center = (self.center[0] * scale, self.center[1] * scale)
+        effect.mouse = (self.mouse[0] * scale, self.mouse[1] * scale)
+        effect.radius = self.radius * scale
+        return effect
+
+    @property
+    def direct_core(self):
+        # C语言核心直接计算最近邻取样，不需要映射表
+        return self.active_backend == 'core' and self.interpolation == 'nearest'
+
+    def prepare(self, width, height):
+        if not self.empty(width, height) and not self.direct_core:
+            self.remap_table(width, height)
+
+    def render_rows(self, src, out, top, bottom):
+        height, width = src.shape[-3:-1]
+        if not self.empty(width, height):
+            WarpEffect.render_rows(self, src, out, top, bottom)
+
+    def filter_core(self, src, out, rows):
+        if self.interpolation != 'nearest':
+            return WarpEffect.filter_core(self, src, out, rows)
+        height, width, nband = src.shape
+        left, top, right, bottom = self.region(width, height)
+        top, bottom = max(top, rows[0]), min(bottom, rows[1])
+        if top < bottom:
+            core.local_warp(src, width, height, nband, self.center, self.mouse,
+                            self.radius, self.antialias,
+                            (left, top, right, bottom), out)
+
+    def render_nearest(self, src, out):
+        width, height = src.size
+        nband = src.nband
+        data, pixels = src.data, out.data
         r = self.radius
         cx, cy = self.center
         mx, my = self.mouse
-
-        nband = len(img.getpixel((0, 0)))
+        warp = self.warp
         antialias = self.antialias
-        for x in xrange(width):
-            for y in xrange(height):
+        offsets = [ai / float(antialias) for ai in xrange(antialias)]
+        bands = range(nband)
+        psum = [0] * nband
+        left, top, right, bottom = self.region(width, height)
+
+        for y in xrange(top, bottom):
+            for x in xrange(left, right):
                 if sqrt((x - cx) ** 2 + (y - cy) ** 2) > r:
                     continue
 
                 found = 0
-                psum = (0, ) * nband
+                for b in bands:
+                    psum[b] = 0
 
                 # anti-alias
-                for ai in xrange(antialias):
-                    _x = x + ai / float(antialias)
-                    for aj in xrange(antialias):
-                        _y = y + aj / float(antialias)
-
-                        u, v = self.warp(_x, _y, r, (cx, cy), (mx, my))
+                for ox in offsets:
+                    _x = x + ox
+                    for oy in offsets:
+                        u, v = warp(_x, y + oy, r, (cx, cy), (mx, my))
                         u = int(round(u))
                         v = int(round(v))
                         if not (0 <= u < width and 0 <= v < height):
                             continue
-                        pt = img.getpixel((u, v))
-                        psum = map(operator.add, psum, pt)
-                        found += 1 
+                        k = (v * width + u) * nband
+                        for b in bands:
+                            psum[b] += data[k + b]
+                        found += 1
 
                 if found > 0:
-                    psum = map(operator.div, psum, (found, ) * len(psum)) 
-                    new_img.putpixel((x, y), tuple(psum))
+                    k = (y * width + x) * nband
+                    for b in bands:
+                        pixels[k + b] = psum[b] / found
 
-        return new_img 
 
+class MultiLocalWarpEffect(Effect):
+    '''一次完成多个局部变形，结果与依次调用各个LocalWarpEffect完全相同。
+    整张图只转换一次，之后每个变形只在自己圆的外接矩形内读写，
+    所以开销与变形的总面积成正比，而不是图片面积 x 变形个数。
+    '''
+    name = 'Multi Local Warp Effect'
+    # 所有变形共用的后端，None表示使用全局默认后端
+    backend = None
+    active_backend = WarpEffect.active_backend
 
-class LensWarpEffect(Effect):
+    def __init__(self, warps=(), antialias=2, interpolation='nearest'):
+        '''
+        @param warps LocalWarpEffect或者(center, mouse, radius)的列表，按顺序执行
+        '''
+        self.antialias = antialias
+        self.interpolation = check_interpolation(interpolation)
+        self.warps = []
+        for warp in warps:
+            self.append(warp)
+
+    def append(self, warp):
+        if not isinstance(warp, LocalWarpEffect):
+            center, mouse, radius = warp
+            warp = LocalWarpEffect(center, mouse, radius, self.antialias, self.interpolation)
+        self.warps.append(warp)
+
+    def draft(self, scale=1):
+        warps = [warp.draft(scale) for warp in self.warps]
+        if all(d is w for d, w in zip(warps, self.warps)):
+            return self
+        effect = copy.copy(self)
+        effect.antialias = 1
+        effect.interpolation = 'nearest'
+        effect.warps = warps
+        return effect
+
+    def filter(self, img, out=None, inplace=False):
+        target = output_target(img, out, inplace)
+        backend = self.active_backend
+        width, height = img.size
+        warps = [warp for warp in self.warps if not warp.empty(width, height)]
+        for warp in warps:
+            warp.backend = backend
+
+        if backend == 'python':
+            # 与下面的NumPy版本相同，只是缓冲区换成PixelBuffer
+            buf = PixelBuffer.from_image(img)
+            scratch = buf.copy()
+            for warp in warps:
+                warp.render_pixels(buf, scratch)
+                buf.paste(scratch, warp.region(width, height))
+            return buf.image(target)
+
+        buf = numpy.array(image_to_array(img))
+        # 每个变形从buf读取，结果先写到scratch中对应的矩形里，再拷回buf，
+        # 这样后面的变形看到的是前面变形的结果
+        scratch = numpy.empty_like(buf)
+        for warp in warps:
+            left, top, right, bottom = warp.region(width, height)
+            area = buf[top:bottom, left:right]
+            scratch[top:bottom, left:right] = area
+            warp.prepare(width, height)
+            warp.render_rows(buf, scratch, top, bottom)
+            area[:] = scratch[top:bottom, left:right]
+        return deliver_array(buf, img.mode, target)
+
+
+def union_box(a, b):
+    '''两个矩形的外接矩形，None或者空矩形会被忽略'''
+    boxes = [box for box in (a, b) if box and box[0] < box[2] and box[1] < box[3]]
+    if not boxes:
+        return None
+    return (min(box[0] for box in boxes), min(box[1] for box in boxes),
+            max(box[2] for box in boxes), max(box[3] for box in boxes))
+
+
+class LocalWarpSession(object):
+    '''交互式的局部变形：鼠标按下后不断拖动，每次只重新计算变化了的区域。
+    session保存原图和当前的结果，拖动时先把上一次变形的区域恢复成原图，
+    再只在新的区域内计算，所以每一帧的开销只与圆的大小有关。
+
+        session = LocalWarpSession(img, radius=40)
+        session.begin((120, 80))
+        for mouse in drag_events:
+            box = session.drag(mouse)              # 需要重绘的矩形
+            canvas.paste(session.crop(box), box[:2])
+        session.end()                              # 把这一笔合并到原图中
+        result = session.image()
+    '''
+    # None表示使用全局默认后端
+    backend = None
+    active_backend = WarpEffect.active_backend
+
+    def __init__(self, img, radius, antialias=2, interpolation='nearest', backend=None):
+        self.mode = img.mode
+        self.size = img.size
+        self.radius = radius
+        self.antialias = antialias
+        self.interpolation = check_interpolation(interpolation)
+        self.backend = backend
+        # 当前这一笔的变形，以及结果中与source不同的矩形
+        self.warp = None
+        self.box = None
+        if self.active_backend == 'python':
+            self.source = PixelBuffer.from_image(img)
+            self.output = self.source.copy()
+        else:
+            self.source = numpy.array(image_to_array(img))
+            self.output = self.source.copy()
+
+    def begin(self, center, radius=None):
+        '''在center处按下鼠标，开始新的一笔。上一笔没有结束的话先结束它'''
+        if self.warp is not None:
+            self.end()
+        self.warp = LocalWarpEffect(center, center, radius or self.radius,
+                                    self.antialias, self.interpolation)
+        self.warp.backend = self.active_backend
+        self.box = None
+
+    def drag(self, mouse, radius=None):
+        '''把当前这一笔的鼠标位置移到mouse
+        @return 需要重绘的矩形 (left, top, right, bottom)，即新旧两个区域的并集，
+                没有变化时为None
+        '''
+        warp = self.warp
+        warp.mouse = mouse
+        if radius is not None:
+            warp.radius = radius
+        width, height = self.size
+        box = None if warp.empty(width, height) else warp.region(width, height)
+        dirty = union_box(self.box, box)
+        self.restore(self.box)
+        if box is not None:
+            self.render(box)
+        self.box = box
+        return dirty
+
+    def end(self):
+        '''松开鼠标，把这一笔的结果合并到原图中，之后的变形在此基础上进行'''
+        if self.box is not None:
+            left, top, right, bottom = self.box
+            if self.active_backend == 'python':
+                self.source.paste(self.output, self.box)
+            else:
+                self.source[top:bottom, left:right] = self.output[top:bottom, left:right]
+        self.warp = None
+        self.box = None
+
+    def cancel(self):
+        '''放弃当前这一笔，返回需要重绘的矩形'''
+        box = self.box
+        self.restore(box)
+        self.warp = None
+        self.box = None
+        return box
+
+    def restore(self, box):
+        '''把结果中box内的像素恢复成原图'''
+        if box is None:
+            return
+        left, top, right, bottom = box
+        if self.active_backend == 'python':
+            self.output.paste(self.source, box)
+        else:
+            self.output[top:bottom, left:right] = self.source[top:bottom, left:right]
+
+    def render(self, box):
+        warp = self.warp
+        backend = self.active_backend
+        width, height = self.size
+        if backend == 'python':
+            warp.render_pixels(self.source, self.output)
+        elif backend == 'core' and warp.interpolation == 'nearest':
+            warp.filter_core(self.source, self.output, (box[1], box[3]))
+        else:
+            # 拖动过程中每一帧的参数都不同，映射表用过一次就没用了，不放进缓存
+            table = warp.build_remap_table(width, height)
+            if backend == 'core':
+                warp.apply_core(table, self.source, self.output, (box[1], box[3]))
+            else:
+                table.apply(self.source, self.output)
+
+    def image(self):
+        '''当前的结果'''
+        if self.active_backend == 'python':
+            return self.output.image()
+        return array_to_image(self.output, self.mode)
+
+    def crop(self, box):
+        '''当前结果中box内的部分，用于只重绘变化了的区域'''
+        if self.active_backend == 'python':
+            return self.output.crop(box)
+        left, top, right, bottom = box
+        return array_to_image(self.output[top:bottom, left:right], self.mode)
+
+
+class LensWarpEffect(WarpEffect):
     '''Lens warping Effect
     全局性的镜头变形效果，构造的时候需要输入一个变换方程
     f(x, y) => (x', y').其中，x和y都被规范化为-1到1的取值。
+    方程也可以写成字符串，如 'x * abs(x), y * abs(y)'，会被编译成NumPy的向量运算（见Formula）。
     参考资料：http://paulbourke.net/miscellaneous/imagewarp/
     '''
     name = 'Warp Effect' 
+    # 字符串方程的变量名
+    formula_variables = ('x', 'y')
+    # 方程使用规范化坐标，与图片尺寸无关
+    scale_invariant = True
 
-    def __init__(self, formula, antialias=2):
-        self.formula = formula
+    def __init__(self, formula, antialias=2, interpolation='nearest'):
+        self.formula = as_formula(formula, self.formula_variables)
         self.antialias = antialias
+        self.interpolation = check_interpolation(interpolation)
 
-    def filter(self, img):
-        '''Effect Kernel of radius based Effect. 
-        @param formula is a function like f(x, y) => (x', y'), -1 <= x <= 1 and -1 <= y <= 1
-        '''
+    def lens_formula(self, x, y):
+        '''规范化坐标下的变换方程'''
+        return self.formula(x, y)
 
-        try:
-            return core.lens_warp(img, self.formula, self.antialias, self.empty_color) 
-        except:
-            pass
-        
-        width, height = img.size
+    def lens_points(self, xs, y):
+        '''一行子采样点的变换结果，xs是规范化的横坐标，y是它们共同的纵坐标'''
+        lens_formula = self.lens_formula
+        return [lens_formula(x, y) for x in xs]
+
+    def remap_params(self):
+        return (self.formula, )
+
+    def source_coords(self, x, y, width, height):
+        x = 2 * x / width - 1
+        y = 2 * y / height - 1
+        xnew, ynew = self.lens_formula(x, y)
+        return 0.5 * width * (xnew + 1), 0.5 * height * (ynew + 1)
+
+    def render_nearest(self, src, out):
+        '''逐像素调用formula的版本，formula只需要支持标量'''
+        width, height = src.size
         nx, ny = width, height
-        new_img = img.copy()
-        nband = len(img.getpixel((0, 0)))
+        nband = src.nband
+        data, pixels = src.data, out.data
+        antialias = self.antialias
+        offsets = [ai / float(antialias) for ai in xrange(antialias)]
+        # 每一列、每一行子采样点的规范化坐标只算一次，xs按像素、子采样点的顺序排成一行
+        xs = [2 * (i + o) / width - 1 for i in xrange(width) for o in offsets]
+        ys = [[2 * (j + o) / height - 1 for o in offsets] for j in xrange(height)]
+        bands = range(nband)
+        psum = [0] * nband
+
         for j in xrange(height):
+            # distortion：这一行每个子采样纵坐标上的所有点一次算完
+            rows = [self.lens_points(xs, y) for y in ys[j]]
             for i in xrange(width):
                 found = 0
-                psum = (0, ) * nband
-                new_img.putpixel((i, j), Effect.empty_color)
+                for b in bands:
+                    psum[b] = 0
                 # antialias
-                for ai in xrange(self.antialias):
-                    x = 2 * (i + ai / float(self.antialias)) / width - 1
-                    for aj in xrange(self.antialias):
-                        y = 2 * (j + aj / float(self.antialias)) / height - 1
-
-                        # distortion 
-                        xnew, ynew = self.formula(x, y) 
+                for row in rows:
+                    for xnew, ynew in row[i * antialias:(i + 1) * antialias]:
 
                         i2 = int(round(0.5 * nx * (xnew + 1)))
                         j2 = int(round(0.5 * ny * (ynew + 1)))
@@ -250,75 +1609,229 @@ class LensWarpEffect(Effect):
                         if not (0 <= i2 < nx and 0 <= j2 < ny):
                             continue
 
-                        pt = img.getpixel((i2, j2))
-                        psum = map(operator.add, psum, pt)
-                        found += 1 
+                        k = (j2 * width + i2) * nband
+                        for b in bands:
+                            psum[b] += data[k + b]
+                        found += 1
 
                 if found > 0:
-                    psum = map(operator.div, psum, (found, ) * len(psum)) 
-                    new_img.putpixel((i, j), tuple(psum))
+                    k = (j * width + i) * nband
+                    for b in bands:
+                        pixels[k + b] = psum[b] / found
 
-        return new_img
 
-
-class RadianFormulaEffect(Effect):
+class RadianFormulaEffect(LensWarpEffect):
     '''Transform the Image according to the input formula
     @note The formula is a function like f(r, phi) => (r, phi)
     which r is radius and phi is radian angel.
+    The formula can also be a string like 'r ** 1.5 * cos(r), phi'.
     ''' 
     name = 'Radian Formula Effect'
+    formula_variables = ('r', 'phi')
 
-    def __init__(self, formula, antialias=2):
-        self.formula = formula
-        self.antialias = antialias
-
-    def filter(self, img):
-        try:
-            return core.radian_warp(img, self.formula, self.antialias, self.empty_color)
-        except:
-            pass
+    def lens_formula(self, x, y):
+        '''transform formula
+        func is a function that like f(r, phi) => (r, phi)
+        x和y可以是标量，也可以是numpy数组
+        '''
+        return self.polar_formula(*polar_coords(x, y))
 
-        def radian_formula(x, y):
-            '''transform formula
-            func is a function that like f(r, phi) => (r, phi)
-            '''
-            r = sqrt(x ** 2 + y ** 2)
-            phi = atan2(y, x)
+    def lens_points(self, xs, y):
+        # 整行的极坐标一次舍入到float32，不用逐点转换
+        r = float32_list([sqrt(x ** 2 + y ** 2) for x in xs])
+        phi = float32_list([atan2(y, x) for x in xs])
+        polar_formula = self.polar_formula
+        return [polar_formula(a, b) for a, b in zip(r, phi)]
 
-            r, phi = self.formula(r, phi)
+    def polar_formula(self, r, phi):
+        '''极坐标下的变换，返回规范化的直角坐标'''
+        m = numpy if is_array(r) else math
+        r, phi = self.formula(r, phi)
 
-            xnew = r * cos(phi)
-            ynew = r * sin(phi)
+        xnew = r * m.cos(phi)
+        ynew = r * m.sin(phi)
 
-            return xnew, ynew
+        return xnew, ynew
 
-        warp = LensWarpEffect(radian_formula, self.antialias)
-        return warp(img)
+    def grid_coords(self, box, antialias, width, height):
+        if box != (0, 0, width, height):
+            # 只算一部分时不值得生成整张图的极坐标网格，结果是一样的
+            return LensWarpEffect.grid_coords(self, box, antialias, width, height)
+        # 极坐标直接从共用的网格中取，不需要每个特效各算一遍sqrt和atan2
+        r, phi = polar_grid(width, height, antialias)
+        xnew, ynew = self.polar_formula(r.astype(float), phi.astype(float))
+        return 0.5 * width * (xnew + 1), 0.5 * height * (ynew + 1)
 
 
 class RadianSqrtEffect(RadianFormulaEffect):
     name = 'r = sqrt(r)' 
     def __init__(self):
         super(RadianSqrtEffect, self).__init__(
-            lambda r, phi: (sqrt(r), phi))
+            lambda r, phi: (r ** 0.5, phi))
         
 
+class PerspectiveWarpEffect(WarpEffect):
+    '''透视变换
+    把图片的四个角分别移动offset，中间按透视（3x3的单应矩阵）变换，
+    原来用Image.QUAD做的是双线性的四边形映射，并不是真正的透视。
+    矩阵对每组参数只计算一次，映射表也会被缓存，图片的模式（包括alpha通道）保持不变，
+    没有被覆盖到的像素填充empty_color。
+    '''
+    name = 'Perspective Warp Effect'
+
+    def __init__(self,
+                 lefttopoffset=(0, 0),
+                 righttopoffset=(0, 0),
+                 rightbottomoffset=(0, 0),
+                 leftbottomoffset=(0, 0),
+                 antialias=1,
+                 interpolation='bilinear',
+                 ):
+        self.lefttopoffset     = lefttopoffset
+        self.righttopoffset    = righttopoffset
+        self.rightbottomoffset = rightbottomoffset
+        self.leftbottomoffset  = leftbottomoffset
+        self.antialias = antialias
+        self.interpolation = check_interpolation(interpolation)
+
+    @property
+    def offsets(self):
+        return (tuple(self.lefttopoffset), tuple(self.righttopoffset),
+                tuple(self.rightbottomoffset), tuple(self.leftbottomoffset))
+
+    def remap_params(self):
+        return self.offsets
+
+    def matrix(self, width, height):
+        '''输出图 => 源图的单应矩阵 (a, b, c, d, e, f, g, h)，坐标以像素的边为准'''
+        key = (width, height, self.offsets)
+        return homography_cache.get(key, lambda: perspective_matrix(width, height, self.offsets))
+
+    def source_coords(self, x, y, width, height):
+        a, b, c, d, e, f, g, h = self.matrix(width, height)
+        # 像素的中心是整数坐标，矩阵使用的坐标以像素的边为准，差半个像素
+        x = x + 0.5
+        y = y + 0.5
+        w = g * x + h * y + 1
+        if is_array(w):
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                u = (a * x + b * y + c) / w - 0.5
+                v = (d * x + e * y + f) / w - 0.5
+            # 落到地平线之后的点无效
+            behind = w <= 0
+            return numpy.where(behind, numpy.nan, u), numpy.where(behind, numpy.nan, v)
+        if w <= 0:
+            return float('nan'), float('nan')
+        return (a * x + b * y + c) / w - 0.5, (d * x + e * y + f) / w - 0.5
+
+    @property
+    def direct_core(self):
+        # C语言核心直接计算双线性插值，不需要映射表
+        return self.active_backend == 'core' and self.interpolation == 'bilinear'
+
+    def prepare(self, width, height):
+        if not self.direct_core:
+            self.remap_table(width, height)
+
+    def filter_core(self, src, out, rows):
+        if self.interpolation != 'bilinear':
+            return WarpEffect.filter_core(self, src, out, rows)
+        height, width, nband = src.shape
+        core.perspective(src, width, height, nband, self.matrix(width, height),
+                         (0, 0, width, height), rows, out)
+
+    def with_offsets(self, offsets):
+        effect = copy.copy(self)
+        (effect.lefttopoffset, effect.righttopoffset,
+         effect.rightbottomoffset, effect.leftbottomoffset) = offsets
+        return effect
+
+    def draft(self, scale=1):
+        effect = WarpEffect.draft(self, 1)
+        if scale == 1:
+            return effect
+        return effect.with_offsets([(x * scale, y * scale) for x, y in self.offsets])
+
+    def filter_variants(self, img, variants):
+        '''同一张图片、多组四角偏移的透视变换，常用于数据增强
+        源图只转换一次，每组参数的映射表用完就丢弃，不占用映射表缓存。
+        @param variants [(lefttop, righttop, rightbottom, leftbottom)]
+        @return 生成器，依次产生每组参数的结果
+        '''
+        if self.active_backend == 'python':
+            for offsets in variants:
+                yield self.with_offsets(offsets).filter(img)
+            return
+
+        height = img.size[1]
+        src = image_to_array(img)
+        for offsets in variants:
+            effect = self.with_offsets(offsets)
+            out = numpy.empty_like(src)
+            effect.init_output(src, out)
+            effect.render_tile(src, out, 0, height)
+            yield array_to_image(out, img.mode)
+
+
 class GlobalWaveEffect(Effect):
     '''全局波浪效果，使用sin进行变换
     '''
+    coordinate_mapping = True
+    keep_source = False
+    # mesh网格的大小（像素），'auto'表示按波浪的形状自动选择
+    mesh_cell = 10
+    # 自动选择网格大小时，网格内双线性插值与sin曲线之间允许的最大误差（像素）
+    mesh_tolerance = 0.25
+    tileable = numpy is not None
+
     def __init__(self, dw=1, dh=0.1, xoffset=0, antialias=2,
                  amplitudeRange = (6, 6.5),
                  periodRange    = (0.07, 0.07),
+                 mesh_cell = None,
+                 seed = None,
+                 rng = None,
                  ):
+        '''
+        @param seed 随机数种子，相同的种子得到相同的波浪，这样结果可以被缓存
+        @param rng 使用的random.Random对象，默认使用random模块
+        '''
         self.dw = dw
         self.dh = dh
         self.antialias = antialias
         self.xoffset = xoffset
-
-        self.amplitude = random.uniform(*amplitudeRange)
-        self.period = random.uniform(*periodRange)
-        self.offset = (random.uniform(0, math.pi * 2 / self.period),
-                       random.uniform(0, math.pi * 2 / self.period))
+        self.amplitudeRange = amplitudeRange
+        self.periodRange = periodRange
+        if mesh_cell is not None:
+            self.mesh_cell = mesh_cell
+        if rng is None:
+            rng = random if seed is None else random.Random(seed)
+        self.rng = rng
+
+        self.randomize()
+
+    def randomize(self):
+        '''重新随机选择振幅、周期和相位'''
+        rng = self.rng
+        self.amplitude = rng.uniform(*self.amplitudeRange)
+        self.period = rng.uniform(*self.periodRange)
+        self.offset = (rng.uniform(0, math.pi * 2 / self.period),
+                       rng.uniform(0, math.pi * 2 / self.period))
+
+    @property
+    def cell(self):
+        '''实际使用的网格大小'''
+        if self.mesh_cell != 'auto':
+            return self.mesh_cell
+        # 用折线近似a * sin(p * x)，步长为r时最大误差约为 a * (p * r) ** 2 / 8
+        curvature = self.amplitude * self.period ** 2
+        if curvature <= 0:
+            return 32
+        return max(2, min(32, int(sqrt(8 * self.mesh_tolerance / curvature))))
+
+    @property
+    def tile_align(self):
+        '''分块渲染时每一块的高度必须是网格大小的整数倍'''
+        return self.cell
 
     def transform(self, image):
         return (lambda x, y,
@@ -328,32 +1841,48 @@ class GlobalWaveEffect(Effect):
                 (math.sin( (y+o[0])*p )*a + x,
                  math.sin( (x+o[1])*p )*a + y))
 
-    def render(self, image):
-        r = 10
-        xPoints = image.size[0] / r + 2
-        yPoints = image.size[1] / r + 2
-        f = self.transform(image)
-
-        # Create a list of arrays with transformed points
-        xRows = []
-        yRows = []
-        for j in xrange(yPoints):
-            xRow = []
-            yRow = []
-            for i in xrange(xPoints):
-                x, y = f(i*r, j*r)
-
-                # Clamp the edges so we don't get black undefined areas
-                x = max(0, min(image.size[0]-1, x))
-                y = max(0, min(image.size[1]-1, y))
-
-                xRow.append(x)
-                yRow.append(y)
-            xRows.append(xRow)
-            yRows.append(yRow)
-
-        # Create the mesh list, with a transformation for
-        # each square between points on the grid
+    def remap_params(self):
+        return (self.amplitude, self.period, self.offset)
+
+    def source_coords(self, x, y, width, height):
+        '''与transform相同的变换，x和y可以是numpy数组'''
+        m = numpy if is_array(x) else math
+        a, p, o = self.amplitude, self.period, self.offset
+        u = m.sin((y + o[0]) * p) * a + x
+        v = m.sin((x + o[1]) * p) * a + y
+        # Clamp the edges so we don't get black undefined areas
+        if m is numpy:
+            return numpy.clip(u, 0, width - 1), numpy.clip(v, 0, height - 1)
+        return max(0, min(width - 1, u)), max(0, min(height - 1, v))
+
+    def mesh(self, size):
+        '''Image.MESH需要的网格列表，按 (尺寸, 网格大小, 波浪参数) 缓存'''
+        r = self.cell
+        key = (size, r, self.remap_params())
+        return mesh_cache.get(key, lambda: self.build_mesh(size, r))
+
+    def build_mesh(self, size, r):
+        # 变换是可分离的：x方向的偏移只与网格点所在的行有关，y方向的偏移只与列有关，
+        # 所以只需要对每一行、每一列各算一次sin
+        xPoints = size[0] / r + 2
+        yPoints = size[1] / r + 2
+        a, p, o = self.amplitude, self.period, self.offset
+
+        if numpy is not None:
+            xs = numpy.arange(xPoints) * r
+            ys = numpy.arange(yPoints) * r
+            return self.mesh_quads(size, r, xs, ys,
+                                   numpy.sin((ys + o[0]) * p) * a, numpy.sin((xs + o[1]) * p) * a)
+
+        xShift = [math.sin((j * r + o[0]) * p) * a for j in xrange(yPoints)]
+        yShift = [math.sin((i * r + o[1]) * p) * a for i in xrange(xPoints)]
+
+        # Clamp the edges so we don't get black undefined areas
+        xRows = [[max(0, min(size[0] - 1, dx + i * r)) for i in xrange(xPoints)]
+                 for dx in xShift]
+        yRows = [[max(0, min(size[1] - 1, dy + j * r)) for dy in yShift]
+                 for j in xrange(yPoints)]
+
         mesh = []
         for j in xrange(yPoints-1):
             for i in xrange(xPoints-1):
@@ -367,23 +1896,207 @@ class GlobalWaveEffect(Effect):
                      xRows[j+1][i+1], yRows[j+1][i+1],
                      xRows[j  ][i+1], yRows[j  ][i+1]),
                     ))
+        return mesh
+
+    def mesh_quads(self, size, r, xs, ys, xShift, yShift):
+        '''由网格点的坐标xs、ys和每一行的x偏移xShift、每一列的y偏移yShift生成mesh（NumPy）'''
+        # Clamp the edges so we don't get black undefined areas
+        xRows = numpy.clip(xShift[:, None] + xs, 0, size[0] - 1)
+        yRows = numpy.clip(yShift[None, :] + ys[:, None], 0, size[1] - 1)
+
+        # Source quadrilateral: NW, SW, SE, NE
+        quads = numpy.dstack((xRows[:-1, :-1], yRows[:-1, :-1],
+                              xRows[1:, :-1], yRows[1:, :-1],
+                              xRows[1:, 1:], yRows[1:, 1:],
+                              xRows[:-1, 1:], yRows[:-1, 1:]))
+        quads = map(tuple, quads.reshape(-1, 8).tolist())
+        boxes = mesh_cache.get(('boxes', size, r), lambda: self.mesh_boxes(size, r))
+        return zip(boxes, quads)
+
+    def random_mesh(self, size):
+        '''只用一次的随机波浪的mesh，不放进缓存
+        周期固定时（periodRange的上下限相同，默认如此），网格点的sin(x * p)、cos(x * p)
+        按 (尺寸, 网格大小, 周期) 缓存，每个波浪只需要再算两组sin、cos：
+        sin((x + o) * p) = sin(x * p) * cos(o * p) + cos(x * p) * sin(o * p)。
+        结果与build_mesh只有浮点舍入上的差别。
+        '''
+        r = self.cell
+        low, high = self.periodRange
+        if numpy is None or low != high:
+            return self.build_mesh(size, r)
+        a, p, o = self.amplitude, self.period, self.offset
+
+        def build():
+            xs = numpy.arange(size[0] / r + 2) * r
+            ys = numpy.arange(size[1] / r + 2) * r
+            return (xs, ys, numpy.sin(xs * p), numpy.cos(xs * p),
+                    numpy.sin(ys * p), numpy.cos(ys * p))
+        xs, ys, xsin, xcos, ysin, ycos = mesh_cache.get(('sin', size, r, p), build)
+        xShift = (ysin * math.cos(o[0] * p) + ycos * math.sin(o[0] * p)) * a
+        yShift = (xsin * math.cos(o[1] * p) + xcos * math.sin(o[1] * p)) * a
+        return self.mesh_quads(size, r, xs, ys, xShift, yShift)
+
+    @staticmethod
+    def mesh_boxes(size, r):
+        '''网格中每一格在输出图中的矩形，只与尺寸和网格大小有关'''
+        xPoints = size[0] / r + 2
+        yPoints = size[1] / r + 2
+        return [(i * r, j * r, (i + 1) * r, (j + 1) * r)
+                for j in xrange(yPoints - 1) for i in xrange(xPoints - 1)]
+
+    def render(self, image, target=None):
+        return transform_mesh(image, self.mesh(image.size), Image.BILINEAR, target)
+
+    def draft(self, scale=1):
+        '''缩小scale倍后，振幅和相位按像素缩小，周期相应变短'''
+        if scale == 1:
+            return self
+        effect = copy.copy(self)
+        effect.amplitude = self.amplitude * scale
+        effect.period = self.period / scale
+        effect.offset = (self.offset[0] * scale, self.offset[1] * scale)
+        return effect
+
+    def prepare(self, width, height):
+        self.prepared_mesh = ((width, height), self.mesh((width, height)))
+
+    def init_output(self, src, out):
+        pass
 
-        return image.transform(image.size, Image.MESH, mesh, Image.BILINEAR)
-
-    def filter(self, img):
-        # try:
-        #     return core.wave_warp(img, self.dw, self.dh, self.xoffset, self.antialias, self.empty_color)
-        # except:
-        #     pass 
-
-        return self.render(img)
+    def render_rows(self, src, out, top, bottom):
+        '''只渲染[top, bottom)这些行，top必须是网格大小的整数倍'''
+        height, width, nband = src.shape
+        size, mesh = getattr(self, 'prepared_mesh', (None, None))
+        if size != (width, height):
+            mesh = self.mesh((width, height))
+        mesh = [(box, quad) for box, quad in mesh if top <= box[1] < bottom]
+        if not mesh:
+            return
+
+        # 只把这一块用到的源图行（上下各多留两行）转成Image
+        ys = [quad[k] for box, quad in mesh for k in (1, 3, 5, 7)]
+        y0 = max(0, int(math.floor(min(ys))) - 2)
+        y1 = min(height, int(math.ceil(max(ys))) + 3)
+        mesh = [((x0, b0 - top, x1, b1 - top),
+                 tuple(c - y0 if k % 2 else c for k, c in enumerate(quad)))
+                for (x0, b0, x1, b1), quad in mesh]
+        image = array_to_image(src[y0:y1])
+        band = image.transform((width, bottom - top), Image.MESH, mesh, Image.BILINEAR)
+        out[top:bottom] = image_to_array(band)
+
+    def filter(self, img, out=None, inplace=False):
+        target = output_target(img, out, inplace)
+        if target is img:
+            # 不能一边读一边写同一张图片
+            return deliver(self.render(img), target)
+        return self.render(img, target)
+
+    def filter_batch(self, images, batch_size=16):
+        # 同样尺寸的图片共用一个mesh
+        size, mesh = None, None
+        for img in images:
+            if img.size != size:
+                size, mesh = img.size, self.mesh(img.size)
+            yield img.transform(size, Image.MESH, mesh, Image.BILINEAR)
+
+    def filter_random(self, images):
+        '''每张图片使用一个新的随机波浪（范围与构造时相同），常用于生成验证码。
+        随机的参数不会重复，所以mesh不放进缓存，只缓存周期固定时共用的sin表（见random_mesh）。
+        @return 生成器，依次产生 (图片, 该图片所用的GlobalWaveEffect)
+        '''
+        for img in images:
+            wave = copy.copy(self)
+            wave.randomize()
+            mesh = wave.random_mesh(img.size)
+            yield img.transform(img.size, Image.MESH, mesh, Image.BILINEAR), wave
+
+class FusedWarpEffect(WarpEffect):
+    '''把若干个坐标映射类特效复合成一个映射，只需要取样一次。
+    不但省掉了中间图片的分配，也避免了多次重采样带来的模糊。
+    '''
+    name = 'Fused Warp Effect'
+
+    def __init__(self, effects):
+        self.effects = list(effects)
+        self.antialias = max(f.antialias for f in self.effects)
+        self.keep_source = all(f.keep_source for f in self.effects)
+        # 复合后只取样一次，使用其中质量最高的取样方式
+        self.interpolation = max((getattr(f, 'interpolation', 'nearest') for f in self.effects),
+                                 key=INTERPOLATIONS.index)
+
+    def draft(self, scale=1):
+        effects = [f.draft(scale) for f in self.effects]
+        if None in effects:
+            return None
+        if all(d is f for d, f in zip(effects, self.effects)):
+            return self
+        return FusedWarpEffect(effects)
+
+    def remap_params(self):
+        return tuple((f.__class__, f.remap_params(), f.antialias) for f in self.effects)
+
+    def region(self, width, height):
+        '''所有特效都保留源图时，只有各自region的并集中的像素会被改变，
+        相邻的LocalWarpEffect合并后仍然只计算它们的外接矩形
+        '''
+        if not self.keep_source:
+            return (0, 0, width, height)
+        boxes = [f.region(width, height) for f in self.effects]
+        boxes = [box for box in boxes if box[0] < box[2] and box[1] < box[3]]
+        if not boxes:
+            return (0, 0, 0, 0)
+        return (max(0, min(box[0] for box in boxes)), max(0, min(box[1] for box in boxes)),
+                min(width, max(box[2] for box in boxes)), min(height, max(box[3] for box in boxes)))
+
+    def source_coords(self, x, y, width, height):
+        # 先执行的特效最后映射：out(p) = f1(f2(p))
+        pixel = True
+        for f in reversed(self.effects):
+            if is_array(x):
+                with numpy.errstate(invalid='ignore'):
+                    x, y = self.compose(f, x, y, width, height, pixel)
+            else:
+                x, y = self.compose(f, x, y, width, height, pixel)
+            pixel = False
+        return x, y
+
+    def compose(self, f, x, y, width, height, pixel):
+        '''把坐标(x, y)经过特效f映射一次，落在图外的点变为NaN
+        @param pixel (x, y)是否是输出图中的子采样点，是的话f没有影响到的点
+                     取其所在的像素，否则保持原坐标
+        '''
+        m = numpy if is_array(x) else math
+        u, v = f.source_coords(x, y, width, height)
+        if pixel:
+            x, y = m.floor(x), m.floor(y)
+        if m is numpy:
+            u, v, _ = numpy.broadcast_arrays(
+                numpy.asarray(u, float), numpy.asarray(v, float), x)
+            if f.keep_source:
+                # 该特效没有影响到的像素保持原位置
+                untouched = numpy.isnan(u)
+                u = numpy.where(untouched, x, u)
+                v = numpy.where(untouched, y, v)
+            inside = ((u > -0.5) & (u < width - 0.5) &
+                      (v > -0.5) & (v < height - 0.5))
+            return numpy.where(inside, u, numpy.nan), numpy.where(inside, v, numpy.nan)
+
+        if f.keep_source and math.isnan(u):
+            u, v = x, y
+        if not (-0.5 < u < width - 0.5 and -0.5 < v < height - 0.5):
+            return float('nan'), float('nan')
+        return u, v
 
 
 class EffectGlue(Effect):
     name = 'Effect Glue'
-    def __init__(self, name=None):
+    def __init__(self, name=None, fuse=True):
+        '''
+        @param fuse 是否把相邻的坐标映射类特效合并成一次取样
+        '''
         self.name = name if name else EffectGlue.name 
         self.effect_pipeline = []
+        self.fuse = fuse
 
     def append(self, effect):
         self.effect_pipeline.append(effect)
@@ -392,15 +2105,133 @@ class EffectGlue(Effect):
         self.effect_pipeline.remove(effect)
 
     def insert(self, index, effect):
-        self.effect_pipeline.insert(index, Effect)
+        self.effect_pipeline.insert(index, effect)
 
     def pop(self):
         return self.effect_pipeline.pop()
 
-    def filter(self, img):
-        for f in self.effect_pipeline:
-            img = f.filter(img)
-        return img
+    def stages(self):
+        '''实际执行的各个阶段，相邻的坐标映射类特效会被合并成FusedWarpEffect'''
+        if not self.fuse:
+            return list(self.effect_pipeline)
+
+        stages, run = [], []
+        for f in self.effect_pipeline + [None]:
+            if f is not None and f.coordinate_mapping:
+                run.append(f)
+                continue
+            if len(run) > 1:
+                stages.append(FusedWarpEffect(run))
+            else:
+                stages.extend(run)
+            run = []
+            if f is not None:
+                stages.append(f)
+        return stages
+
+    def filter(self, img, out=None, inplace=False):
+        '''依次执行各个阶段
+        有NumPy时整条流水线最多使用两块数组和两张Image，所以不论有几个阶段，分配的帧数都是固定的，
+        见filter_buffers。
+        '''
+        target = output_target(img, out, inplace)
+        stages = self.stages()
+        if not stages:
+            return copy_to(img, target)
+        if (numpy is None or not any(f.tileable for f in stages)
+            or any(f.cache is not None for f in stages)):
+            # 第一个阶段生成新的图片，之后的阶段都在这张图上原地执行
+            if not filter_takes_output(stages[0]) and target is not img:
+                # 老式的特效可能直接修改输入，先拷贝一份，保证img不变
+                img = img.copy()
+            for index, f in enumerate(stages[:-1]):
+                img = f(img, inplace=index > 0)
+            return stages[-1](img, target, len(stages) > 1 and target is None)
+        return self.filter_buffers(img, stages, target)
+
+    def filter_buffers(self, img, stages, target):
+        '''WarpEffect从一块数组读取、写到另一块，然后交换。其他阶段在Image上执行：
+        整张重画的阶段（keep_source为False并且接受out参数，如GlobalWaveEffect）从一张Image画到另一张，
+        其余的阶段原地修改。target本身就是其中一张Image；没有target时，
+        结果写到已经分配的Image中。Image与数组之间的转换各经过一次tostring，
+        PIL导出像素时的这个临时字符串不计在内。
+        '''
+        width, height = img.size
+        mode = img.mode
+        shape = (height, width, len(img.getbands()))
+        arrays = [None, None]
+        cur = 0
+        images = [target, None]
+        # 当前的结果：在Image中时就是这张Image（开始时是输入本身），为None时在arrays[cur]中
+        image = img
+        for index, f in enumerate(stages):
+            if not isinstance(f, WarpEffect):
+                if image is None:
+                    if images[0] is None:
+                        images[0] = Image.new(mode, (width, height))
+                    image = images[0]
+                    image.fromstring(arrays[cur])
+                side = 1 if image is images[0] else 0
+                if images[side] is None:
+                    images[side] = Image.new(mode, (width, height))
+                if not f.keep_source and filter_takes_output(f):
+                    result = f(image, images[side])
+                elif image is img and target is not img:
+                    # 输入不能被修改，拷到另一张Image上再原地执行
+                    result = f(copy_to(image, images[side]), inplace=True)
+                else:
+                    result = f(image, inplace=True)
+                if result.size != (width, height) or result.mode != mode:
+                    # 尺寸或者模式变了，剩下的阶段直接顺序执行
+                    for f in stages[index + 1:]:
+                        result = f(result)
+                    return deliver(result, target)
+                image = result
+                continue
+
+            if Effect.instrument is not None:
+                wall, cpu = time.time(), time.clock()
+            if image is not None:
+                data = numpy.frombuffer(image.tostring(), numpy.uint8).reshape(shape)
+                if arrays[cur] is not None and arrays[cur].flags.writeable:
+                    arrays[cur][...] = data
+                else:
+                    # 只读的数组，只作为源
+                    arrays[cur] = data
+                image = None
+            dst = 1 - cur
+            if arrays[dst] is None or not arrays[dst].flags.writeable:
+                arrays[dst] = None
+                arrays[dst] = numpy.empty(shape, numpy.uint8)
+            f.prepare(width, height)
+            f.init_output(arrays[cur], arrays[dst])
+            f.render_rows(arrays[cur], arrays[dst], 0, height)
+            cur = dst
+            if Effect.instrument is not None:
+                frame = Frame(mode, (width, height))
+                Effect.instrument.record(f, frame, frame, time.time() - wall, time.clock() - cpu)
+
+        if image is not None:
+            return deliver(image, target)
+        if target is None:
+            target = images[0] if images[0] is not None else images[1]
+        return deliver_array(arrays[cur], mode, target)
+
+    def filter_batch(self, images, batch_size=16):
+        # 各个阶段的生成器串起来，每个阶段同时最多只持有batch_size张图片
+        for f in self.stages():
+            images = f.filter_batch(images, batch_size)
+        return images
+
+    def draft(self, scale=1):
+        effects = [f.draft(scale) for f in self.effect_pipeline]
+        if None in effects:
+            return None
+        if all(d is f for d, f in zip(effects, self.effect_pipeline)):
+            return self
+        glue = copy.copy(self)
+        glue.effect_pipeline = effects
+        return glue
         
 
 class GridMaker(Effect):
@@ -411,7 +2242,8 @@ class GridMaker(Effect):
         self.height_offset = height_offset
         self.color = color
 
-    def filter(self, img):
+    def filter(self, img, out=None, inplace=False):
+        img = copy_to(img, output_target(img, out, inplace))
         width, height = img.size
 
         # draw grid
@@ -436,7 +2268,8 @@ class TextWriter(Effect):
             raise NotEmplementedError
         self.font = font
 
-    def filter(self, img):
+    def filter(self, img, out=None, inplace=False):
+        img = copy_to(img, output_target(img, out, inplace))
         draw = ImageDraw.Draw(img) 
         draw.text((self.x, self.y), self.text, self.color)
         del draw
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author:  Hua Liang [ Stupid ET ]
+# email:   et@everet.org
+# website: http://EverET.org
+#
+# 输出阶段：把结果编码成JPEG、PNG或者WebP
+#
+# 每一帧都 save('....jpg', quality=90) 时，编码往往比特效本身还慢。这里：
+#   * 每个线程有一块可以重复使用的内存缓冲区，不用每帧新建StringIO；
+#   * 按格式预设了几组参数，默认 'fast' 关掉optimize、progressive这些很慢的选项；
+#   * 对比图（原图 | 结果）直接贴到一张重复使用的画布上，不用每帧分配两倍宽的新图片。
+#     输出JPEG时画布是RGB，编码前也不用再转换一次。
+#
+#   encoder = Encoder('JPEG', 'fast')
+#   data = encoder.encode(img)
+#   encoder.save(encoder.comparison(img, effect(img)), 'tmp/0.jpg')
+
+import threading
+from cStringIO import StringIO
+import Image, ImageFile, ImageDraw
+
+Image.init()
+
+# 每种格式的预设参数，没有列出的参数使用PIL的默认值。
+# 老版本PIL不认识的参数（compress_level等）会被忽略。
+PRESETS = {
+    'JPEG': {
+        'fast': dict(quality=85),
+        'balanced': dict(quality=90, optimize=True),
+        'small': dict(quality=80, optimize=True, progressive=True),
+        'quality': dict(quality=95, subsampling=0),
+        },
+    'PNG': {
+        'fast': dict(compress_level=1),
+        'balanced': dict(compress_level=6),
+        'small': dict(compress_level=9, optimize=True),
+        },
+    'WEBP': {
+        'fast': dict(quality=80, method=0),
+        'balanced': dict(quality=80, method=4),
+        'small': dict(quality=75, method=6),
+        'quality': dict(quality=95, method=4),
+        'lossless': dict(lossless=True, method=0),
+        },
+    }
+
+# 老版本PIL只看有没有这些参数，optimize=False也会打开优化，所以值为假时要去掉
+FLAGS = ('optimize', 'progressive', 'progression', 'lossless')
+
+# 各种格式可以直接写的模式，其他模式先转换成第一个
+MODES = {
+    'JPEG': ('RGB', 'L', 'CMYK'),
+    'PNG': ('RGB', 'RGBA', 'L', 'LA', 'P', '1', 'I'),
+    'WEBP': ('RGB', 'RGBA'),
+    }
+
+
+def formats():
+    '''这个PIL支持的预设格式'''
+    return sorted(f for f in PRESETS if f in Image.SAVE)
+
+
+class Encoder(object):
+    '''把图片编码成某种格式
+    一个Encoder可以在多个线程中同时使用，每个线程有自己的缓冲区和画布。
+    @param format 'JPEG'、'PNG'或者'WEBP'
+    @param preset PRESETS中的预设名
+    @param options 额外传给Image.save的参数，覆盖预设中的同名参数
+    '''
+    def __init__(self, format='JPEG', preset='fast', **options):
+        format = format.upper()
+        if format == 'JPG':
+            format = 'JPEG'
+        if format not in Image.SAVE:
+            raise ValueError('PIL was built without %s support' % format)
+        presets = PRESETS.get(format, {})
+        if preset not in presets:
+            raise ValueError('unknown %s preset %r, expected one of %s'
+                             % (format, preset, ', '.join(sorted(presets))))
+        self.format = format
+        self.preset = preset
+        self.options = dict(presets[preset], **options)
+        for flag in FLAGS:
+            if not self.options.get(flag, True):
+                del self.options[flag]
+        self.local = threading.local()
+
+    @property
+    def buffer(self):
+        '''当前线程的缓冲区，每次使用前清空，已经分配的内存会保留'''
+        buf = getattr(self.local, 'buffer', None)
+        if buf is None:
+            buf = self.local.buffer = StringIO()
+        buf.seek(0)
+        buf.truncate()
+        return buf
+
+    def prepare(self, img):
+        modes = MODES.get(self.format)
+        if modes and img.mode not in modes:
+            img = img.convert(modes[0])
+        if self.format == 'JPEG' and ('optimize' in self.options or 'progressive' in self.options):
+            # 老版本PIL写优化或者渐进的JPEG时，整张图要能放进一个编码块
+            width, height = img.size
+            ImageFile.MAXBLOCK = max(ImageFile.MAXBLOCK, width * height * len(img.getbands()))
+        return img
+
+    def encode(self, img):
+        '''@return 编码后的数据'''
+        buf = self.buffer
+        self.prepare(img).save(buf, self.format, **self.options)
+        return buf.getvalue()
+
+    def write(self, img, fp):
+        '''编码到打开的文件中，真正的文件由PIL直接写入，不经过缓冲区'''
+        self.prepare(img).save(fp, self.format, **self.options)
+
+    def save(self, img, path):
+        with open(path, 'wb') as f:
+            self.write(img, f)
+
+    @property
+    def canvas_mode(self):
+        return 'RGB' if self.format == 'JPEG' else 'RGBA'
+
+    def comparison(self, left, right, divider=(255, 0, 0, 255)):
+        '''左边left、右边right的对比图，中间画一条分隔线
+        返回的画布会被当前线程下一次调用重复使用，需要保留时请copy()。
+        '''
+        width, height = left.size
+        size = (width + right.size[0], max(height, right.size[1]))
+        mode = self.canvas_mode
+        canvases = getattr(self.local, 'canvases', None)
+        if canvases is None:
+            canvases = self.local.canvases = {}
+        canvas = canvases.get((mode, size))
+        if canvas is None:
+            canvas = canvases[(mode, size)] = Image.new(mode, size)
+        elif left.size[1] != right.size[1]:
+            # 高度不同时，较矮的一边下面要清空
+            canvas.paste(0, (0, 0) + size)
+        canvas.paste(left, (0, 0))
+        canvas.paste(right, (width, 0))
+        ImageDraw.Draw(canvas).line((width, 0, width, size[1]), divider[:len(mode)])
+        return canvas
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author:  Hua Liang [ Stupid ET ]
+# email:   et@everet.org
+# website: http://EverET.org
+#
+# 字符串形式的变换方程
+#
+# 用lambda写的方程里常常用到math.cos这样只接受标量的函数，只能逐个像素调用。
+# 这里把 "r ** 1.5 * cos(r), phi" 这样的字符串解析一次，编译成两个函数：
+# 一个使用math，供纯Python后端逐点调用；一个使用NumPy，整张图一次算完。
+#
+#   LensWarpEffect('x * abs(x), y * abs(y)')
+#   RadianFormulaEffect('r ** 1.5 * cos(r), phi')
+#   RegionWarpEffect('x + 0.2 * y, y', box=(20, 20, 80, 80))
+#
+# 方程只能使用变量、数字、四则运算、乘方、比较、a if c else b 以及下面列出的函数和常量。
+
+import ast, math, __future__
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def scalar_where(condition, a, b):
+    return a if condition else b
+
+
+def float32_list(values):
+    '''把一组标量一次舍入到float32的精度，与numpy的astype(numpy.float32)一致'''
+    return array('f', values).tolist()
+
+
+def polar_coords(x, y):
+    '''规范化的直角坐标 => 极坐标 (r, phi)，x和y可以是标量，也可以是numpy数组
+    r和phi都舍入到float32的精度，与径向特效共用的float32网格（见Effect.polar_grid）一致，
+    所以各个后端的结果完全相同。
+    '''
+    if numpy is not None and isinstance(x, numpy.ndarray):
+        return (numpy.sqrt(x ** 2 + y ** 2).astype(numpy.float32).astype(float),
+                numpy.arctan2(y, x).astype(numpy.float32).astype(float))
+    return tuple(float32_list((math.sqrt(x ** 2 + y ** 2), math.atan2(y, x))))
+
+
+# 方程中可以使用的名字 => (标量版本, NumPy版本)
+FUNCTIONS = {
+    'sqrt': (math.sqrt, 'sqrt'),
+    'sin': (math.sin, 'sin'),
+    'cos': (math.cos, 'cos'),
+    'tan': (math.tan, 'tan'),
+    'asin': (math.asin, 'arcsin'),
+    'acos': (math.acos, 'arccos'),
+    'atan': (math.atan, 'arctan'),
+    'atan2': (math.atan2, 'arctan2'),
+    'sinh': (math.sinh, 'sinh'),
+    'cosh': (math.cosh, 'cosh'),
+    'tanh': (math.tanh, 'tanh'),
+    'exp': (math.exp, 'exp'),
+    'log': (math.log, 'log'),
+    'log10': (math.log10, 'log10'),
+    'floor': (math.floor, 'floor'),
+    'ceil': (math.ceil, 'ceil'),
+    'hypot': (math.hypot, 'hypot'),
+    'abs': (abs, 'abs'),
+    'min': (min, 'minimum'),
+    'max': (max, 'maximum'),
+    'where': (scalar_where, 'where'),
+    }
+
+CONSTANTS = {'pi': math.pi, 'e': math.e}
+
+# 允许出现的语法结构
+OPERATORS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow,
+             ast.UAdd, ast.USub,
+             ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.Eq, ast.NotEq)
+NODES = (ast.Expression, ast.Tuple, ast.BinOp, ast.UnaryOp, ast.Compare, ast.IfExp,
+         ast.Call, ast.Name, ast.Num, ast.Load) + OPERATORS
+
+
+def namespace(vectorized):
+    '''编译方程时使用的全局名字空间'''
+    ns = dict(CONSTANTS, __builtins__={})
+    for name, (scalar, vector) in FUNCTIONS.iteritems():
+        ns[name] = getattr(numpy, vector) if vectorized else scalar
+    return ns
+
+
+class ConditionToWhere(ast.NodeTransformer):
+    '''a if c else b => where(c, a, b)，a < b < c => (a < b) & (b < c)，这样对NumPy数组也成立
+    Python的连续比较要对中间结果求真假，数组会抛出"truth value is ambiguous"。
+    where会先算出两个分支，所以只用于NumPy版本，标量版本保留原来的a if c else b，
+    'sqrt(x) if x >= 0 else -sqrt(-x)'这样用条件保护的分支不会出错。
+    '''
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        if len(node.ops) == 1:
+            return node
+        operands = [node.left] + node.comparators
+        result = None
+        for op, left, right in zip(node.ops, operands, operands[1:]):
+            pair = ast.Compare(left=left, ops=[op], comparators=[right])
+            result = pair if result is None else ast.BinOp(left=result, op=ast.BitAnd(), right=pair)
+        return ast.copy_location(result, node)
+
+    def visit_IfExp(self, node):
+        self.generic_visit(node)
+        call = ast.Call(func=ast.Name(id='where', ctx=ast.Load()),
+                        args=[node.test, node.body, node.orelse],
+                        keywords=[], starargs=None, kwargs=None)
+        return ast.copy_location(call, node)
+
+
+class Formula(object):
+    '''解析好的变换方程，可以像原来的lambda一样调用
+    参数是标量时使用math计算，是NumPy数组时整个数组一起计算。
+    @param expression 方程，如 "r ** 1.5, phi"，结果的个数必须与变量的个数相同
+    @param variables 变量名
+    @param polar 为True时变量是极坐标 (r, phi)，调用时输入输出的都是直角坐标 (x, y)，
+                 可以直接交给LensWarpEffect，结果与RadianFormulaEffect完全相同
+    '''
+    def __init__(self, expression, variables=('x', 'y'), polar=False):
+        self.expression = expression
+        self.variables = tuple(variables)
+        self.polar = polar
+        if polar and len(self.variables) != 2:
+            raise ValueError('polar formulas take exactly two variables (r, phi)')
+
+        self.scalar = eval(self.compile(), namespace(False))
+        self.vector = eval(self.compile(True), namespace(True)) if numpy is not None else None
+        if polar:
+            self.scalar = self.wrap_polar(self.scalar, math.cos, math.sin)
+            if self.vector is not None:
+                self.vector = self.wrap_polar(self.vector, numpy.cos, numpy.sin)
+
+    def compile(self, vectorized=False):
+        '''检查方程的语法，编译成 lambda 变量: (方程)
+        @param vectorized 为True时编译NumPy版本，条件表达式和连续比较换成数组运算
+        '''
+        try:
+            tree = ast.parse(self.expression.strip(), '<formula>', 'eval')
+        except SyntaxError, e:
+            raise ValueError('invalid formula %r: %s' % (self.expression, e.msg))
+
+        allowed = set(self.variables) | set(FUNCTIONS) | set(CONSTANTS)
+        for node in ast.walk(tree):
+            if not isinstance(node, NODES):
+                raise ValueError('invalid formula %r: %s is not allowed'
+                                 % (self.expression, node.__class__.__name__))
+            if isinstance(node, ast.Name) and node.id not in allowed:
+                raise ValueError('invalid formula %r: unknown name %r' % (self.expression, node.id))
+            if isinstance(node, ast.Call) and (not isinstance(node.func, ast.Name)
+                                               or node.func.id not in FUNCTIONS
+                                               or node.keywords or node.starargs or node.kwargs):
+                raise ValueError('invalid formula %r: only plain calls of %s are allowed'
+                                 % (self.expression, ', '.join(sorted(FUNCTIONS))))
+        outputs = len(tree.body.elts) if isinstance(tree.body, ast.Tuple) else 1
+        if outputs != len(self.variables):
+            raise ValueError('formula %r gives %d values, expected %d'
+                             % (self.expression, outputs, len(self.variables)))
+
+        body = ConditionToWhere().visit(tree.body) if vectorized else tree.body
+        args = ast.arguments(args=[ast.Name(id=name, ctx=ast.Param()) for name in self.variables],
+                             vararg=None, kwarg=None, defaults=[])
+        tree = ast.Expression(body=ast.Lambda(args=args, body=body))
+        ast.fix_missing_locations(tree)
+        # 与用户的直觉一致，1 / 2 是0.5
+        return compile(tree, '<formula>', 'eval', __future__.division.compiler_flag, True)
+
+    @staticmethod
+    def wrap_polar(formula, cos, sin):
+        def cartesian(x, y):
+            r, phi = formula(*polar_coords(x, y))
+            return r * cos(phi), r * sin(phi)
+        return cartesian
+
+    def __call__(self, *args):
+        if self.vector is not None and isinstance(args[0], numpy.ndarray):
+            # where的两个分支都会计算，被条件排除的那一边出现的NaN和除零不用警告
+            with numpy.errstate(invalid='ignore', divide='ignore'):
+                return self.vector(*args)
+        return self.scalar(*args)
+
+    def key(self):
+        return (self.expression, self.variables, self.polar)
+
+    def __eq__(self, other):
+        return isinstance(other, Formula) and self.key() == other.key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __reduce__(self):
+        # 编译出的函数不能pickle，传给其他进程时只传方程本身
+        return (Formula, self.key())
+
+    def __repr__(self):
+        return 'Formula(%r, %r%s)' % (self.expression, self.variables,
+                                      ', polar=True' if self.polar else '')
+
+
+def as_formula(formula, variables=('x', 'y')):
+    '''字符串编译成Formula，函数原样返回'''
+    if isinstance(formula, basestring):
+        return Formula(formula, variables)
+    return formula
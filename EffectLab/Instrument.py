@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author:  Hua Liang [ Stupid ET ]
+# email:   et@everet.org
+# website: http://EverET.org
+#
+# 特效的性能统计
+#
+# 打开之后，每次调用Effect（包括EffectGlue中的每个阶段）都会记录一次：
+# 墙上时间、CPU时间、处理的像素数以及新分配的图片大小，交给接收者（sink）处理。
+# 没有打开时Effect.__call__只多一次属性判断，几乎没有开销。
+#
+#   stats = Instrument.enable(Instrument.StatsSink())
+#   ...
+#   print stats.report()
+#   Instrument.disable()
+
+import math, threading, logging
+import Image
+
+from Effect import Effect
+
+
+def effect_key(effect):
+    '''统计时区分特效的名字，实例自己设置了name的（例如EffectGlue）会带上name'''
+    name = effect.__class__.__name__
+    if 'name' in effect.__dict__:
+        name = '%s(%s)' % (name, effect.name)
+    return name
+
+
+class Sample(object):
+    '''一次特效调用的记录'''
+    __slots__ = ('effect', 'wall', 'cpu', 'pixels', 'nbytes')
+
+    def __init__(self, effect, img, out, wall, cpu, target=None):
+        self.effect = effect_key(effect)
+        self.wall = wall
+        self.cpu = cpu
+        width, height = img.size
+        self.pixels = width * height
+        # 原地修改或者写入调用者给出的图片时，特效没有分配新的图片
+        self.nbytes = 0
+        if out is not img and out is not target and isinstance(out, Image.Image):
+            width, height = out.size
+            self.nbytes = width * height * Image.getmodebands(out.mode)
+
+
+class Sink(object):
+    '''接收者的基类，子类实现add(sample)'''
+    def record(self, effect, img, out, wall, cpu, target=None):
+        self.add(Sample(effect, img, out, wall, cpu, target))
+
+    def add(self, sample):
+        raise NotImplementedError
+
+
+class Histogram(object):
+    '''以2为底按对数分桶的直方图，单位是微秒'''
+    def __init__(self):
+        self.buckets = {}
+
+    def add(self, seconds):
+        us = max(1.0, seconds * 1e6)
+        bucket = int(math.log(us, 2))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def items(self):
+        '''[(下界微秒, 上界微秒, 次数)]'''
+        return [(2 ** b, 2 ** (b + 1), self.buckets[b]) for b in sorted(self.buckets)]
+
+
+class EffectStats(object):
+    '''一个特效的累计统计'''
+    def __init__(self):
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.pixels = 0
+        self.nbytes = 0
+        self.wall_histogram = Histogram()
+        self.cpu_histogram = Histogram()
+
+    def add(self, sample):
+        self.calls += 1
+        self.wall += sample.wall
+        self.cpu += sample.cpu
+        self.pixels += sample.pixels
+        self.nbytes += sample.nbytes
+        self.wall_histogram.add(sample.wall)
+        self.cpu_histogram.add(sample.cpu)
+
+
+class StatsSink(Sink):
+    '''在内存中按特效累计统计，可以在多个线程中同时使用'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def add(self, sample):
+        with self.lock:
+            stats = self.stats.get(sample.effect)
+            if stats is None:
+                stats = self.stats[sample.effect] = EffectStats()
+            stats.add(sample)
+
+    def clear(self):
+        with self.lock:
+            self.stats.clear()
+
+    def report(self):
+        lines = ['%-40s %8s %12s %12s %10s %10s' % (
+            'effect', 'calls', 'wall ms/call', 'cpu ms/call', 'MPix/s', 'MB alloc')]
+        with self.lock:
+            for name in sorted(self.stats, key=lambda n: -self.stats[n].wall):
+                s = self.stats[name]
+                lines.append('%-40s %8d %12.3f %12.3f %10.2f %10.1f' % (
+                    name, s.calls, s.wall / s.calls * 1000, s.cpu / s.calls * 1000,
+                    s.pixels / 1e6 / s.wall if s.wall else 0, s.nbytes / 1e6))
+        return '\n'.join(lines)
+
+
+class LogSink(Sink):
+    '''把每次调用写到日志中'''
+    def __init__(self, logger=None, level=logging.DEBUG):
+        self.logger = logger or logging.getLogger('EffectLab.Instrument')
+        self.level = level
+
+    def add(self, sample):
+        self.logger.log(self.level, '%s: %.3f ms wall, %.3f ms cpu, %d pixels, %d bytes',
+                        sample.effect, sample.wall * 1000, sample.cpu * 1000,
+                        sample.pixels, sample.nbytes)
+
+
+class CallbackSink(Sink):
+    '''把每次调用的Sample交给callback，可以用来对接外部的监控系统'''
+    def __init__(self, callback):
+        self.callback = callback
+
+    def add(self, sample):
+        self.callback(sample)
+
+
+class MultiSink(Sink):
+    '''同时交给多个接收者'''
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+    def add(self, sample):
+        for sink in self.sinks:
+            sink.add(sample)
+
+
+def enable(sink):
+    '''打开统计，返回sink'''
+    Effect.instrument = sink
+    return sink
+
+
+def disable():
+    Effect.instrument = None
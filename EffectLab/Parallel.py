@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author:  Hua Liang [ Stupid ET ]
+# email:   et@everet.org
+# website: http://EverET.org
+#
+# 多进程分块渲染：把输出图按行分成若干块，交给进程池中的多个进程同时计算。
+# 源图和结果都放在共享内存中，进程之间只传递行号，图片本身不需要pickle。
+
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+
+from Effect import EffectGlue, numpy, image_to_array, array_to_image
+
+# 子进程中的状态，由进程池的initializer设置。
+# 进程池是fork出来的，特效（包括其中的lambda）和已经生成的映射表都直接继承。
+_worker = {}
+
+
+def _init_worker(stages, buffers, shape):
+    _worker['stages'] = stages
+    _worker['buffers'] = [numpy.frombuffer(b, numpy.uint8).reshape(shape)
+                          for b in buffers]
+
+
+def _render_band(task):
+    index, src, dst, top, bottom = task
+    buffers = _worker['buffers']
+    _worker['stages'][index].render_rows(buffers[src], buffers[dst], top, bottom)
+
+
+class TiledRenderer(object):
+    '''把特效或者EffectGlue按行分块，在进程池中并行渲染
+    结果与单进程渲染逐字节一致。不能分块的特效在主进程中整张计算。
+    '''
+    def __init__(self, workers=None, tile_height=64):
+        '''
+        @param workers 进程数，默认为CPU核数
+        @param tile_height 每一块的行数，会向上对齐到特效要求的行数
+        '''
+        self.workers = workers or multiprocessing.cpu_count()
+        self.tile_height = tile_height
+
+    def bands(self, height, align):
+        step = max(1, (self.tile_height + align - 1) // align) * align
+        return [(top, min(height, top + step)) for top in xrange(0, height, step)]
+
+    def render(self, effect, img):
+        if isinstance(effect, EffectGlue):
+            stages = effect.stages()
+        else:
+            stages = [effect]
+        if numpy is None or not any(f.tileable for f in stages):
+            return effect(img)
+
+        width, height = img.size
+        mode = img.mode
+        src = image_to_array(img)
+
+        # 在fork之前生成映射表，子进程直接继承
+        for f in stages:
+            if f.tileable:
+                f.prepare(width, height)
+
+        # 两块共享内存轮流作为源图和结果
+        buffers = [RawArray('B', src.size) for i in xrange(2)]
+        arrays = [numpy.frombuffer(b, numpy.uint8).reshape(src.shape) for b in buffers]
+        arrays[0][:] = src
+        cur = 0
+
+        pool = multiprocessing.Pool(self.workers, _init_worker,
+                                    (stages, buffers, src.shape))
+        try:
+            for index, f in enumerate(stages):
+                if not f.tileable:
+                    img = f.filter(array_to_image(arrays[cur], mode))
+                    if img.size != (width, height) or img.mode != mode:
+                        # 尺寸或者模式变了，剩下的阶段直接顺序执行
+                        for f in stages[index + 1:]:
+                            img = f.filter(img)
+                        return img
+                    arrays[cur][:] = image_to_array(img)
+                    continue
+
+                dst = 1 - cur
+                f.init_output(arrays[cur], arrays[dst])
+                tasks = [(index, cur, dst, top, bottom)
+                         for top, bottom in self.bands(height, f.tile_align)]
+                pool.map(_render_band, tasks, chunksize=1)
+                cur = dst
+        finally:
+            pool.close()
+            pool.join()
+
+        return array_to_image(arrays[cur], mode)
+
+
+def render_tiled(effect, img, workers=None, tile_height=64):
+    '''用TiledRenderer渲染一张图'''
+    return TiledRenderer(workers, tile_height).render(effect, img)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author:  Hua Liang [ Stupid ET ]
+# email:   et@everet.org
+# website: http://EverET.org
+#
+# 流式处理大量图片：读取 -> 特效 -> 写出，每个阶段在各自的线程中运行，
+# 阶段之间用有界队列连接，所以内存占用只与队列长度有关，与图片总数无关。
+# PIL的解码、编码以及NumPy、C语言核心的计算都会释放GIL，线程之间可以重叠I/O与计算。
+
+import os, sys, threading, Queue
+import Image
+
+from Effect import EffectGlue
+
+# 队列中表示结束的标记
+_DONE = object()
+
+
+def open_images(paths):
+    '''把文件路径变成Pipeline的输入，图片在读取线程中才打开'''
+    for path in paths:
+        yield path, path
+
+
+def file_sink(directory, ext='.jpg', encoder=None, **options):
+    '''生成一个把结果保存到directory中的sink，options会传给Image.save
+    @param encoder Encoder.Encoder，给出时用它编码，options被忽略
+    '''
+    def sink(key, img):
+        name = os.path.splitext(os.path.basename(str(key)))[0]
+        path = os.path.join(directory, name + ext)
+        if encoder is not None:
+            encoder.save(img, path)
+        else:
+            img.save(path, **options)
+    return sink
+
+
+class Pipeline(object):
+    '''source -> effect -> sink 的流式处理管道
+
+    source中的每一项可以是Image、文件路径，或者 (key, Image或文件路径)。
+    读取线程打开并解码图片，最多预读prefetch张；
+    workers个线程对图片应用特效；
+    写出线程调用sink(key, img)保存结果，最多积压write_queue张。
+    '''
+    def __init__(self, effect, prefetch=8, workers=2, write_queue=8):
+        '''
+        @param effect 一个Effect，也可以是Effect的列表，会用EffectGlue串起来
+        '''
+        if isinstance(effect, (list, tuple)):
+            glue = EffectGlue()
+            for f in effect:
+                glue.append(f)
+            effect = glue
+        self.effect = effect
+        self.prefetch = prefetch
+        self.workers = workers
+        self.write_queue = write_queue
+
+    def run(self, source, sink):
+        '''处理source中的所有图片，结果在写出线程中交给sink，返回处理的张数'''
+        output = Queue.Queue(self.write_queue)
+        state = self._start(source, output)
+        count = [0]
+
+        def writer():
+            finished = 0
+            try:
+                while finished < self.workers:
+                    item = output.get()
+                    if item is _DONE:
+                        finished += 1
+                        continue
+                    sink(*item)
+                    count[0] += 1
+            except Exception:
+                state['fail']()
+                # 继续取走队列中的结果，让计算线程可以退出
+                while finished < self.workers:
+                    if output.get() is _DONE:
+                        finished += 1
+
+        thread = threading.Thread(target=writer)
+        thread.start()
+        thread.join()
+        self._finish(state)
+        return count[0]
+
+    def results(self, source):
+        '''以生成器的形式返回 (key, 处理后的Image)，顺序与source不一定相同'''
+        output = Queue.Queue(self.write_queue)
+        state = self._start(source, output)
+        finished = 0
+        try:
+            while finished < self.workers:
+                item = output.get()
+                if item is _DONE:
+                    finished += 1
+                    continue
+                yield item
+        finally:
+            # 提前结束时让各个线程退出
+            state['stop'].set()
+            while finished < self.workers:
+                if output.get() is _DONE:
+                    finished += 1
+            self._finish(state)
+
+    def _start(self, source, output):
+        decoded = Queue.Queue(self.prefetch)
+        stop = threading.Event()
+        state = {'error': None, 'stop': stop}
+
+        def put(queue, item):
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def fail():
+            if state['error'] is None:
+                state['error'] = sys.exc_info()
+            stop.set()
+
+        def reader():
+            try:
+                for item in source:
+                    key, img = item if isinstance(item, tuple) else (item, item)
+                    if isinstance(img, basestring):
+                        img = Image.open(img)
+                        img.load()
+                    if not put(decoded, (key, img)):
+                        break
+            except Exception:
+                fail()
+            for i in xrange(self.workers):
+                decoded.put(_DONE)
+
+        def worker():
+            try:
+                while True:
+                    item = decoded.get()
+                    if item is _DONE:
+                        break
+                    if stop.is_set():
+                        continue
+                    key, img = item
+                    put(output, (key, self.effect(img)))
+            except Exception:
+                fail()
+                # 取走剩下的输入直到结束标记，让读取线程可以退出
+                while decoded.get() is not _DONE:
+                    pass
+            output.put(_DONE)
+
+        threads = [threading.Thread(target=reader)]
+        threads += [threading.Thread(target=worker) for i in xrange(self.workers)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        state['threads'] = threads
+        state['fail'] = fail
+        return state
+
+    def _finish(self, state):
+        for t in state['threads']:
+            t.join()
+        if state['error']:
+            raise state['error'][0], state['error'][1], state['error'][2]
+
+
+def stream(effect, source, sink, **options):
+    '''用Pipeline处理source中的所有图片，options会传给Pipeline'''
+    return Pipeline(effect, **options).run(source, sink)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author:  Hua Liang [ Stupid ET ]
+# email:   et@everet.org
+# website: http://EverET.org
+#
+# 内存映射的原始像素文件，用于比内存还大的图片
+#
+# 特效的输入输出都是解码好的整张Image，再加上copy和映射表，一张扫描的大图要占用好几倍的内存。
+# 这里的图片放在没有压缩的原始文件中，用numpy.memmap映射到内存：
+# 只有被访问到的部分才会读入，写出的部分由操作系统写回文件。
+# render_mapped按行分块渲染，每一块的映射表只为这些行生成，用完就丢弃，
+# 所以常驻内存只与块的大小有关，与图片大小无关。
+#
+#   src = RawImage.from_image(Image.open('scan.tif'), 'scan.raw')
+#   out = RawImage.create('warped.raw', src.mode, src.size)
+#   LensWarpEffect('x * abs(x), y * abs(y)').filter_mapped(src, out)
+#   out.crop((0, 0, 1024, 1024)).save('corner.png')
+#
+# 文件本身只有像素，行优先、每个通道一个字节。模式和尺寸记录在旁边的 <文件名>.json 中，
+# 格式与Atlas保存的raw图集一样。
+
+import os, json
+import Image
+
+from Effect import numpy, image_to_array, array_to_image, WarpEffect
+
+# render_mapped默认每块的像素数。抗锯齿时每个像素有antialias ** 2个采样点，
+# 生成一块映射表的临时数组大约是每个采样点几十字节
+TILE_PIXELS = 256 * 1024
+
+
+class RawImage(object):
+    '''磁盘上的原始像素文件
+    array是 height x width x bands 的numpy.memmap，可以直接交给特效的render_rows。
+    '''
+    def __init__(self, path, mode, size, writable=False, offset=0):
+        if numpy is None:
+            raise ImportError('RawImage needs NumPy')
+        self.path = path
+        self.mode = mode
+        self.size = tuple(size)
+        width, height = self.size
+        self.array = numpy.memmap(path, numpy.uint8, 'r+' if writable else 'r', offset,
+                                  (height, width, Image.getmodebands(mode)))
+
+    @staticmethod
+    def manifest_path(path):
+        return path + '.json'
+
+    @classmethod
+    def create(cls, path, mode, size):
+        '''新建一个可写的文件，文件是稀疏的，没有写过的像素全是0'''
+        width, height = size
+        with open(path, 'wb') as f:
+            f.truncate(width * height * Image.getmodebands(mode))
+        with open(cls.manifest_path(path), 'w') as f:
+            json.dump(dict(image=os.path.basename(path), format='raw',
+                           mode=mode, size=list(size)), f, indent=1, sort_keys=True)
+        return cls(path, mode, size, writable=True)
+
+    @classmethod
+    def open(cls, path, writable=False):
+        '''打开create生成的文件，模式和尺寸从清单中读取'''
+        with open(cls.manifest_path(path)) as f:
+            manifest = json.load(f)
+        return cls(path, str(manifest['mode']), manifest['size'], writable)
+
+    @classmethod
+    def from_image(cls, img, path, tile_height=256):
+        '''把Image写成原始文件，每次只转换tile_height行'''
+        raw = cls.create(path, img.mode, img.size)
+        width, height = img.size
+        for top in xrange(0, height, tile_height):
+            bottom = min(height, top + tile_height)
+            raw.array[top:bottom] = image_to_array(img.crop((0, top, width, bottom)))
+        raw.flush()
+        return raw
+
+    @property
+    def nband(self):
+        return self.array.shape[2]
+
+    def crop(self, box):
+        '''box中的像素，返回一张新的Image'''
+        left, top, right, bottom = box
+        return array_to_image(self.array[top:bottom, left:right], self.mode)
+
+    def paste(self, img, origin=(0, 0)):
+        '''把与自己模式相同的img写到origin处'''
+        if img.mode != self.mode:
+            img = img.convert(self.mode)
+        x, y = origin
+        width, height = img.size
+        self.array[y:y + height, x:x + width] = image_to_array(img)
+
+    def image(self):
+        '''整张图读入内存，只适用于放得下的图片'''
+        return self.crop((0, 0) + self.size)
+
+    def flush(self):
+        self.array.flush()
+
+    def close(self):
+        self.flush()
+        mm = getattr(self.array, '_mmap', None)
+        self.array = None
+        if mm is not None:
+            mm.close()
+
+
+def render_mapped(effect, src, out, tile_height=None):
+    '''把effect作用在RawImage src上，结果写入RawImage out
+    out与src的模式、尺寸必须相同。每块tile_height行，默认每块大约TILE_PIXELS个像素，
+    写完一块就写回文件。
+    只支持WarpEffect（LensWarpEffect、RegionWarpEffect、PerspectiveWarpEffect等），
+    需要NumPy或者C语言核心。
+    '''
+    if not isinstance(effect, WarpEffect):
+        raise TypeError('render_mapped needs a WarpEffect, got %s' % effect.__class__.__name__)
+    if effect.active_backend == 'python':
+        raise ValueError('render_mapped needs the core or numpy backend')
+    if src.size != out.size or src.mode != out.mode:
+        raise ValueError('src is %s %r but out is %s %r' % (src.mode, src.size, out.mode, out.size))
+
+    width, height = src.size
+    if tile_height is None:
+        tile_height = max(1, TILE_PIXELS // width)
+    align = effect.tile_align
+    step = max(1, (tile_height + align - 1) // align) * align
+    for top in xrange(0, height, step):
+        bottom = min(height, top + step)
+        effect.init_output(src.array[top:bottom], out.array[top:bottom])
+        effect.render_tile(src.array, out.array, top, bottom)
+        out.flush()
+    return out
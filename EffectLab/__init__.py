@@ -7,3 +7,12 @@
 # The latter version will put some part into C Module for better performance.
 
 import Effect
+import Parallel
+import Pipeline
+import Instrument
+import Cache
+import Atlas
+import Formula
+import Captcha
+import Encoder
+import RawImage
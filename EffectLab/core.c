@@ -1,386 +1,499 @@
 #include <Python.h>
 #include <stdio.h>
 #include <math.h>
-#include "ImPlatform.h" 
+#include "ImPlatform.h"
+
+/*
+ * EffectLab的C语言核心
+ *
+ * 所有的函数都直接操作连续的像素缓冲区（height x width x bands的uint8），
+ * 不依赖PIL内部的数据结构，所以PIL的版本变了也不会出问题。
+ * 计算的过程中不需要调用Python，因此会释放GIL，可以在多个线程中同时运行。
+ */
+
+#define MAX_BANDS 4
+
+
+/* 按照映射表取样并求平均
+ * index是 nsamples x npixels 的int32数组，-1表示该子采样点落在图外
+ * found是每个像素有效子采样点的个数
+ * box是结果写入out中的区域，没有有效采样点的像素保持out原来的值
+ * 只处理box中位于rows = (top, bottom)之间的行，方便分块并行
+ */
+static PyObject* remap(PyObject *self, PyObject *args)
+{
+    Py_buffer src, index, found, out;
+    int width, height, bands, nsamples;
+    int left, top, right, bottom, rowtop, rowbottom;
+    int boxwidth, npixels;
+    int i, s, b, x, y;
+    const UINT8 *in;
+    const INT32 *idx, *cnt;
+    UINT8 *pixel;
+    int sum[MAX_BANDS];
+
+    if (!PyArg_ParseTuple(args, "s*iiis*s*i(iiii)(ii)w*",
+                          &src, &width, &height, &bands,
+                          &index, &found, &nsamples,
+                          &left, &top, &right, &bottom,
+                          &rowtop, &rowbottom,
+                          &out))
+    {
+        return NULL;
+    }
 
-/* 1.1.9 pil */
+    boxwidth = right - left;
+    npixels = boxwidth * (bottom - top);
 
-typedef struct ImagingMemoryInstance* Imaging; 
-typedef struct ImagingAccessInstance* ImagingAccess;
-typedef struct ImagingPaletteInstance* ImagingPalette;
+    if (bands < 1 || bands > MAX_BANDS
+        || src.len < (Py_ssize_t)width * height * bands
+        || out.len < (Py_ssize_t)width * height * bands
+        || index.len < (Py_ssize_t)nsamples * npixels * sizeof(INT32)
+        || found.len < (Py_ssize_t)npixels * sizeof(INT32)
+        || left < 0 || top < 0 || right > width || bottom > height)
+    {
+        PyBuffer_Release(&src);
+        PyBuffer_Release(&index);
+        PyBuffer_Release(&found);
+        PyBuffer_Release(&out);
+        PyErr_SetString(PyExc_ValueError, "buffer size mismatch");
+        return NULL;
+    }
 
-struct ImagingMemoryInstance {
+    in = (const UINT8 *)src.buf;
+    idx = (const INT32 *)index.buf;
+    cnt = (const INT32 *)found.buf;
 
-    /* Format */
-    char mode[6+1];	/* Band names ("1", "L", "P", "RGB", "RGBA", "CMYK", "YCbCr", "BGR;xy") */
-    int type;		/* Data type (IMAGING_TYPE_*) */
-    int depth;		/* Depth (ignored in this version) */
-    int bands;		/* Number of bands (1, 2, 3, or 4) */
-    int xsize;		/* Image dimension. */
-    int ysize;
+    rowtop = rowtop > top ? rowtop : top;
+    rowbottom = rowbottom < bottom ? rowbottom : bottom;
 
-    /* Colour palette (for "P" images only) */
-    ImagingPalette palette;
+    Py_BEGIN_ALLOW_THREADS
 
-    /* Data pointers */
-    UINT8 **image8;	/* Set for 8-bit images (pixelsize=1). */
-    INT32 **image32;	/* Set for 32-bit images (pixelsize=4). */
+    for (i = (rowtop - top) * boxwidth; i < (rowbottom - top) * boxwidth; i++)
+    {
+        if (cnt[i] <= 0)
+        {
+            continue;
+        }
 
-    /* Internals */
-    char **image;	/* Actual raster data. */
-    char *block;	/* Set if data is allocated in a single block. */
+        for (b = 0; b < bands; b++)
+        {
+            sum[b] = 0;
+        }
 
-    int pixelsize;	/* Size of a pixel, in bytes (1, 2 or 4) */
-    int linesize;	/* Size of a line, in bytes (xsize * pixelsize) */
+        for (s = 0; s < nsamples; s++)
+        {
+            INT32 k = idx[(Py_ssize_t)s * npixels + i];
+            if (k < 0)
+            {
+                continue;
+            }
+            for (b = 0; b < bands; b++)
+            {
+                sum[b] += in[(Py_ssize_t)k * bands + b];
+            }
+        }
 
-    /* Virtual methods */
-    void (*destroy)(Imaging im);
-};
+        x = left + i % boxwidth;
+        y = top + i / boxwidth;
+        pixel = (UINT8 *)out.buf + ((Py_ssize_t)y * width + x) * bands;
+        for (b = 0; b < bands; b++)
+        {
+            pixel[b] = sum[b] / cnt[i];
+        }
+    }
 
+    Py_END_ALLOW_THREADS
 
-struct ImagingAccessInstance {
-  const char* mode;
-  void* (*line)(Imaging im, int i, int j);
-  void (*get_pixel)(Imaging im, int i, int j, void* pixel);
-  void (*put_pixel)(Imaging im, int i, int j, const void* pixel);
-};
+    PyBuffer_Release(&src);
+    PyBuffer_Release(&index);
+    PyBuffer_Release(&found);
+    PyBuffer_Release(&out);
 
-struct ImagingPaletteInstance {
+    Py_RETURN_NONE;
+}
 
-    /* Format */
-    char mode[4+1];	/* Band names */
 
-    /* Data */
-    UINT8 palette[1024];/* Palette data (same format as image data) */
+/* 按照插值核加权取样，对应InterpolatedRemapTable
+ * xindex, xweight是 npixels x kx 的数组，yoffset, yweight是 npixels x ky 的数组，
+ * 权重是int16的定点数（1.0对应1 << WEIGHT_BITS），yoffset记录的是行首的下标（y * width）。found为0的像素保持out原来的值。
+ * out = sum_j wy[j] * sum_i wx[i] * src[y[j], x[i]]，全部用整数计算，与NumPy版本的结果完全相同
+ */
+#define WEIGHT_BITS 12
 
-    INT16* cache;	/* Palette cache (used for predefined palettes) */
-    int keep_cache;	/* This palette will be reused; keep cache */
+static PyObject* remap_weighted(PyObject *self, PyObject *args)
+{
+    Py_buffer src, xindex, xweight, yoffset, yweight, found, out;
+    int width, height, bands, kx, ky;
+    int left, top, right, bottom, rowtop, rowbottom;
+    int boxwidth, npixels;
+    int i, j, k, b, x, y;
+    const UINT8 *in, *pt;
+    const UINT8 *row;
+    const INT32 *xi, *yi, *cnt, *pxi;
+    const INT16 *wx, *wy, *pwx;
+    UINT8 *pixel;
+    INT64 sum[MAX_BANDS], t;
+    INT32 rsum[MAX_BANDS];
+
+    if (!PyArg_ParseTuple(args, "s*iiis*s*is*s*is*(iiii)(ii)w*",
+                          &src, &width, &height, &bands,
+                          &xindex, &xweight, &kx,
+                          &yoffset, &yweight, &ky,
+                          &found,
+                          &left, &top, &right, &bottom,
+                          &rowtop, &rowbottom,
+                          &out))
+    {
+        return NULL;
+    }
 
-};
+    boxwidth = right - left;
+    npixels = boxwidth * (bottom - top);
+
+    if (bands < 1 || bands > MAX_BANDS
+        || src.len < (Py_ssize_t)width * height * bands
+        || out.len < (Py_ssize_t)width * height * bands
+        || xindex.len < (Py_ssize_t)kx * npixels * sizeof(INT32)
+        || xweight.len < (Py_ssize_t)kx * npixels * sizeof(INT16)
+        || yoffset.len < (Py_ssize_t)ky * npixels * sizeof(INT32)
+        || yweight.len < (Py_ssize_t)ky * npixels * sizeof(INT16)
+        || found.len < (Py_ssize_t)npixels * sizeof(INT32)
+        || left < 0 || top < 0 || right > width || bottom > height)
+    {
+        PyBuffer_Release(&src);
+        PyBuffer_Release(&xindex);
+        PyBuffer_Release(&xweight);
+        PyBuffer_Release(&yoffset);
+        PyBuffer_Release(&yweight);
+        PyBuffer_Release(&found);
+        PyBuffer_Release(&out);
+        PyErr_SetString(PyExc_ValueError, "buffer size mismatch");
+        return NULL;
+    }
 
-typedef struct {
-    PyObject_HEAD
-    Imaging image;
-    ImagingAccess access;
-} ImagingObject;
+    in = (const UINT8 *)src.buf;
+    xi = (const INT32 *)xindex.buf;
+    wx = (const INT16 *)xweight.buf;
+    yi = (const INT32 *)yoffset.buf;
+    wy = (const INT16 *)yweight.buf;
+    cnt = (const INT32 *)found.buf;
 
+    rowtop = rowtop > top ? rowtop : top;
+    rowbottom = rowbottom < bottom ? rowbottom : bottom;
 
+    Py_BEGIN_ALLOW_THREADS
 
-/* 弧度变形 */
-static int _radian_warp(PyObject *func, double x, double y, double *xnew, double *ynew)
-{
-    double phi,radius,radius2;
-    PyObject *ret;
+    for (i = (rowtop - top) * boxwidth; i < (rowbottom - top) * boxwidth; i++)
+    {
+        if (cnt[i] <= 0)
+        {
+            continue;
+        }
 
-    radius2 = x * x + y * y;
-    radius = sqrt(radius2);
-    phi = atan2(y, x);
+        for (b = 0; b < bands; b++)
+        {
+            sum[b] = 0;
+        }
 
-    if ((ret = PyObject_CallFunction(func, "dd", radius, phi)) == NULL)
-    {
-        return 0;
+        pxi = xi + (Py_ssize_t)i * kx;
+        pwx = wx + (Py_ssize_t)i * kx;
+        for (j = 0; j < ky; j++)
+        {
+            row = in + (Py_ssize_t)yi[(Py_ssize_t)i * ky + j] * bands;
+            for (b = 0; b < bands; b++)
+            {
+                rsum[b] = 0;
+            }
+            for (k = 0; k < kx; k++)
+            {
+                pt = row + (Py_ssize_t)pxi[k] * bands;
+                for (b = 0; b < bands; b++)
+                {
+                    rsum[b] += pwx[k] * pt[b];
+                }
+            }
+            for (b = 0; b < bands; b++)
+            {
+                sum[b] += (INT64)wy[(Py_ssize_t)i * ky + j] * rsum[b];
+            }
+        }
+
+        x = left + i % boxwidth;
+        y = top + i / boxwidth;
+        pixel = (UINT8 *)out.buf + ((Py_ssize_t)y * width + x) * bands;
+        for (b = 0; b < bands; b++)
+        {
+            t = sum[b] + (1 << (2 * WEIGHT_BITS - 1));
+            t = t < 0 ? 0 : t >> (2 * WEIGHT_BITS);
+            pixel[b] = t > 255 ? 255 : (UINT8)t;
+        }
     }
-    if (!PyArg_ParseTuple(ret, "dd", &radius, &phi))
-    {
-        return 0;
-    } 
-    Py_DECREF(ret);
 
-    *xnew = radius * cos(phi);
-    *ynew = radius * sin(phi);
+    Py_END_ALLOW_THREADS
+
+    PyBuffer_Release(&src);
+    PyBuffer_Release(&xindex);
+    PyBuffer_Release(&xweight);
+    PyBuffer_Release(&yoffset);
+    PyBuffer_Release(&yweight);
+    PyBuffer_Release(&found);
+    PyBuffer_Release(&out);
 
-    return 1;
+    Py_RETURN_NONE;
 }
 
 
-/* 基于平移的变形 */
-static int _xy_warp(PyObject *func, double x, double y, double *xnew, double *ynew)
+/* 与floor的结果相同（|u| < 2 ** 31），不用调用libm，快得多 */
+static inline double fast_floor(double u)
 {
-    PyObject *ret;
-    if ((ret = PyObject_CallFunction(func, "dd", x, y)) == NULL)
+    double t = (double)(int)u;
+    return t > u ? t - 1 : t;
+}
+
+/* 一个方向上的双线性插值，与Python中的axis_taps('bilinear', ...)逐位相同 */
+static inline void bilinear_taps(double u, int size, int *index, INT16 *weight)
+{
+    double base = fast_floor(u);
+    int k, i;
+
+    for (k = 0; k < 2; k++)
     {
-        return 0;
+        i = (int)base + k;
+        index[k] = i < 0 ? 0 : (i > size - 1 ? size - 1 : i);
+        weight[k] = (INT16)fast_floor((1 - fabs(u - (base + k))) * (1 << WEIGHT_BITS) + 0.5);
     }
-    if (!PyArg_ParseTuple(ret, "dd", xnew, ynew))
-    {
-        return 0;
-    } 
-    Py_DECREF(ret);
-
-    return 1;
 }
 
 
-/* 镜头变形效果 */
-static PyObject* _lens_warp(PyObject *self, PyObject *args, int (*warp)(PyObject*, double, double, double *, double*))
+/* 透视变换 + 双线性插值，不需要映射表
+ * matrix是输出图 => 源图的单应矩阵 (a, b, c, d, e, f, g, h)，坐标以像素的边为准，
+ * 结果与PerspectiveWarpEffect生成的InterpolatedRemapTable完全相同。
+ * 落在源图之外（或者地平线之后）的像素保持out原来的值。
+ */
+static PyObject* perspective(PyObject *self, PyObject *args)
 {
-    PyObject *image;
-    PyObject *newimage;
-    ImagingObject *core;
-    Imaging imIn, imOut;
-    int i, j, ai, aj; 
-    int found, rsum, gsum, bsum, asum;
-    int antialias = 2;
-    double xx, yy;
-    int width, height;
-    double i2, j2;
-    double xnew, ynew;
-    UINT8 *pixel; 
-    int i3, j3;
-    PyObject *func;
-    PyObject *empty_color;
-    int er, eg, eb, ea;
-
-    if (!PyArg_ParseTuple(args, "OOiO", &image, &func, &antialias, &empty_color))
+    Py_buffer src, out;
+    int width, height, bands;
+    double a, b, c, d, e, f, g, h;
+    int left, top, right, bottom, rowtop, rowbottom;
+    int x, y, j, k, ch;
+    int xi[2], yi[2];
+    INT16 wx[2], wy[2];
+    double xx, yy, w, u, v;
+    const UINT8 *in, *pt;
+    UINT8 *pixel;
+    INT64 sum[MAX_BANDS], t;
+    INT32 rsum[MAX_BANDS];
+
+    if (!PyArg_ParseTuple(args, "s*iii(dddddddd)(iiii)(ii)w*",
+                          &src, &width, &height, &bands,
+                          &a, &b, &c, &d, &e, &f, &g, &h,
+                          &left, &top, &right, &bottom,
+                          &rowtop, &rowbottom,
+                          &out))
     {
         return NULL;
-    } 
+    }
 
-    if ((core = (ImagingObject *)PyObject_GetAttrString(image, "im")) == NULL)
+    if (bands < 1 || bands > MAX_BANDS
+        || src.len < (Py_ssize_t)width * height * bands
+        || out.len < (Py_ssize_t)width * height * bands
+        || left < 0 || top < 0 || right > width || bottom > height)
     {
+        PyBuffer_Release(&src);
+        PyBuffer_Release(&out);
+        PyErr_SetString(PyExc_ValueError, "buffer size mismatch");
         return NULL;
-    } 
-    imIn = core->image;
-    Py_DECREF(core);
+    }
 
-    /* copy a new image */
-    newimage = PyObject_CallMethod(image, "copy", NULL);
-    if ((core = (ImagingObject *)PyObject_GetAttrString(newimage, "im")) == NULL)
-    {
-        return NULL;
-    } 
-    imOut = core->image; 
-    Py_DECREF(core);
+    in = (const UINT8 *)src.buf;
+    rowtop = rowtop > top ? rowtop : top;
+    rowbottom = rowbottom < bottom ? rowbottom : bottom;
 
-    if (!PyArg_ParseTuple(empty_color, "iiii", &er, &eg, &eb, &ea))
-    {
-        return NULL;
-    } 
+    Py_BEGIN_ALLOW_THREADS
 
-    width = imIn->xsize;
-    height = imIn->ysize;
-    
-    for (j = 0; j < height; j++)
+    for (y = rowtop; y < rowbottom; y++)
     {
-        for (i = 0; i < width; i++)
+        yy = y + 0.5;
+        for (x = left; x < right; x++)
         {
-            found = 0;
-            rsum = 0;
-            gsum = 0;
-            bsum = 0; 
-            asum = 0;
-
-            pixel = imOut->image[j];
-            pixel += i * 4;
-            pixel[0] = er;
-            pixel[1] = eg;
-            pixel[2] = eb;
-            pixel[3] = ea;
-
-            for (ai = 0; ai < antialias; ai++)
+            xx = x + 0.5;
+            w = g * xx + h * yy + 1;
+            if (!(w > 0))
+            {
+                continue;
+            }
+            u = (a * xx + b * yy + c) / w - 0.5;
+            v = (d * xx + e * yy + f) / w - 0.5;
+            if (!(u > -0.5 && u < width - 0.5 && v > -0.5 && v < height - 0.5))
             {
-                xx = 2.0 * (i + ai / (double)antialias) / width - 1; 
+                continue;
+            }
 
-                for (aj = 0; aj < antialias; aj++)
+            bilinear_taps(u, width, xi, wx);
+            bilinear_taps(v, height, yi, wy);
+            for (ch = 0; ch < bands; ch++)
+            {
+                sum[ch] = 0;
+            }
+            for (j = 0; j < 2; j++)
+            {
+                for (ch = 0; ch < bands; ch++)
                 {
-                    yy = 2.0 * (j + aj / (double)antialias) / height - 1;
-
-                    xnew = xx;
-                    ynew = yy;
-
-                    /* ----------- */
-                    warp(func, xx, yy, &xnew, &ynew);
-
-                    /* ------------------------- */
-
-                    i2 = 0.5 * width * (xnew + 1);
-                    j2 = 0.5 * height * (ynew + 1);
-                    
-                    i3 = round(i2);
-                    j3 = round(j2);
-
-                    if (i3 < 0 || i3 >= width || j3 < 0 || j3 >= height)
+                    rsum[ch] = 0;
+                }
+                for (k = 0; k < 2; k++)
+                {
+                    pt = in + ((Py_ssize_t)yi[j] * width + xi[k]) * bands;
+                    for (ch = 0; ch < bands; ch++)
                     {
-                        continue;
+                        rsum[ch] += wx[k] * pt[ch];
                     }
-
-                    pixel = (UINT8*)imIn->image[j3];
-                    pixel += i3 * 4;
-
-                    rsum += pixel[0];
-                    gsum += pixel[1];
-                    bsum += pixel[2];
-                    asum += pixel[3];
-                    found++;
+                }
+                for (ch = 0; ch < bands; ch++)
+                {
+                    sum[ch] += (INT64)wy[j] * rsum[ch];
                 }
             }
 
-            if (found > 0)
+            pixel = (UINT8 *)out.buf + ((Py_ssize_t)y * width + x) * bands;
+            for (ch = 0; ch < bands; ch++)
             {
-                pixel = imOut->image[j];
-                pixel += i * 4;
-                pixel[0] = rsum / found;
-                pixel[1] = gsum / found;
-                pixel[2] = bsum / found;
-                pixel[3] = asum / found;
+                t = sum[ch] + (1 << (2 * WEIGHT_BITS - 1));
+                t = t < 0 ? 0 : t >> (2 * WEIGHT_BITS);
+                pixel[ch] = t > 255 ? 255 : (UINT8)t;
             }
         }
     }
 
-    return (PyObject *)newimage;
-}
+    Py_END_ALLOW_THREADS
 
-static PyObject* lens_warp(PyObject *self, PyObject *args)
-{
-    PyObject *img = _lens_warp(self, args, _xy_warp);
-    return img;
-}
+    PyBuffer_Release(&src);
+    PyBuffer_Release(&out);
 
-static PyObject* radian_warp(PyObject *self, PyObject *args)
-{
-    PyObject *img = _lens_warp(self, args, _radian_warp);
-    return img;
+    Py_RETURN_NONE;
 }
 
-/* 波浪效果 */
-static PyObject* wave_warp(PyObject *self, PyObject *args)
+
+/* 局部变形，参考 Interactive Image Warping by Andreas Gustafsson
+ * 与LocalWarpEffect.warp的计算完全一致，out中应该预先放好原图
+ */
+static PyObject* local_warp(PyObject *self, PyObject *args)
 {
-    PyObject *image;
-    PyObject *newimage;
-    ImagingObject *core;
-    Imaging imIn, imOut;
-    int i, j, ai, aj; 
-    int found, rsum, gsum, bsum, asum;
-    int antialias = 2;
-    double xx, yy;
-    int width, height;
-    double i2, j2;
-    double xnew, ynew;
-    UINT8 *pixel; 
-    int i3, j3;
-    PyObject *empty_color;
-    double dw = 1, dh=0.3;
-    double radian;
-    double offset;
-    int er, eg, eb, ea;
-    double xoffset;
-
-    if (!PyArg_ParseTuple(args, "OdddiO", &image, &dw, &dh, &xoffset, &antialias, &empty_color))
+    Py_buffer src, out;
+    int width, height, bands, antialias;
+    double cx, cy, mx, my, r;
+    int left, top, right, bottom;
+    int x, y, ai, aj, b, found;
+    double xx, yy, dis_x_c, dis_m_c, div, factor, u, v;
+    const UINT8 *in, *pt;
+    UINT8 *pixel;
+    int sum[MAX_BANDS];
+
+    if (!PyArg_ParseTuple(args, "s*iii(dd)(dd)di(iiii)w*",
+                          &src, &width, &height, &bands,
+                          &cx, &cy, &mx, &my, &r, &antialias,
+                          &left, &top, &right, &bottom,
+                          &out))
     {
         return NULL;
-    } 
+    }
 
-    if ((core = (ImagingObject *)PyObject_GetAttrString(image, "im")) == NULL)
+    if (bands < 1 || bands > MAX_BANDS || antialias < 1
+        || src.len < (Py_ssize_t)width * height * bands
+        || out.len < (Py_ssize_t)width * height * bands
+        || left < 0 || top < 0 || right > width || bottom > height)
     {
+        PyBuffer_Release(&src);
+        PyBuffer_Release(&out);
+        PyErr_SetString(PyExc_ValueError, "buffer size mismatch");
         return NULL;
-    } 
-    imIn = core->image;
-    Py_DECREF(core);
+    }
 
-    /* copy a new image */
-    newimage = PyObject_CallMethod(image, "copy", NULL);
-    if ((core = (ImagingObject *)PyObject_GetAttrString(newimage, "im")) == NULL)
-    {
-        return NULL;
-    } 
-    imOut = core->image; 
-    Py_DECREF(core);
+    in = (const UINT8 *)src.buf;
 
-    if (!PyArg_ParseTuple(empty_color, "iiii", &er, &eg, &eb, &ea))
-    {
-        return NULL;
-    } 
+    Py_BEGIN_ALLOW_THREADS
 
-    width = imIn->xsize;
-    height = imIn->ysize;
-    
-    for (j = 0; j < height; j++)
+    for (y = top; y < bottom; y++)
     {
-        for (i = 0; i < width; i++)
+        for (x = left; x < right; x++)
         {
+            if (sqrt((x - cx) * (x - cx) + (y - cy) * (y - cy)) > r)
+            {
+                continue;
+            }
+
             found = 0;
-            rsum = 0;
-            gsum = 0;
-            bsum = 0; 
-            asum = 0;
-
-            pixel = imOut->image[j];
-            pixel += i * 4;
-            pixel[0] = er;
-            pixel[1] = eg;
-            pixel[2] = eb;
-            pixel[3] = ea;
+            for (b = 0; b < bands; b++)
+            {
+                sum[b] = 0;
+            }
 
             for (ai = 0; ai < antialias; ai++)
             {
-                xx = i + ai / (double)antialias;
+                xx = x + ai / (double)antialias;
 
                 for (aj = 0; aj < antialias; aj++)
                 {
-                    yy = j + aj / (double)antialias;
+                    yy = y + aj / (double)antialias;
 
-                    /* ------------------------- */
-                    radian = 2 * 3.14159265 * (xx + xoffset) / (double)width * dw;
-                    offset = 0.5 * sin(radian) * height * dh;
-
-                    xnew = xx;
-                    ynew = yy + offset; 
-                    
-                    /* ------------------------- */
+                    dis_x_c = sqrt((xx - cx) * (xx - cx) + (yy - cy) * (yy - cy));
+                    dis_m_c = sqrt((xx - mx) * (xx - mx) + (yy - my) * (yy - my));
+                    div = r * r - dis_x_c * dis_x_c + dis_m_c * dis_m_c;
+                    if (div == 0)
+                    {
+                        div = 0.0000000001;
+                    }
+                    factor = (r * r - dis_x_c * dis_x_c) / div;
+                    factor = factor * factor;
 
-                    i3 = round(xnew);
-                    j3 = round(ynew);
-                    /* printf("%d %d %d %d\n", i, j, i3, j3); */
+                    u = round(xx - factor * (mx - cx));
+                    v = round(yy - factor * (my - cy));
 
-                    if (i3 < 0 || i3 >= width || j3 < 0 || j3 >= height)
+                    if (!(u >= 0 && u < width && v >= 0 && v < height))
                     {
                         continue;
                     }
 
-                    pixel = (UINT8*)imIn->image[j3];
-                    pixel += i3 * 4;
-
-                    rsum += pixel[0];
-                    gsum += pixel[1];
-                    bsum += pixel[2];
-                    asum += pixel[3];
+                    pt = in + ((Py_ssize_t)v * width + (Py_ssize_t)u) * bands;
+                    for (b = 0; b < bands; b++)
+                    {
+                        sum[b] += pt[b];
+                    }
                     found++;
                 }
             }
 
             if (found > 0)
             {
-                pixel = imOut->image[j];
-                pixel += i * 4;
-                pixel[0] = rsum / found;
-                pixel[1] = gsum / found;
-                pixel[2] = bsum / found;
-                pixel[3] = asum / found;
+                pixel = (UINT8 *)out.buf + ((Py_ssize_t)y * width + x) * bands;
+                for (b = 0; b < bands; b++)
+                {
+                    pixel[b] = sum[b] / found;
+                }
             }
         }
     }
 
-    return (PyObject *)newimage;
+    Py_END_ALLOW_THREADS
+
+    PyBuffer_Release(&src);
+    PyBuffer_Release(&out);
+
+    Py_RETURN_NONE;
 }
 
 
 static PyMethodDef CoreMethods[] = {
-    {"lens_warp", lens_warp, METH_VARARGS, "Global warp"},
-    {"radian_warp", radian_warp, METH_VARARGS, "Radian Warp"},
-    {"wave_warp", wave_warp, METH_VARARGS, "Wave"},
+    {"remap", remap, METH_VARARGS, "Gather and average through a remap table"},
+    {"remap_weighted", remap_weighted, METH_VARARGS, "Weighted remap for interpolated sampling"},
+    {"perspective", perspective, METH_VARARGS, "Perspective warp with bilinear sampling"},
+    {"local_warp", local_warp, METH_VARARGS, "Local warp"},
     {NULL, NULL, 0, NULL}
 };
 
-PyMODINIT_FUNC initEffectLabCore()
+PyMODINIT_FUNC initEffectLabCore(void)
 {
     Py_InitModule("EffectLabCore", CoreMethods);
 }
-
-
-
-
-
-
-
-
-
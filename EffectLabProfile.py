@@ -1,37 +1,289 @@
 #!/usr/bin/env python
-# -*- coding: utf-8 -*-  
+# -*- coding: utf-8 -*-
 # author:  Hua Liang [ Stupid ET ]
 # email:   et@everet.org
 # website: http://EverET.org
 #
+# EffectLab的性能测试
+#
+# 对每一个Effect子类，在不同的图片尺寸、模式、抗锯齿级别以及后端下计时，
+# 输出每帧耗时、每秒处理的百万像素数以及峰值内存，结果可以保存成JSON，
+# 并与之前保存的基准结果比较，找出性能下降的用例。
+#
+#   python EffectLabProfile.py --sizes 64,256,1024 --json new.json
+#   python EffectLabProfile.py --baseline old.json --threshold 0.1
+#   python EffectLabProfile.py --effects GlobalWaveEffect --profile
 
-import os 
+import os, sys, time, json, resource, optparse
 from EffectLab.Effect import *
 
 Effect.empty_color = (255, 255, 255, 255)
 
-if __name__ == '__main__':
-    from timeit import Timer
-    from functools import partial
-    import cProfile
-
-    img = Image.new("RGB", (100, 100))
-    wave = GlobalWaveEffect(1, 0.5)
-    test = partial(wave, img)
-
-    profile = False
-    if profile:
-        cProfile.run("test()", "profile.data")
-
-        import pstats
-        #创建Stats对象
-        p = pstats.Stats("profile.data")
-        # p.strip_dirs().sort_stats(-1).print_stats()
-        # p.strip_dirs().sort_stats("cumulative").print_stats()
-        p.strip_dirs().sort_stats("time").print_stats()
-    else: 
-        t = Timer('test()', 'from __main__ import test') 
-        N = 3
-        TIMES = 30
-        print sum(t.repeat(N, TIMES)) / N / TIMES * 1000, 'ms'
+SIZES = {
+    '64': (64, 64),
+    '256': (256, 256),
+    '1024': (1024, 1024),
+    '1080p': (1920, 1080),
+    '4k': (3840, 2160),
+    }
+
+
+def radian_sqrt(width, height, antialias, mode):
+    effect = RadianSqrtEffect()
+    effect.antialias = antialias
+    return effect
+
+
+def sample_glue(width, height, antialias, mode):
+    glue = EffectGlue()
+    glue.append(LensWarpEffect(lambda x, y: (x * abs(x), y * abs(y)), antialias))
+    glue.append(GlobalWaveEffect(1, 0.5))
+    return glue
+
+
+# 每个特效的构造方法：f(width, height, antialias, mode) => Effect，颜色等参数要与图片的模式一致
+FACTORIES = {
+    'LensWarpEffect': lambda w, h, aa, mode:
+        LensWarpEffect(lambda x, y: (x * abs(x), y * abs(y)), aa),
+    'RadianFormulaEffect': lambda w, h, aa, mode:
+        RadianFormulaEffect(lambda r, phi: (r ** 1.5, phi), aa),
+    'RadianSqrtEffect': radian_sqrt,
+    'RegionWarpEffect': lambda w, h, aa, mode:
+        RegionWarpEffect(lambda x, y: (x + 0.2 * y, y), aa, (w / 4, h / 4, w * 3 / 4, h * 3 / 4)),
+    'LocalWarpEffect': lambda w, h, aa, mode:
+        LocalWarpEffect((w / 2, h / 2), (w / 2 + w / 10, h / 2 + h / 10), min(w, h) / 3, aa),
+    'MultiLocalWarpEffect': lambda w, h, aa, mode: MultiLocalWarpEffect(
+        [((w * i / 8, h * j / 8), (w * i / 8 + 4, h * j / 8 + 2), min(w, h) / 16)
+         for i in xrange(1, 8) for j in xrange(1, 8)], aa),
+    'FusedWarpEffect': lambda w, h, aa, mode:
+        FusedWarpEffect(sample_glue(w, h, aa, mode).effect_pipeline),
+    'GlobalWaveEffect': lambda w, h, aa, mode: GlobalWaveEffect(1, 0.5),
+    'PerspectiveWarpEffect': lambda w, h, aa, mode:
+        PerspectiveWarpEffect((w / 10, h / 20), (-w / 10, 0), (0, -h / 20), (w / 20, 0)),
+    'EffectGlue': sample_glue,
+    'GridMaker': lambda w, h, aa, mode: GridMaker(20, 20, fill_color(mode, (0, 0, 0, 255))),
+    'TextWriter': lambda w, h, aa, mode:
+        TextWriter((10, 10), 'EffectLab', fill_color(mode, (0, 0, 0, 255))),
+    }
+
+
+def effect_classes():
+    '''Effect的所有子类（包括间接子类）'''
+    found, todo = [], [Effect]
+    while todo:
+        cls = todo.pop()
+        for sub in cls.__subclasses__():
+            if sub not in found:
+                found.append(sub)
+                todo.append(sub)
+    return found
+
+
+def make_cases(options):
+    '''生成所有要测试的用例'''
+    names = [cls.__name__ for cls in effect_classes()]
+    for name in names:
+        if name not in FACTORIES and name != 'WarpEffect':
+            print >> sys.stderr, 'no benchmark factory for %s, skipped' % name
+    if options.effects:
+        names = [n for n in names if n in options.effects.split(',')]
+
+    for name in sorted(n for n in names if n in FACTORIES):
+        for size in options.sizes.split(','):
+            width, height = SIZES.get(size) or map(int, size.split('x'))
+            for mode in options.modes.split(','):
+                for antialias in map(int, options.antialias.split(',')):
+                    effect = FACTORIES[name](width, height, antialias, mode)
+                    backends = [None]
+                    interpolations = ['nearest']
+                    if isinstance(effect, (WarpEffect, EffectGlue, MultiLocalWarpEffect)):
+                        backends = [b for b in options.backends.split(',')
+                                    if b in available_backends()]
+                    else:
+                        # 不受antialias影响的特效只测一次，记为0
+                        antialias = 0
+                    if isinstance(effect, WarpEffect):
+                        # 默认只测特效自己的取样方式
+                        interpolations = (options.interpolations.split(',')
+                                          if options.interpolations else [effect.interpolation])
+                    for backend in backends:
+                        if backend == 'python' and width * height > options.python_max_pixels:
+                            continue
+                        for interpolation in interpolations:
+                            # 插值方式每个像素只取一个采样点，与antialias无关
+                            if interpolation != 'nearest' and antialias != 1:
+                                continue
+                            yield dict(effect=name, width=width, height=height, mode=mode,
+                                       antialias=antialias, backend=backend or 'default',
+                                       interpolation=interpolation)
+                    if not antialias:
+                        break
+
+
+def case_key(case):
+    key = '%(effect)s/%(mode)s/%(width)dx%(height)d/aa%(antialias)d/%(backend)s' % case
+    if case.get('interpolation', 'nearest') != 'nearest':
+        key += '/' + case['interpolation']
+    return key
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux上单位是KB，Mac上是字节
+    return rss / 1024.0 if sys.platform != 'darwin' else rss / 1024.0 / 1024.0
+
 
+def run_case(case, min_time, repeat):
+    '''在当前进程中运行一个用例，返回计时结果'''
+    width, height = case['width'], case['height']
+    effect = FACTORIES[case['effect']](width, height, case['antialias'] or 1, case['mode'])
+    if isinstance(effect, WarpEffect):
+        effect.interpolation = case['interpolation']
+    set_backend(None if case['backend'] == 'default' else case['backend'])
+    img = Image.new(case['mode'], (width, height), fill_color(case['mode'], Effect.empty_color))
+
+    # 第一次调用包含映射表等预处理的时间，单独记录
+    start = time.time()
+    effect(img.copy())
+    first = time.time() - start
+
+    # 每轮至少运行min_time秒，取最快的一轮
+    number = 1
+    while True:
+        start = time.time()
+        for i in xrange(number):
+            effect(img)
+        elapsed = time.time() - start
+        if elapsed >= min_time or number >= 1000:
+            break
+        number *= 2
+    best = elapsed
+    for i in xrange(repeat - 1):
+        start = time.time()
+        for i in xrange(number):
+            effect(img)
+        best = min(best, time.time() - start)
+
+    ms = best / number * 1000
+    return dict(case, first_ms=first * 1000, ms=ms,
+                mpix_per_s=width * height / 1e6 / (ms / 1000),
+                peak_rss_mb=peak_rss_mb())
+
+
+def run_isolated(case, min_time, repeat):
+    '''在fork出来的子进程中运行用例，这样峰值内存只包含这一个用例'''
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        try:
+            result = run_case(case, min_time, repeat)
+        except Exception, e:
+            result = dict(case, error='%s: %s' % (e.__class__.__name__, e))
+        os.write(wfd, json.dumps(result))
+        os._exit(0)
+
+    os.close(wfd)
+    data = []
+    while True:
+        chunk = os.read(rfd, 65536)
+        if not chunk:
+            break
+        data.append(chunk)
+    os.close(rfd)
+    os.waitpid(pid, 0)
+    return json.loads(''.join(data))
+
+
+def compare(results, baseline, threshold):
+    '''与基准结果比较，返回变慢超过threshold的用例 [(结果, 变慢的倍数)]
+    基准中有计时、这次却出错的用例也算在内，倍数为None
+    '''
+    base = dict((case_key(r), r) for r in baseline if 'ms' in r)
+    regressions = []
+    for r in results:
+        old = base.get(case_key(r))
+        if old is None:
+            continue
+        if 'ms' not in r:
+            r['baseline_ms'] = old['ms']
+            regressions.append((r, None))
+            continue
+        ratio = r['ms'] / old['ms']
+        r['baseline_ms'] = old['ms']
+        if ratio > 1 + threshold:
+            regressions.append((r, ratio))
+    return regressions
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--effects', default='', help='comma separated Effect class names, default all')
+    parser.add_option('--sizes', default='64,256,1024', help='comma separated sizes: %s or WxH' % ','.join(sorted(SIZES)))
+    parser.add_option('--modes', default='RGB,RGBA,L')
+    parser.add_option('--antialias', default='1,2,4')
+    parser.add_option('--backends', default=','.join(BACKENDS))
+    parser.add_option('--interpolations', default='',
+                      help='comma separated: %s, default the effect\'s own' % ','.join(INTERPOLATIONS))
+    parser.add_option('--python-max-pixels', type='int', default=256 * 256,
+                      help='skip the python backend for larger images')
+    parser.add_option('--min-time', type='float', default=0.2, help='seconds per timing round')
+    parser.add_option('--repeat', type='int', default=3)
+    parser.add_option('--json', help='write the results to this file')
+    parser.add_option('--baseline', help='compare with results saved by --json')
+    parser.add_option('--threshold', type='float', default=0.1,
+                      help='report cases slower than baseline by this fraction')
+    parser.add_option('--no-isolate', action='store_true', help='run every case in this process')
+    parser.add_option('--profile', action='store_true', help='run the cases under cProfile')
+    options, args = parser.parse_args()
+
+    cases = list(make_cases(options))
+
+    if options.profile:
+        import cProfile, pstats
+        profiler = cProfile.Profile()
+        profiler.runcall(lambda: [run_case(c, options.min_time, 1) for c in cases])
+        pstats.Stats(profiler).strip_dirs().sort_stats("time").print_stats(30)
+        return 0
+
+    results = []
+    print '%-60s %10s %10s %10s %10s' % ('case', 'ms/frame', 'first ms', 'MPix/s', 'peak MB')
+    for case in cases:
+        if options.no_isolate:
+            try:
+                r = run_case(case, options.min_time, options.repeat)
+            except Exception, e:
+                r = dict(case, error='%s: %s' % (e.__class__.__name__, e))
+        else:
+            r = run_isolated(case, options.min_time, options.repeat)
+        results.append(r)
+        if 'error' in r:
+            print '%-60s %s' % (case_key(r), r['error'])
+        else:
+            print '%-60s %10.3f %10.3f %10.2f %10.1f' % (
+                case_key(r), r['ms'], r['first_ms'], r['mpix_per_s'], r['peak_rss_mb'])
+        sys.stdout.flush()
+
+    status = 0
+    if options.baseline:
+        baseline = json.load(open(options.baseline))['results']
+        regressions = compare(results, baseline, options.threshold)
+        for r, ratio in regressions:
+            if ratio is None:
+                print 'FAILED     %-60s %.3f ms -> %s' % (case_key(r), r['baseline_ms'], r['error'])
+            else:
+                print 'REGRESSION %-60s %.3f ms -> %.3f ms (x%.2f)' % (
+                    case_key(r), r['baseline_ms'], r['ms'], ratio)
+        if regressions:
+            status = 1
+        else:
+            print 'no regressions against', options.baseline
+
+    if options.json:
+        json.dump(dict(version=VERSION, backends=available_backends(), results=results),
+                  open(options.json, 'w'), indent=1)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -11,8 +11,11 @@ import autoreload
 import ImageChops
 from math import sqrt, sin, cos, tan, atan2
 from EffectLab.Effect import *
+from EffectLab.Atlas import GlyphAtlas
+from EffectLab.Encoder import Encoder
 
 Effect.empty_color = (255, 255, 255, 255)
+encoder = Encoder('JPEG', quality=90)
 
 def merge_origin_and_new(img, effect):
     '''Merge origin and new Image processed by function effect in one Image
@@ -24,18 +27,8 @@ def merge_origin_and_new(img, effect):
     img = effect(old) 
 
     # merge origin and new image
-    out = Image.new("RGBA", (width * 2, height))
-    out.paste(old, (0, 0))
-    out.paste(img, (width, 0)) 
-    draw = ImageDraw.Draw(out) 
-    draw.line((width, 0, width, height), (255, 0, 0, 255))
-
-    return out
-
-class Character(object):
-    def __init__(self, img):
-        self.width, self.height = img.size
-        self.img = img
+    # 画布会被重复使用，下一次调用之前保存
+    return encoder.comparison(old, img)
 
 def main():
     print 'Started'
@@ -49,7 +42,7 @@ def main():
         # RadianFormulaEffect(lambda r, phi: (r ** 2, phi), 4), 
         GlobalWaveEffect(1, 0.5),
         # LensWarpEffect(lambda x, y: (sin(x * math.pi / 2), sin(y * math.pi / 2))),
-        # RadianFormulaEffect(lambda r, phi: (r ** 1.5 * math.cos(r), phi)),
+        # RadianFormulaEffect('r ** 1.5 * cos(r), phi'),
                ] 
 
     # if os.path.exists('z.jpg'):
@@ -58,32 +51,25 @@ def main():
     #     img = Image.new("RGBA", (300, 300), (255, 255, 255, 255))
 
     characters = string.letters + string.digits
-    char_img = {} 
-    for ch in characters:
-        img = Image.open('Images/%s.png' % ch)
-        char_img[ch] = Character(img)
+    # 所有字符都在一张图集中，遮罩也已经预先算好
+    if os.path.exists('Images/atlas.json'):
+        atlas = GlyphAtlas.open('Images/atlas.json')
+    else:
+        atlas = GlyphAtlas.from_directory('Images', characters)
 
     text = ''.join(random.choice(string.letters) for i in xrange(4))
 
-    img = Image.new("RGBA", (100, 40), (255, 255, 255, 255))
+    img = atlas.canvas((100, 40))
     font = ImageFont.truetype("UbuntuMono-R.ttf", 33)
     # draw = ImageDraw.Draw(img) 
     # draw.setfont(font) 
     # draw.text((10, 0), text, (0, 0, 0)) 
 
-    last = random.choice(characters)
-    offset = 15
-    for i in range(5):
-        ch = random.choice(characters)
-        img.paste(char_img[ch].img,
-                  (offset, 0),
-                  ImageChops.invert(char_img[ch].img.split()[1]))
-        last = ch
-        offset += char_img[last].width - 1
+    atlas.compose(''.join(random.choice(characters) for i in range(5)), img, (15, 0))
 
     for index, effect in enumerate(effects):
         for i in xrange(1):
-            merge_origin_and_new(img, effect).save('tmp/%d-%d.jpg' % (index, i), quality=90)
+            encoder.save(merge_origin_and_new(img, effect), 'tmp/%d-%d.jpg' % (index, i))
         print '.',
     print 'done'
 
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author:  Hua Liang [ Stupid ET ]
+# email:   et@everet.org
+# website: http://EverET.org
+#
+# 字符串方程的测试：python TestFormula.py
+
+import unittest
+from EffectLab.Formula import Formula, numpy
+
+
+class FormulaTest(unittest.TestCase):
+    def check(self, expression, points):
+        formula = Formula(expression)
+        xs = numpy.array([x for x, y in points])
+        ys = numpy.array([y for x, y in points])
+        u, v = formula(xs, ys)
+        for i, (x, y) in enumerate(points):
+            self.assertEqual(formula(x, y), (u[i], v[i]))
+
+    def test_condition(self):
+        self.check('x * 2 if x > 0.5 else x, y', [(0.25, 0.0), (0.75, 1.0)])
+
+    def test_chained_comparison(self):
+        # 连续比较对NumPy数组也必须成立，不能退回逐点计算
+        formula = Formula('x * 2 if 0 < x < 0.5 else x, y')
+        u, v = formula(numpy.array([-0.25, 0.25, 0.75]), numpy.zeros(3))
+        self.assertEqual(list(u), [-0.25, 0.5, 0.75])
+        self.assertEqual(formula(0.25, 0.0), (0.5, 0.0))
+        self.check('x if -1 < x <= y < 1 else -x, y',
+                   [(-0.5, 0.5), (0.5, -0.5), (0.0, 1.0), (-1.0, 0.0)])
+
+    def test_guarded_branch(self):
+        # 标量版本只计算条件成立的分支，sqrt不会收到负数
+        formula = Formula('sqrt(x) if x >= 0 else -sqrt(-x), y')
+        self.assertEqual(formula(0.25, 0.0), (0.5, 0.0))
+        self.assertEqual(formula(-0.25, 0.0), (-0.5, 0.0))
+        self.check('sqrt(x) if x >= 0 else -sqrt(-x), y', [(0.25, 0.0), (-0.25, 1.0)])
+
+    def test_rejected(self):
+        for expression in ('__import__("os"), y', 'x.real, y', 'x, y, x',
+                           'x if 0 < x and x < 1 else 0, y'):
+            self.assertRaises(ValueError, Formula, expression)
+
+
+if __name__ == '__main__':
+    unittest.main()
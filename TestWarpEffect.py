@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author:  Hua Liang [ Stupid ET ]
+# email:   et@everet.org
+# website: http://EverET.org
+#
+# 坐标映射类特效的测试：python TestWarpEffect.py
+
+import unittest
+import Image
+from EffectLab.Effect import (LocalWarpEffect, RegionWarpEffect, available_backends,
+                              remap_cache)
+
+
+def sample_image():
+    img = Image.new('RGB', (40, 30), (10, 20, 30))
+    img.paste((200, 100, 50), (8, 6, 24, 20))
+    return img
+
+
+class WarpEffectTest(unittest.TestCase):
+    def render(self, effect, backend):
+        effect.backend = backend
+        return effect(sample_image()).tostring()
+
+    def test_list_arguments(self):
+        # 参数是列表时与tuple的结果相同，不能因为作为缓存的key而出错
+        for backend in available_backends():
+            remap_cache.clear()
+            self.assertEqual(self.render(LocalWarpEffect([15, 12], [20, 15], 10), backend),
+                             self.render(LocalWarpEffect((15, 12), (20, 15), 10), backend))
+            self.assertEqual(self.render(RegionWarpEffect('x + 0.2 * y, y', 2, [5, 5, 30, 20]),
+                                         backend),
+                             self.render(RegionWarpEffect('x + 0.2 * y, y', 2, (5, 5, 30, 20)),
+                                         backend))
+
+
+if __name__ == '__main__':
+    unittest.main()
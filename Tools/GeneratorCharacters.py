@@ -1,61 +1,149 @@
 #!/usr/bin/env python
+# -*- coding: utf-8 -*-
 # author:  Hua Liang [ Stupid ET ]
 # email:   et@everet.org
 # website: http://EverET.org
 #
 # This is a tools that generate each image of character
+#
+# 把所有字符画成一行，按列投影切出每个字符，打包成一张图集和一个清单。
+# 可以一次生成多种字体、多个字号，每一套在进程池中并行生成：
+#
+#   python GeneratorCharacters.py
+#   python GeneratorCharacters.py --fonts a.ttf,b.ttf --sizes 24,33 --output ../Images/atlas
 
-import random, string, md5, time
+import string, sys, os, optparse, multiprocessing
 import Image, ImageDraw, ImageFont
-import StringIO, string
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from EffectLab.Atlas import GlyphAtlas
+
+width, height = 1200, 40
+
+characters = string.letters + string.digits
 
 def get_vertical_map(img):
-    img = img.convert('L') 
-    # segmentation
-    m = [0] * width 
-    for x in range(width):
-        for y in range(height):
-            if img.getpixel((x, y)) != 255:
+    '''每一列中非白色像素的个数'''
+    img = img.convert('L')
+    w, h = img.size
+    data = img.tostring()
+    if numpy is not None:
+        pixels = numpy.fromstring(data, numpy.uint8).reshape(h, w)
+        return (pixels != 255).sum(axis=0)
+
+    m = [0] * w
+    for y in xrange(h):
+        row = data[y * w:(y + 1) * w]
+        for x in xrange(w):
+            if row[x] != '\xff':
                 m[x] += 1
     return m
 
-def get_character_region(iterator):
+def get_character_region(m):
     '''get character region
+    @return [(left, right)]，每一段连续的非空列是一个字符，right是字符后的第一个空列
     '''
-    state = "empty"
-
-    i, lbd, rbd = 0, -1, -1
-    while True:
-        data = iterator.next() 
-        if state == "empty":
-            if data != 0:
-                # enter
-                state = "collect"
-                lbd = i
-        elif state == "collect":
-            if data == 0:
-                # leave
-                rbd = i
-                state = "empty"
-                yield (lbd, rbd)
-        i += 1
+    if numpy is not None:
+        ink = numpy.concatenate(([False], numpy.asarray(m) != 0, [False]))
+        edges = numpy.flatnonzero(ink[1:] != ink[:-1])
+        return [(int(l), int(r)) for l, r in edges.reshape(-1, 2)]
 
-width, height = 1200, 40
+    regions, lbd = [], None
+    for i, data in enumerate(m):
+        if data and lbd is None:
+            lbd = i
+        elif not data and lbd is not None:
+            regions.append((lbd, i))
+            lbd = None
+    if lbd is not None:
+        regions.append((lbd, len(m)))
+    return regions
 
-characters = string.letters + string.digits
+def face_name(font_path, size):
+    return '%s-%d' % (os.path.splitext(os.path.basename(font_path))[0], size)
+
+def render_face(job):
+    '''生成一套字体的所有字符
+    在进程池中运行，返回的图片转成字符串，方便传回主进程
+    @return (字体名, [(字符, 模式, 尺寸, 像素)], {字符: 度量})
+    '''
+    font_path, size, chars = job
+    font = ImageFont.truetype(font_path, size)
+    # 字符之间留出空隙，否则相邻的字符可能连在一起
+    text = ' '.join(chars)
+    text_width, text_height = font.getsize(text)
+    w, h = text_width + 20, max(height, text_height)
+
+    # draw img
+    img = Image.new("RGBA", (w, h), (255, 255, 255, 0))
+    draw = ImageDraw.Draw(img)
+    draw.setfont(font)
+    draw.text((10, 0), text, (0, 0, 0, 255))
+    del draw
+
+    regions = get_character_region(get_vertical_map(img))
+    if len(regions) != len(chars):
+        raise ValueError('%s: found %d glyphs for %d characters'
+                         % (face_name(font_path, size), len(regions), len(chars)))
+
+    glyphs, metrics = [], {}
+    for ch, (left, right) in zip(chars, regions):
+        glyph = img.crop((left, 0, right, h))
+        glyphs.append((ch, glyph.mode, glyph.size, glyph.tostring()))
+        metrics[ch] = dict(advance=font.getsize(ch)[0], ink=right - left)
+    return face_name(font_path, size), glyphs, metrics
+
+def build_atlas(jobs, processes=None):
+    '''并行生成所有字体，打包成一张图集
+    只有一套字体时字符名就是字符本身，多套时是 "字体/字符"
+    '''
+    if len(jobs) > 1 and processes != 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            faces = pool.map(render_face, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        faces = map(render_face, jobs)
 
-# draw img
-img = Image.new("RGBA", (width, height), (255, 255, 255, 0))
-font = ImageFont.truetype("../UbuntuMono-R.ttf", 33)
-draw = ImageDraw.Draw(img) 
-draw.setfont(font)
-draw.text((10, 0), characters, (0, 0, 0, 255)) 
-del draw
+    glyphs, metrics = [], {}
+    for name, face_glyphs, face_metrics in faces:
+        prefix = name + '/' if len(faces) > 1 else ''
+        for ch, mode, size, data in face_glyphs:
+            glyphs.append((prefix + ch, Image.fromstring(mode, size, data)))
+            metrics[prefix + ch] = dict(face_metrics[ch], face=name)
+    return GlyphAtlas.from_glyphs(glyphs, metrics=metrics)
 
-m = get_vertical_map(img)
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--fonts', default=os.path.join(ROOT, 'UbuntuMono-R.ttf'),
+                      help='comma separated TrueType fonts')
+    parser.add_option('--sizes', default='33', help='comma separated font sizes')
+    parser.add_option('--characters', default=characters)
+    parser.add_option('--output', default=os.path.join(ROOT, 'Images', 'atlas'),
+                      help='writes OUTPUT.json and OUTPUT.png (or OUTPUT.raw)')
+    parser.add_option('--format', default='png', help='png or raw')
+    parser.add_option('--processes', type='int', help='default one per CPU')
+    options, args = parser.parse_args()
 
-for index, bd in enumerate(get_character_region(iter(m))):
-    ch = characters[index]
+    jobs = [(font, int(size), options.characters)
+            for font in options.fonts.split(',')
+            for size in options.sizes.split(',')]
 
-    img.crop((bd[0], 0, bd[1], height)).save('../Images/%s.png' % ch) 
+    directory = os.path.dirname(options.output)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    # 所有字符打包成一张图集，生成验证码时不需要逐个打开PNG
+    atlas = build_atlas(jobs, options.processes)
+    atlas.save(options.output, options.format)
+    print '%d glyphs in %d faces -> %s.json' % (len(atlas.boxes), len(jobs), options.output)
 
+if __name__ == '__main__':
+    main()
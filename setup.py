@@ -34,6 +34,7 @@ setup(name = NAME,
       packages = ['EffectLab'],
       license = "Python (MIT style)",
       platforms = "Python 1.5.2 and later and PIL 1.1.7 and later.",
-      ext_modules = [Extension('EffectLab.EffectLabCore', ['EffectLab/core.c']),
+      ext_modules = [Extension('EffectLab.EffectLabCore', ['EffectLab/core.c'],
+                               depends=['EffectLab/ImPlatform.h']),
                      ] 
       )